@@ -0,0 +1,139 @@
+"""Pooled HTTP client for the CoCoMac server.
+
+urllib2.urlopen opens a new connection for every request, so each of the
+hundreds of per-map and per-area queries pays the full cost of connecting
+to the server.  CoCoMacClient instead keeps finished connections open and
+hands them to the next request for the same host, and it limits the number
+of requests made to any one host at the same time.  The client is safe to
+share among threads.
+"""
+import httplib
+import socket
+import threading
+import urllib2
+import urlparse
+
+
+# The site appears to have changed from cocomac.org to 134.95.56.239.
+# Point this at a stand-in server to run queries offline.
+COCOMAC_URL = 'http://134.95.56.239/URLSearch.asp'
+
+
+class CoCoMacClient(object):
+
+    """Thread-safe HTTP client with keep-alive connection pooling.
+
+    Parameters
+    ----------
+    max_per_host : integer (optional)
+      Maximum number of requests in flight to any one host.  Requests
+      beyond this number wait for one of the others to finish.
+
+    timeout : number (optional)
+      Seconds to wait on the server before a request is abandoned.  This
+      applies to connecting and to each read from the socket.
+    """
+
+    def __init__(self, max_per_host=4, timeout=120):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.slots = {}
+
+    def _slot(self, host):
+        with self.lock:
+            if not self.slots.has_key(host):
+                self.slots[host] = threading.BoundedSemaphore(
+                    self.max_per_host)
+            return self.slots[host]
+
+    def _checkout(self, host):
+        """Return an idle connection to host and whether it was reused."""
+        with self.lock:
+            idle = self.idle.get(host)
+            if idle:
+                return idle.pop(), True
+        return httplib.HTTPConnection(host, timeout=self.timeout), False
+
+    def _checkin(self, host, con):
+        with self.lock:
+            self.idle.setdefault(host, []).append(con)
+
+    def _exchange(self, host, con, path):
+        """Send a GET request over con and return the response."""
+        try:
+            con.request('GET', path)
+            response = con.getresponse()
+            body = response.read()
+        except (httplib.HTTPException, socket.error):
+            con.close()
+            raise
+        if response.will_close:
+            con.close()
+        else:
+            self._checkin(host, con)
+        return response.status, response.reason, body
+
+    def _request(self, host, path):
+        con, reused = self._checkout(host)
+        try:
+            return self._exchange(host, con, path)
+        except socket.timeout:
+            raise
+        except (httplib.HTTPException, socket.error):
+            if not reused:
+                raise
+        # The server may have dropped a connection that sat idle in the
+        # pool; try once more on a fresh one.
+        con = httplib.HTTPConnection(host, timeout=self.timeout)
+        return self._exchange(host, con, path)
+
+    def get(self, url):
+        """Return the body of the response to a GET request for url.
+
+        Parameters
+        ----------
+        url : string
+          Absolute http URL.
+
+        Returns
+        -------
+        string
+          Body of the response.
+
+        Notes
+        -----
+        Errors are raised as they are by urllib2.urlopen: socket.timeout
+        when the server takes too long, urllib2.HTTPError for a status
+        other than 200, and urllib2.URLError for any other failure.
+        """
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        slot = self._slot(parts.netloc)
+        slot.acquire()
+        try:
+            status, reason, body = self._request(parts.netloc, path)
+        except socket.timeout:
+            raise
+        except (httplib.HTTPException, socket.error), e:
+            raise urllib2.URLError(e)
+        finally:
+            slot.release()
+        if status != 200:
+            raise urllib2.HTTPError(url, status, reason, None, None)
+        return body
+
+    def close(self):
+        """Close all idle connections."""
+        with self.lock:
+            for connections in self.idle.itervalues():
+                for con in connections:
+                    con.close()
+            self.idle = {}
+
+
+# Shared by query.query_cocomac and query_by_area.query_cocomac_one_area.
+DEFAULT_CLIENT = CoCoMacClient()
@@ -1,17 +1,90 @@
 import re
 import copy
+import heapq
 import itertools
 
+from multiprocessing import Pool
+
 import networkx as nx
 import numpy as np
 
 from congraph import ConGraph
+from rc import BITS, COMPOSITION, CONVERSE, I, RCS, compose, decode
+
+
+# COMPOSITION as nested lists, which are faster to index one RC at a
+# time.
+_STEPS = COMPOSITION.tolist()
+
+
+def _single_rcs():
+    """Return the RC deduced from each pair of RCs, if there is one.
+
+    Also return, for each RC, the RCs it can be followed by and preceded
+    by in a TP.
+    """
+    masks = np.array([BITS[rc] for rc in RCS])
+    table = compose(masks[:, np.newaxis], masks)
+    composed = {}
+    for i, a in enumerate(RCS):
+        for j, b in enumerate(RCS):
+            rc = decode(table[i, j])
+            if rc and len(rc) == 1:
+                composed[a, b] = rc
+    after = dict((a, [b for b in RCS if composed.has_key((a, b))])
+                 for a in RCS)
+    before = dict((b, [a for a in RCS if composed.has_key((a, b))])
+                  for b in RCS)
+    return composed, after, before
+
+_COMPOSED, _AFTER, _BEFORE = _single_rcs()
 
 
 class MapGraphError(Exception):
     pass
 
 
+def _cut_identity_loops(nodes, chains):
+    """Return nodes without the parts that go out and back along chains.
+
+    Used in deducing edges with identical nodes collapsed (see
+    MapGraph._collapse_identities).  Wherever a node appears twice in
+    nodes, the nodes from its first appearance up to its second are left
+    out, provided they are all in its class of identical nodes: the edges
+    between them then all have RC 'I', so the RC of the path is
+    unchanged.
+
+    Parameters
+    ----------
+    nodes : tuple
+      Path of nodes in a MapGraph.
+
+    chains : dictionary
+      See MapGraph._identity_classes.
+
+    Returns
+    -------
+    nodes : tuple
+      The path with the loops cut, or None if a node appears twice with
+      nodes outside its class in between.
+    """
+    path = []
+    positions = {}
+    for node in nodes:
+        if positions.has_key(node):
+            start = positions[node]
+            representative = chains.get(node, (None,))[-1]
+            for loop_node in path[start + 1:]:
+                if chains.get(loop_node, (None,))[-1] != representative:
+                    return
+                del positions[loop_node]
+            del path[start + 1:]
+        else:
+            positions[node] = len(path)
+            path.append(node)
+    return tuple(path)
+
+
 class MapGraph(nx.DiGraph):
 
     """Subclass of the NetworkX DiGraph designed to hold CoCoMac Mapping data.
@@ -27,16 +100,17 @@ class MapGraph(nx.DiGraph):
     'S' (smaller than), 'L' (larger than), or 'O' (overlaps with).  These
     values complete the sentence, The source node is _____ the target node.
 
-    (2) TP (transformation path).  This is a list of regions representing
+    (2) TP (transformation path).  This is a tuple of regions representing
     the chain of relationships (the path within the graph) that mediates
     the relationship between the source and the target.  When the
     relationship between the source and the target has been pulled directly
-    from the literature, TP is an empty list.  When source's relationship
+    from the literature, TP is an empty tuple.  When source's relationship
     to target is known because of source's relationship to region X and
-    region X's relationship to target, TP is ['X'].  The list grows with
+    region X's relationship to target, TP is ('X',).  The tuple grows with
     the number of intervening nodes.  Of note, the TP for the edge from
     target to source must be the reverse of the TP for the edge from
-    source to target.
+    source to target.  Equal TPs are shared among edges rather than
+    copied.
 
     (3) PDC (precision description code).  An integer (from zero to 18,
     with zero being the best) corresponding to an index in the PDC
@@ -80,6 +154,172 @@ class MapGraph(nx.DiGraph):
 
     def __init__(self):
         nx.DiGraph.__init__.im_func(self)
+        self._build_map_index()
+        self._build_tp_index()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # MapGraphs pickled before the indices were introduced lack
+        # them.
+        if not state.has_key('_map_neighbors'):
+            self._build_map_index()
+        if not state.has_key('_tp_uses'):
+            self._build_tp_index()
+
+#------------------------------------------------------------------------------
+# Methods for Indexing Nodes by BrainMap
+#------------------------------------------------------------------------------
+
+    def _build_map_index(self):
+        """Index the nodes in the graph by BrainMap from scratch.
+
+        Three dictionaries are kept up to date as nodes and edges are added
+        and removed: _node_map maps each node to its BrainMap, _map_nodes
+        maps each BrainMap to the set of its nodes, and _map_neighbors maps
+        each node to a dictionary mapping BrainMaps to the node's neighbors
+        in them.  Only BrainMaps with at least one node (or neighbor) are
+        keys.
+        """
+        self._node_map = {}
+        self._map_nodes = {}
+        self._map_neighbors = {}
+        for node in self.nodes_iter():
+            self._index_node(node)
+        for source, target in self.edges_iter():
+            self._index_edge(source, target)
+
+    def _map_of(self, node):
+        """Return the BrainMap of node."""
+        try:
+            return self._node_map[node]
+        except KeyError:
+            return node.split('-')[0]
+
+    def _index_node(self, node):
+        """Add node to the BrainMap index."""
+        if not self._node_map.has_key(node):
+            brain_map = node.split('-')[0]
+            self._node_map[node] = brain_map
+            self._map_nodes.setdefault(brain_map, set()).add(node)
+            self._map_neighbors[node] = {}
+
+    def _unindex_node(self, node):
+        """Remove node from the BrainMap index, along with its edges."""
+        for neighbors in self._map_neighbors.pop(node, {}).itervalues():
+            for neighbor in neighbors:
+                self._discard_neighbor(neighbor, node)
+        brain_map = self._node_map.pop(node, None)
+        nodes = self._map_nodes.get(brain_map)
+        if nodes is not None:
+            nodes.discard(node)
+            if not nodes:
+                del self._map_nodes[brain_map]
+
+    def _index_edge(self, source, target):
+        """Record source and target as neighbors of each other."""
+        self._index_node(source)
+        self._index_node(target)
+        self._map_neighbors[source].setdefault(self._node_map[target],
+                                               set()).add(target)
+        self._map_neighbors[target].setdefault(self._node_map[source],
+                                               set()).add(source)
+
+    def _unindex_edge(self, source, target):
+        """Forget that source and target are neighbors."""
+        self._discard_neighbor(source, target)
+        self._discard_neighbor(target, source)
+
+    def _discard_neighbor(self, node, neighbor):
+        by_map = self._map_neighbors.get(node)
+        if by_map is None:
+            return
+        brain_map = self._map_of(neighbor)
+        neighbors = by_map.get(brain_map)
+        if neighbors is not None:
+            neighbors.discard(neighbor)
+            if not neighbors:
+                del by_map[brain_map]
+
+    def _neighbors_outside_map(self, node):
+        """Return the neighbors of node from BrainMaps other than its own.
+
+        Neighbors are returned in the order of self.neighbors(node), so
+        that ties elsewhere are broken as they were before the index.
+        """
+        own_map = self._map_of(node)
+        if not self._map_neighbors.get(node, {}).has_key(own_map):
+            return self.neighbors(node)
+        return [neighbor for neighbor in self.succ[node] if
+                self._map_of(neighbor) != own_map]
+
+#------------------------------------------------------------------------------
+# Methods for Indexing Transformation Paths
+#------------------------------------------------------------------------------
+
+    def _build_tp_index(self):
+        """Index the edges in the graph by their TPs from scratch.
+
+        Two dictionaries are kept up to date as edges are added, changed,
+        and removed: _tp_by_node maps each node to the edges with that
+        node in their TP, and _tp_by_pair maps each pair of nodes (see
+        _tp_pair) to the edges with those nodes next to each other in
+        their TP.  These are the edges that must go when the node or the
+        edges between the pair are removed.
+
+        TPs are also interned in _tps, which maps each TP to itself, so
+        that edges with equal TPs share one tuple.  _tp_uses maps each TP
+        in _tps to the number of edges with it, and a TP is dropped from
+        both when the last of these edges is removed or changed.
+        """
+        self._tp_by_node = {}
+        self._tp_by_pair = {}
+        self._tps = {}
+        self._tp_uses = {}
+        for source, target, attributes in self.edges_iter(data=True):
+            attributes['TP'] = self._intern_tp(attributes['TP'])
+            self._register_tp(source, target, attributes['TP'])
+
+    def _intern_tp(self, tp):
+        """Return the tuple of the nodes in tp shared by all edges."""
+        tp = tuple(tp)
+        return self._tps.setdefault(tp, tp)
+
+    def _tp_pair(self, node, next_node):
+        """Return the key for node and next_node in _tp_by_pair."""
+        if node < next_node:
+            return node, next_node
+        return next_node, node
+
+    def _register_tp(self, source, target, tp):
+        """Record that the edge from source to target depends on tp."""
+        edge = (source, target)
+        self._tp_uses[tp] = self._tp_uses.get(tp, 0) + 1
+        for node in tp:
+            self._tp_by_node.setdefault(node, set()).add(edge)
+        for node, next_node in zip(tp, tp[1:]):
+            self._tp_by_pair.setdefault(self._tp_pair(node, next_node),
+                                        set()).add(edge)
+
+    def _unregister_tp(self, source, target):
+        """Forget what the edge from source to target depends on.
+
+        Must be called while the edge is still in the graph.
+        """
+        edge = (source, target)
+        tp = self[source][target]['TP']
+        uses = self._tp_uses.pop(tp, 1) - 1
+        if uses:
+            self._tp_uses[tp] = uses
+        else:
+            self._tps.pop(tp, None)
+        for key, index in ([(node, self._tp_by_node) for node in tp] +
+                           [(self._tp_pair(node, next_node), self._tp_by_pair)
+                            for node, next_node in zip(tp, tp[1:])]):
+            edges = index.get(key)
+            if edges is not None:
+                edges.discard(edge)
+                if not edges:
+                    del index[key]
 
 #------------------------------------------------------------------------------
 # Methods for Eliminating Post-Deduction Contradictions
@@ -218,27 +458,69 @@ class MapGraph(nx.DiGraph):
           Maps BrainMaps of node's neighbors to the neighbors themselves.
         """
         neighbors_by_map = {}
-        for neighbor in self.neighbors(node):
-            brain_map = neighbor.split('-')[0]
+        for neighbor in self.succ[node]:
+            brain_map = self._map_of(neighbor)
             if not neighbors_by_map.has_key(brain_map):
                 neighbors_by_map[brain_map] = [neighbor]
             else:
                 neighbors_by_map[brain_map].append(neighbor)
         return neighbors_by_map
 
-    def _eliminate_contradictions(self):
+    def _eliminate_contradictions(self, nodes=None):
         """Remove edges that imply overlap of regions in the same BrainMap.
 
         It is assumed overlap does not genuinely exist, but has resulted
         from one or more errors in the original literature.
+
+        Parameters
+        ----------
+        nodes : iterable (optional)
+          Nodes whose edges are to be checked.  By default, those of all
+          nodes in the graph are.
+
+        Returns
+        -------
+        removed : integer
+          Number of edges removed, along with those deduced from them
+          (each counted once with its reverse).
+
+        Notes
+        -----
+        Nodes, BrainMaps, and neighbors are taken in sorted order.  They
+        used to be taken in the order of nodes_iter and of the BrainMap
+        index, which depends on the order in which edges were added.
+        Resolving one contradiction can remove edges that another
+        involved, so where there are several, the edges kept may differ
+        from those kept then.
         """
-        for node in self.nodes_iter():
+        if nodes is None:
+            nodes = self.nodes_iter()
+        count = self.number_of_edges()
+        # Nodes, BrainMaps, and neighbors are taken in order, so that
+        # the edges kept do not depend on the order in which they were
+        # added.
+        for node in sorted(nodes):
+            if not self.has_node(node):
+                continue
+            # Most nodes have at most one neighbor in each BrainMap, which
+            # the index tells us without looking at the neighbors.
+            for neighbors in self._map_neighbors[node].itervalues():
+                if len(neighbors) > 1:
+                    break
+            else:
+                continue
             neighbors_by_map = self._organize_neighbors_by_map(node)
-            for brain_map, neighbors in neighbors_by_map.iteritems():
+            for brain_map in sorted(neighbors_by_map):
+                # Resolving an earlier contradiction may have removed
+                # edges to some of the neighbors, along with the edges
+                # they supported.
+                neighbors = sorted(n for n in neighbors_by_map[brain_map]
+                                   if self.succ[node].has_key(n))
                 if len(neighbors) > 1:
                     neighbors_by_rc = self._organize_by_rc(node, neighbors)
                     if neighbors_by_rc['IS']:
                         self._resolve_contradiction(node, neighbors_by_rc)
+        return (count - self.number_of_edges()) / 2
 
 #------------------------------------------------------------------------------
 # Methods for Removing Nodes
@@ -337,12 +619,13 @@ class MapGraph(nx.DiGraph):
         is not in the graph to begin with, this method does not.
         """
         if self.has_node(node):
+            for neighbor in self.successors_iter(node):
+                self._unregister_tp(node, neighbor)
+            for neighbor in self.predecessors_iter(node):
+                self._unregister_tp(neighbor, node)
             nx.DiGraph.remove_node.im_func(self, node)
-            edges_to_remove = []
-            for source, target in self.edges_iter():
-                if node in self[source][target]['TP']:
-                    edges_to_remove.append((source, target))
-            self.remove_edges_from(edges_to_remove)
+            self._unindex_node(node)
+            self.remove_edges_from(list(self._tp_by_node.pop(node, ())))
 
     def remove_nodes_from(self, nodes):
         """Remove nodes from the graph.
@@ -379,8 +662,7 @@ class MapGraph(nx.DiGraph):
         smaller : list
           List of nodes from the same map as larger.
         """
-        extra_neighbors = [n for n in self.neighbors(larger) if n.split('-')[0]
-                           != larger.split('-')[0]]
+        extra_neighbors = self._neighbors_outside_map(larger)
         try:
             successors = self.cong.successors(larger)
             predecessors = self.cong.predecessors(larger)
@@ -427,7 +709,6 @@ class MapGraph(nx.DiGraph):
         larger : string
           A single node from the same map as smaller.
         """
-        current_map = larger.split('-')[0]
         for small_node in smaller:
             # Transfer relations.
             try:
@@ -435,9 +716,7 @@ class MapGraph(nx.DiGraph):
             except KeyError:
                 raise KeyError('Graph is missing edges between %s and %s.' %
                                (small_node, larger))
-            extra_neighbors = [n for n in self.neighbors(small_node) if
-                               n.split('-')[0] != current_map]
-            for neighbor in extra_neighbors:
+            for neighbor in self._neighbors_outside_map(small_node):
                 extra_pdc = self[small_node][neighbor]['PDC']
                 extra_rc = self[small_node][neighbor]['RC']
                 if extra_rc in ('I', 'L'):
@@ -464,7 +743,6 @@ class MapGraph(nx.DiGraph):
 
         All nodes in node_list are from the same map.
         """
-        same_map = node_list[0].split('-')[0]
         n_connections = 0
         for node in node_list:
             try:
@@ -472,9 +750,8 @@ class MapGraph(nx.DiGraph):
                 n_connections += len(self.cong.successors(node))
             except nx.NetworkXError:
                 pass
-            for neighbor in self.neighbors(node):
-                if (neighbor.split('-')[0] != same_map and
-                    self[node][neighbor]['RC'] == 'I'):
+            for neighbor in self._neighbors_outside_map(node):
+                if self[node][neighbor]['RC'] == 'I':
                     try:
                         n_connections += len(self.cong.predecessors(neighbor))
                         n_connections += len(self.cong.successors(neighbor))
@@ -552,7 +829,7 @@ class MapGraph(nx.DiGraph):
             larger_connections = self._summate_connections([larger_node])
             smaller_connections = self._summate_connections(smaller_nodes)
             # Remove the level with fewer connections from the graph.
-            current_map = larger_node.split('-')[0]
+            current_map = self._map_of(larger_node)
             if (larger_connections == smaller_connections and current_map ==
                 target_map) or larger_connections > smaller_connections:
                 # If there are more connections for the higher level,
@@ -599,11 +876,9 @@ class MapGraph(nx.DiGraph):
         # In this graph, we don't need to look up predecessors and
         # successors separately, because the methods for adding edges
         # ensure that when an edge is added, its reciprocal is also added.
-        neighbors = self.neighbors(loser)
-        for n in neighbors:
-            if n.split('-')[0] != keeper.split('-')[0]:
-                self.add_edge(keeper, n, rc=self[loser][n]['RC'],
-                              pdc=self[loser][n]['PDC'])
+        for n in self._neighbors_outside_map(loser):
+            self.add_edge(keeper, n, rc=self[loser][n]['RC'],
+                          pdc=self[loser][n]['PDC'])
         self.remove_node(loser)
         # Give loser's conn edges to keeper, and remove loser from conn.
         try:
@@ -749,7 +1024,7 @@ its own map.""" % node_x)
         """
         hierarchies = {}
         for node in intramap_nodes:
-            brain_map = node.split('-')[0]
+            brain_map = self._map_of(node)
             if not hierarchies.has_key(brain_map):
                 hierarchies[brain_map] = {}
             hierarchy = hierarchies[brain_map]
@@ -780,7 +1055,7 @@ its own map.""" % node_x)
           Index in the PDC hierarchy (cocotools.query.PDC_HIER); lower is
           better.
 
-        tp : list
+        tp : sequence
           Nodes in path between source and target on the basis of which
           this edge has been deduced.
 
@@ -826,20 +1101,25 @@ its own map.""" % node_x)
           Index in the PDC hierarchy (cocotools.query.PDC_HIER); lower is
           better.
 
-        tp : list
+        tp : sequence
           Nodes in path between source and target on the basis of which
           this edge has been deduced.
         """
+        if self.has_edge(source, target):
+            self._unregister_tp(source, target)
+            self._unregister_tp(target, source)
+        # TPs are immutable, so the graph need not copy them to keep
+        # them from being changed by whoever supplied them.
+        tp = self._intern_tp(tp)
         nx.DiGraph.add_edge.im_func(self, source, target, RC=rc, PDC=pdc,
                                     TP=tp)
         reverse_rc = {'I': 'I', 'S': 'L', 'L': 'S', 'O': 'O'}
-        # A deepcopy of the original TP must be used to make the
-        # reversed one, so that the original one is not itself
-        # reversed.
-        reversed_tp = copy.deepcopy(tp)
-        reversed_tp.reverse()
+        reversed_tp = self._intern_tp(tp[::-1])
         nx.DiGraph.add_edge.im_func(self, target, source, RC=reverse_rc[rc],
                                     PDC=pdc, TP=reversed_tp)
+        self._index_edge(source, target)
+        self._register_tp(source, target, tp)
+        self._register_tp(target, source, reversed_tp)
 
     def _add_valid_edge(self, source, target, rc, pdc, tp):
         """Incorporate supplied valid edge data into graph.
@@ -863,7 +1143,7 @@ its own map.""" % node_x)
           Index in the PDC hierarchy (cocotools.query.PDC_HIER); lower is
           better.
 
-        tp : list
+        tp : sequence
           Nodes in path between source and target on the basis of which
           this edge has been deduced.
 
@@ -889,7 +1169,7 @@ its own map.""" % node_x)
         source : string
           A node in the graph.
 
-        tp : list
+        tp : sequence
           TP that mediates relationship between source and target.
 
         target : string
@@ -925,20 +1205,15 @@ its own map.""" % node_x)
         deduced_rc : string
           RC corresponding to the relationship between the two nodes.
         """
-        map_step = {'I': {'I': 'I', 'S': 'S', 'L': 'L', 'O': 'O'},
-                    'S': {'I': 'S', 'S': 'S'},
-                    'L': {'I': 'L', 'S': 'ISLO', 'L': 'L', 'O': 'LO'},
-                    'O': {'I': 'O', 'S': 'SO'},
-                    'SO': {'I': 'SO', 'S': 'SO'},
-                    'LO': {'I': 'LO', 'S': 'ISLO'},
-                    'ISLO': {'I': 'ISLO', 'S': 'ISLO'}}
-        deduced_rc = 'I'
+        steps = _STEPS
+        deduced_rc = I
         for rc in rc_chain:
             try:
-                deduced_rc = map_step[deduced_rc][rc]
+                deduced_rc = steps[deduced_rc][BITS[rc]]
             except KeyError:
                 return
-        if len(deduced_rc) == 1:
+        deduced_rc = decode(deduced_rc)
+        if deduced_rc and len(deduced_rc) == 1:
             return deduced_rc
 
     def _get_rc_chain(self, source, tp, target):
@@ -949,7 +1224,7 @@ its own map.""" % node_x)
         source : string
           A node in the graph.
 
-        tp : list
+        tp : sequence
           TP that mediates relationship between source and target.
 
         target : string
@@ -960,10 +1235,9 @@ its own map.""" % node_x)
         rc_chain : string
           Concatenated RCs for edges from source to target through tp.
         """
-        middle = ''
-        for i in range(len(tp) - 1):
-            middle += self[tp[i]][tp[i + 1]]['RC']
-        return self[source][tp[0]]['RC'] + middle + self[tp[-1]][target]['RC']
+        nodes = [source] + list(tp) + [target]
+        return ''.join([self[nodes[i]][nodes[i + 1]]['RC']
+                        for i in range(len(nodes) - 1)])
 
     def _check_nodes(self, nodes):
         """Raise an exception if any node in nodes is not in CoCoMac format.
@@ -984,7 +1258,7 @@ its own map.""" % node_x)
         source : string
           A node in the graph.
 
-        tp : list
+        tp : sequence
           Transformation path from source to target.
 
         target : string
@@ -994,15 +1268,606 @@ its own map.""" % node_x)
         -------
         True or False : boolean
         """
-        map_list = []
-        nodes = tp + [source, target]
-        for n in nodes:
-            brain_map = n.split('-')[0]
-            if brain_map in map_list:
+        maps = set()
+        for n in itertools.chain(tp, (source, target)):
+            brain_map = self._map_of(n)
+            if brain_map in maps:
                 return False
-            map_list.append(brain_map)
+            maps.add(brain_map)
         return True
 
+#------------------------------------------------------------------------------
+# Methods for Deducing Edges
+#------------------------------------------------------------------------------
+
+    def _compose_edges(self, p, node, s, rc, report, found):
+        """Deduce the edge from p to s via node, if it is an improvement.
+
+        Used by deduce_edges.  The new edge is not added to the graph
+        here, but kept in found until the end of the round.
+
+        Parameters
+        ----------
+        p, node, s : strings
+          Nodes in the graph, with edges from p to node and node to s.
+
+        rc : string
+          RC deduced from the RCs of the edges from p to node and node to
+          s, which is the one composing the RCs along their TPs gives.
+
+        report : dictionary
+          Counts kept by deduce_edges.
+
+        found : dictionary
+          Maps each pair of nodes, as returned by _tp_pair, to the TP
+          length, PDC, TP from the first node of the pair to the second,
+          source, target, RC, and TP of the best edge between them deduced
+          so far in this round.  Between edges with TPs of the same length
+          and the same PDC, the one with the TP that sorts first is best,
+          so that which is found first does not matter.
+        """
+        if p == s:
+            return
+        report['candidates'] += 1
+        first = self.succ[p][node]
+        second = self.succ[node][s]
+        tp_length = self._joined_length(first['TP'], node, second['TP'])
+        # The PDC of the new edge is the worse of theirs.
+        pdc = max(first['PDC'], second['PDC'])
+        # Check whether the new edge would be better before building its
+        # TP.
+        pair = self._tp_pair(p, s)
+        if pair in found:
+            old_length, old_pdc = found[pair][:2]
+            # Ties are broken below.
+            tie = pdc > old_pdc
+        elif s in self.succ[p]:
+            old = self.succ[p][s]
+            old_length, old_pdc = len(old['TP']), old['PDC']
+            tie = pdc >= old_pdc
+        else:
+            old_length = None
+        if old_length is not None and (tp_length > old_length or
+                                       (tp_length == old_length and tie)):
+            return
+        tp = self._join_tps(first['TP'], node, second['TP'])
+        if not self._from_different_maps(p, tp, s):
+            return
+        if p == pair[0]:
+            pair_tp = tp
+        else:
+            pair_tp = tp[::-1]
+        if pair in found and (tp_length, pdc, pair_tp) >= found[pair][:3]:
+            return
+        found[pair] = (tp_length, pdc, pair_tp, p, s, rc, tp)
+
+    def _join_tps(self, first_tp, node, second_tp):
+        """Return the TP through node made of first_tp and second_tp.
+
+        Used by _compose_edges.  first_tp is the TP of an edge to node and
+        second_tp that of an edge from node.
+        """
+        return first_tp + (node,) + second_tp
+
+    def _joined_length(self, first_tp, node, second_tp):
+        """Return the length of the TP _join_tps would return."""
+        return len(first_tp) + len(second_tp) + 1
+
+    def _neighbors_by_rc(self, adjacency, node, cache):
+        """Return a dictionary mapping RCs to neighbors of node.
+
+        Used by _deduce_to_fixpoint, which groups only the neighbors of
+        the nodes it composes edges at, so that a round with a short
+        worklist does not have to look at the whole graph.
+
+        Parameters
+        ----------
+        adjacency : dictionary
+          self.succ, to group the nodes node has edges to by the RCs of
+          these edges, or self.pred, to group those with edges to node.
+
+        node : string
+          A node in the graph.
+
+        cache : dictionary
+          Maps nodes to the dictionaries already returned for them with
+          this adjacency.
+        """
+        if not cache.has_key(node):
+            neighbors_by_rc = cache[node] = {}
+            for neighbor, attributes in adjacency[node].iteritems():
+                neighbors_by_rc.setdefault(attributes['RC'],
+                                           []).append(neighbor)
+        return cache[node]
+
+    def _deduce_to_fixpoint(self, worklist=None, changed=None):
+        """Add the edges deduced in rounds by deduce_edges.
+
+        Contradictions are not eliminated.
+
+        Parameters
+        ----------
+        worklist : list (optional)
+          Pairs of nodes, as returned by _tp_pair, with the edges to be
+          composed with their neighbors in the first round.  By default,
+          every edge in the graph is.
+
+        changed : set (optional)
+          Set to which the pairs of nodes with edges added or improved
+          are added.
+
+        Returns
+        -------
+        report : dictionary
+          See deduce_edges.
+        """
+        report = {'rounds': 0, 'candidates': 0, 'added': 0, 'improved': 0}
+        composed, after, before = _COMPOSED, _AFTER, _BEFORE
+        # Each edge is represented in the worklist by itself or its
+        # reverse, whichever _tp_pair returns.
+        if worklist is None:
+            worklist = [(source, target)
+                        for source, target in self.edges_iter()
+                        if (source, target) == self._tp_pair(source, target)]
+        while worklist:
+            report['rounds'] += 1
+            found = {}
+            succ_by_rc = {}
+            pred_by_rc = {}
+            # Edges in the worklist that have been composed with all the
+            # edges next to them, and so need not be composed again with
+            # those later in the worklist.
+            done = set()
+            for source, target in worklist:
+                rc = self.succ[source][target]['RC']
+                successors = self._neighbors_by_rc(self.succ, target,
+                                                   succ_by_rc)
+                predecessors = self._neighbors_by_rc(self.pred, source,
+                                                     pred_by_rc)
+                for next_rc in after[rc]:
+                    for s in successors.get(next_rc, ()):
+                        if self._tp_pair(target, s) not in done:
+                            self._compose_edges(source, target, s,
+                                                composed[rc, next_rc],
+                                                report, found)
+                for previous_rc in before[rc]:
+                    for p in predecessors.get(previous_rc, ()):
+                        if self._tp_pair(p, source) not in done:
+                            self._compose_edges(p, source, target,
+                                                composed[previous_rc, rc],
+                                                report, found)
+                done.add((source, target))
+            # The graph is left unchanged until the end of the round, so
+            # that each edge is added or improved at most once per round.
+            worklist = sorted(found)
+            for pair in worklist:
+                p, s, rc, tp = found[pair][3:]
+                pdc = found[pair][1]
+                if self.has_edge(p, s):
+                    report['improved'] += 1
+                else:
+                    report['added'] += 1
+                self._add_edge_and_its_reverse(p, s, rc, pdc, tp)
+            if changed is not None:
+                changed.update(worklist)
+        return report
+
+    def _push_candidate(self, p, node, s, heap, best, committed, report):
+        """Push the edge from p to s via node onto heap if it may be best.
+
+        Used by _deduce_best_first.  The edge is left out if an edge
+        between p and s has been committed already, if its RC cannot be
+        resolved, or if it is no better than the edge already in the
+        graph or than the best pushed before.
+
+        Parameters
+        ----------
+        p, node, s : strings
+          Nodes in the graph, with committed edges from p to node and node
+          to s.
+
+        heap : list
+          Heap of the TP length, PDC, TP from the first node of the pair
+          (see _tp_pair) to the second, source, target, RC, and TP of
+          edges.
+
+        best : dictionary
+          Maps pairs to the TP length, PDC, and TP of the best edge
+          between them pushed so far.
+
+        committed : set
+          Pairs whose edges are final.
+
+        report : dictionary
+          Counts kept by _deduce_best_first.
+        """
+        if p == s:
+            return
+        pair = self._tp_pair(p, s)
+        if pair in committed:
+            return
+        first = self.succ[p][node]
+        second = self.succ[node][s]
+        rc = _COMPOSED.get((first['RC'], second['RC']))
+        if not rc:
+            return
+        report['candidates'] += 1
+        tp_length = self._joined_length(first['TP'], node, second['TP'])
+        pdc = max(first['PDC'], second['PDC'])
+        if pair in best and (tp_length, pdc) > best[pair][:2]:
+            return
+        if s in self.succ[p]:
+            old = self.succ[p][s]
+            if (tp_length, pdc) >= (len(old['TP']), old['PDC']):
+                return
+        tp = self._join_tps(first['TP'], node, second['TP'])
+        if not self._from_different_maps(p, tp, s):
+            return
+        if p == pair[0]:
+            pair_tp = tp
+        else:
+            pair_tp = tp[::-1]
+        key = (tp_length, pdc, pair_tp)
+        if pair in best:
+            if key >= best[pair]:
+                return
+            # Deducing edges as they are found, the edge would be
+            # rewritten here.
+            report['rewrites_avoided'] += 1
+        best[pair] = key
+        heapq.heappush(heap, key + (p, s, rc, tp))
+
+    def _deduce_best_first(self):
+        """Add the edges deduced by deduce_edges, each pair just once.
+
+        Edges are grown in order of TP length and then PDC, as paths are
+        in Dijkstra's algorithm.  Each edge in the graph, and each edge
+        deduced from two committed edges, is pushed onto a heap in that
+        order.  The first edge popped between a pair of nodes is
+        committed.  It is then composed with the committed edges next to
+        it.  An edge composed from two others has a longer TP than
+        either, so no edge found later can be better than one committed,
+        and each edge is written to the graph at most once.  Contradictions
+        are not eliminated.
+
+        Returns
+        -------
+        report : dictionary
+          Maps 'candidates' to the number of pairs of edges composed,
+          'added' and 'improved' to the numbers of edges added and
+          improved (each counted once with its reverse), and
+          'rewrites_avoided' to the number of times a better edge was
+          found between a pair after another had been (and so would have
+          been written over it, were edges added as they were found).
+        """
+        report = {'candidates': 0, 'added': 0, 'improved': 0,
+                  'rewrites_avoided': 0}
+        heap = []
+        for source, target, attributes in self.edges_iter(data=True):
+            if source < target:
+                heap.append((len(attributes['TP']), attributes['PDC'],
+                             attributes['TP'], source, target,
+                             attributes['RC'], attributes['TP']))
+        heapq.heapify(heap)
+        best = {}
+        committed = set()
+        converse = dict((rc, decode(CONVERSE[BITS[rc]])) for rc in RCS)
+        # Maps each node to a dictionary mapping RCs to the nodes it has
+        # committed edges with that RC to.
+        committed_by_rc = {}
+        while heap:
+            tp_length, pdc, pair_tp, p, s, rc, tp = heapq.heappop(heap)
+            pair = self._tp_pair(p, s)
+            if pair in committed:
+                continue
+            committed.add(pair)
+            if not self.has_edge(p, s):
+                report['added'] += 1
+                self._add_edge_and_its_reverse(p, s, rc, pdc, tp)
+            elif self.succ[p][s]['TP'] != tp:
+                report['improved'] += 1
+                self._add_edge_and_its_reverse(p, s, rc, pdc, tp)
+            s_by_rc = committed_by_rc.setdefault(s, {})
+            for next_rc in _AFTER[rc]:
+                for n in s_by_rc.get(next_rc, ()):
+                    self._push_candidate(p, s, n, heap, best, committed,
+                                         report)
+            p_by_rc = committed_by_rc.setdefault(p, {})
+            for previous_rc in _BEFORE[rc]:
+                # The edge from n to p has previous_rc if that from p to
+                # n has its converse.
+                for n in p_by_rc.get(converse[previous_rc], ()):
+                    self._push_candidate(n, p, s, heap, best, committed,
+                                         report)
+            p_by_rc.setdefault(rc, []).append(s)
+            s_by_rc.setdefault(converse[rc], []).append(p)
+        return report
+
+    def _deduce(self, collapse_identities, best_first):
+        """Add the edges deduced by deduce_edges.
+
+        Contradictions are not eliminated.
+
+        Parameters
+        ----------
+        collapse_identities, best_first : bool
+          See deduce_edges.
+
+        Returns
+        -------
+        report : dictionary
+          See deduce_edges.
+        """
+        graph = self
+        if collapse_identities:
+            graph, chains = self._collapse_identities()
+        if best_first:
+            report = graph._deduce_best_first()
+        else:
+            report = graph._deduce_to_fixpoint()
+        if collapse_identities:
+            report['collapsed'] = (self.number_of_nodes() -
+                                   graph.number_of_nodes())
+            expanded = self._expand_identities(graph, chains)
+            for key in ('candidates', 'added', 'improved'):
+                report[key] += expanded[key]
+        return report
+
+    def _deduce_components(self, collapse_identities, best_first,
+                           processes):
+        """Deduce edges in each weakly connected component in parallel.
+
+        Used by deduce_edges.  Deduction and the elimination of
+        contradictions never reach from one component into another, and
+        neither depends on the order in which edges were added, so each
+        component can be handled separately with the same result.  The
+        edges of the components are replaced with those returned by the
+        pool, in order.
+
+        Parameters
+        ----------
+        collapse_identities, best_first : bool
+          See deduce_edges.
+
+        processes : integer
+          Number of processes in the pool.
+
+        Returns
+        -------
+        report : dictionary
+          See deduce_edges; 'rounds' is the most run for any component,
+          and the other counts are summed over the components.
+        """
+        components = []
+        small_nodes = []
+        for nodes in nx.weakly_connected_components(self):
+            nodes = sorted(nodes)
+            # Nothing can be deduced from or contradict an edge
+            # between two nodes alone.
+            if len(nodes) > 2:
+                components.append((nodes, collapse_identities, best_first,
+                                   [(source, target, attributes) for
+                                    source, target, attributes
+                                    in self.edges_iter(nodes, data=True)]))
+            else:
+                small_nodes.extend(nodes)
+        # The smaller components are still deduced here, without a pool,
+        # so that the report counts them (a round, say, or an identity
+        # collapsed) as deducing the whole graph at once would.  Their
+        # edges are unchanged.
+        report = _deduce_component((small_nodes, collapse_identities,
+                                    best_first,
+                                    self.edges(small_nodes, data=True)))[0]
+        if not components:
+            return report
+        # The largest components are started first.
+        components.sort(key=lambda component: -len(component[3]))
+        pool = Pool(processes)
+        try:
+            results = pool.map(_deduce_component, components, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        for component, (component_report,
+                        edges) in sorted(zip(components, results)):
+            for key, count in component_report.iteritems():
+                if key == 'rounds':
+                    report[key] = max(report.get(key, 0), count)
+                else:
+                    report[key] = report.get(key, 0) + count
+            nodes = component[0]
+            self.remove_edges_from(self.edges(nodes))
+            for source, target, attributes in edges:
+                if source < target:
+                    self._add_edge_and_its_reverse(source, target,
+                                                   attributes['RC'],
+                                                   attributes['PDC'],
+                                                   attributes['TP'])
+        return report
+
+    def _identity_classes(self):
+        """Group the nodes joined by chains of 'I' edges.
+
+        The 'I' edges are taken in order of PDC, and each joins the
+        classes of its nodes (kept in a union-find forest) unless that
+        would put two nodes from the same BrainMap in one class.  The
+        edges that joined classes thus form, for each class, a tree
+        through which its nodes are related by the best PDCs possible.
+        The smallest node in each class represents it.
+
+        Returns
+        -------
+        chains : dictionary
+          Maps each node in a class of more than one node to the tuple of
+          nodes along the tree from it to the representative of its class
+          (both included).
+        """
+        parent = {}
+        maps = {}
+
+        def find(node):
+            root = node
+            while parent[root] != root:
+                root = parent[root]
+            while parent[node] != root:
+                parent[node], node = root, parent[node]
+            return root
+
+        for node in self.nodes_iter():
+            parent[node] = node
+            maps[node] = set([self._map_of(node)])
+        tree = {}
+        identities = sorted((attributes['PDC'], source, target)
+                            for source, target, attributes
+                            in self.edges_iter(data=True)
+                            if attributes['RC'] == 'I' and source < target)
+        for pdc, source, target in identities:
+            source_root, target_root = find(source), find(target)
+            if (source_root == target_root or
+                maps[source_root] & maps[target_root]):
+                continue
+            parent[target_root] = source_root
+            maps[source_root] |= maps.pop(target_root)
+            tree.setdefault(source, []).append(target)
+            tree.setdefault(target, []).append(source)
+        classes = {}
+        for node in tree:
+            classes.setdefault(find(node), []).append(node)
+        chains = {}
+        for members in classes.itervalues():
+            representative = min(members)
+            chains[representative] = (representative,)
+            stack = [representative]
+            while stack:
+                node = stack.pop()
+                for neighbor in tree[node]:
+                    if not chains.has_key(neighbor):
+                        chains[neighbor] = (neighbor,) + chains[node]
+                        stack.append(neighbor)
+        return chains
+
+    def _collapse_identities(self):
+        """Return a graph with each class of identical nodes made one.
+
+        Used by deduce_edges.  Each class of nodes found by
+        _identity_classes is represented by one node in the new graph.
+        Every edge between nodes of different classes becomes an edge
+        between their representatives with the same RC, its TP extended
+        by the chains of 'I' edges to them.  Where several edges are
+        collapsed into one, the best is kept.
+
+        Returns
+        -------
+        quotient : MapGraph
+          Graph of the representatives and the nodes in no class.
+
+        chains : dictionary
+          See _identity_classes.
+        """
+        chains = self._identity_classes()
+        quotient = _IdentityQuotient(chains)
+        for node in self.nodes_iter():
+            if not chains.has_key(node) or chains[node][-1] == node:
+                quotient.add_node(node)
+        # Edges are taken in order, so that which is kept of edges
+        # equally good does not depend on the order they were added.
+        for source, target in sorted(self.edges_iter()):
+            attributes = self[source][target]
+            source_chain = chains.get(source, (source,))
+            target_chain = chains.get(target, (target,))
+            if source_chain[-1] == target_chain[-1] or source > target:
+                continue
+            nodes = (source_chain[::-1] + attributes['TP'] + target_chain)
+            tp = nodes[1:-1]
+            if tp:
+                pdc = self._get_worst_pdc_in_tp(nodes[0], tp, nodes[-1])
+            else:
+                pdc = attributes['PDC']
+            quotient._add_valid_edge(nodes[0], nodes[-1], attributes['RC'],
+                                     pdc, tp)
+        return quotient, chains
+
+    def _expand_identities(self, quotient, chains):
+        """Add the edges implied by those deduced in quotient.
+
+        Used by deduce_edges.  Each edge between representatives in
+        quotient implies an edge with the same RC between every node in
+        the class of one and every node in the class of the other, its TP
+        extended by the chains of 'I' edges to them.  Nodes in the same
+        class are joined by edges with RC 'I' through their tree.
+
+        Paths through the tree and the representative may be longer than
+        others through the nodes of a class, so the edges of those nodes
+        are then composed with their neighbors until nothing is improved,
+        as in deduce_edges.
+
+        Parameters
+        ----------
+        quotient : MapGraph
+          Graph returned by _collapse_identities, after deduction.
+
+        chains : dictionary
+          See _identity_classes.
+
+        Returns
+        -------
+        report : dictionary
+          See _deduce_to_fixpoint; it covers the edges improved (or added)
+          after those implied by quotient.
+        """
+        members = {}
+        for node in sorted(chains):
+            members.setdefault(chains[node][-1], []).append(node)
+        # As in _collapse_identities, edges are taken in order.
+        for source, target in sorted(quotient.edges_iter()):
+            if source > target:
+                continue
+            attributes = quotient[source][target]
+            for x in members.get(source, [source]):
+                for y in members.get(target, [target]):
+                    nodes = _cut_identity_loops(chains.get(x, (x,)) +
+                                                attributes['TP'] +
+                                                chains.get(y, (y,))[::-1],
+                                                chains)
+                    if nodes:
+                        self._add_expanded_edge(nodes, attributes['RC'])
+        for representative in sorted(members):
+            nodes = members[representative]
+            for i, x in enumerate(nodes):
+                for y in nodes[i + 1:]:
+                    x_chain, y_chain = chains[x], chains[y]
+                    # Leave out the part of the chains they share, but
+                    # for the node where they meet.
+                    shared = 1
+                    while (shared < min(len(x_chain), len(y_chain)) and
+                           x_chain[-shared - 1] == y_chain[-shared - 1]):
+                        shared += 1
+                    self._add_expanded_edge(x_chain[:len(x_chain) -
+                                                    shared + 1] +
+                                            y_chain[:len(y_chain) -
+                                                    shared][::-1], 'I')
+        # Any path shorter than those through the trees passes through
+        # an edge of a node in a class.
+        return self._deduce_to_fixpoint(sorted(set(
+            self._tp_pair(node, neighbor) for node in chains
+            for neighbor in self.succ[node])))
+
+    def _add_expanded_edge(self, nodes, rc):
+        """Add the edge along a path found by _expand_identities.
+
+        The edge is from the first node to the last, with RC rc and the
+        rest of nodes as its TP.  It is not added if nodes are not all
+        from different BrainMaps, and replaces an edge already in the graph
+        only if it is better.
+        """
+        source, tp, target = nodes[0], nodes[1:-1], nodes[-1]
+        if source == target or not tp:
+            return
+        if not self._from_different_maps(source, tp, target):
+            return
+        pdc = self._get_worst_pdc_in_tp(source, tp, target)
+        self._add_valid_edge(source, target, rc, pdc, tp)
+
 #------------------------------------------------------------------------------
 # Core Public Methods
 #------------------------------------------------------------------------------
@@ -1021,27 +1886,19 @@ its own map.""" % node_x)
         target : string
           Another node in the graph.
         """
-        try:
-            nx.DiGraph.remove_edge.im_func(self, source, target)
-        except nx.NetworkXError:
-            # The edge isn't in the graph.
+        if not self.has_edge(source, target):
             return
-        # If (source, target) was in the graph, then we must
-        # remove its reciprocal, and then check whether it or its
-        # reciprocal mediates any other edges in the graph.
+        # If (source, target) is in the graph, then we must remove
+        # its reciprocal too, and then the edges that it or its
+        # reciprocal mediates, which are found in _tp_by_pair.
+        self._unregister_tp(source, target)
+        self._unregister_tp(target, source)
+        nx.DiGraph.remove_edge.im_func(self, source, target)
         nx.DiGraph.remove_edge.im_func(self, target, source)
-        edges_with_bad_tp = []
-        for s, t in self.edges_iter():
-            if (t, s) in edges_with_bad_tp:
-                # Reciprocals are taken care of automatically.
-                continue
-            tp = self[s][t]['TP']
-            for node, next_node in zip(tp, tp[1:]):
-                if set([node, next_node]) == set([source, target]):
-                    edges_with_bad_tp.append((s, t))
-                    # This edge is bad; we can move on to the next one.
-                    break
-        self.remove_edges_from(edges_with_bad_tp)
+        self._unindex_edge(source, target)
+        # Reciprocals are taken care of automatically.
+        self.remove_edges_from(list(self._tp_by_pair.pop(
+                    self._tp_pair(source, target), ())))
 
     def remove_edges_from(self, edges):
         """Remove edges from the graph, using self.remove_edge.
@@ -1077,7 +1934,7 @@ its own map.""" % node_x)
           Index in the PDC hierarchy (cocotools.query.PDC_HIER); lower is
           better.
 
-        tp : list (optional)
+        tp : sequence (optional)
           Nodes in path between source and target on the basis of which
           this edge has been deduced.
         """
@@ -1135,11 +1992,7 @@ its own map.""" % node_x)
         # these are defined based on physiological properties.  Before we can
         # use this paper, we need to read the papers cited within it that
         # guide its definitions.
-        bf95_nodes = []
-        for node in self.nodes_iter():
-            if node.split('-')[0] == 'BF95':
-                bf95_nodes.append(node)
-        self.remove_nodes_from(bf95_nodes)
+        self.remove_nodes_from(list(self._map_nodes.get('BF95', ())))
         # In both DU86 and UD86a, DMZ partially overlaps MTp and MST.  A
         # reasonable solution is to remove DMZ from our graph.
 
@@ -1720,9 +2573,9 @@ its own map.""" % node_x)
                          ('R00-PFCOM', 'PG91A-14A', {'RC': 'L', 'PDC': 1}),
                          ('R00-PFCOM', 'PG91A-14L', {'RC': 'L', 'PDC': 1}),
                          ('R00-PFCOM', 'PG91A-14M', {'RC': 'L', 'PDC': 1})]
-        maps = [node.split('-')[0] for node in self.nodes_iter()]
         for source, target, attr in missing_edges:
-            if source.split('-')[0] in maps or target.split('-')[0] in maps:
+            if (self._map_nodes.has_key(self._map_of(source)) or
+                self._map_nodes.has_key(self._map_of(target))):
                 self.add_edge(source, target, rc=attr['RC'], pdc=attr['PDC'])
 
     def keep_only_one_level_of_resolution(self, cong, target_map):
@@ -1748,7 +2601,7 @@ its own map.""" % node_x)
         self.cong = cong
         intramap_nodes = set()
         for source, target in self.edges_iter():
-            if source.split('-')[0] == target.split('-')[0]:
+            if self._node_map[source] == self._node_map[target]:
                 intramap_nodes.update([source, target])
         map_hierarchies = self._determine_hierarchies(intramap_nodes)
         for hierarchy in map_hierarchies.itervalues():
@@ -1757,22 +2610,147 @@ its own map.""" % node_x)
         del self.cong
         return cong
 
-    def deduce_edges(self):
+    def deduce_edges(self, collapse_identities=False, processes=1,
+                     best_first=False):
         """Deduce new edges based on those in the graph and add them.
 
         Intra-map edges are disallowed.  It is assumed that all regions
         in the graph from the same BrainMap are disjoint (i.e., at the same
         level of resolution).
+
+        Deduction proceeds in rounds.  In the first round, every edge is
+        composed with the edges before and after it; in each later round,
+        only the edges added or improved in the round before are.  This
+        continues until a round adds and improves nothing, so that no
+        pair of edges in the graph implies an edge better than the one
+        already there.  As with edges added otherwise, a shorter TP is
+        better, and then a smaller PDC (see _new_attributes_are_better).
+        Between edges deduced in the same round that tie on both, the one
+        whose TP sorts first is kept, and contradictions are then
+        eliminated in sorted order (see _eliminate_contradictions), so
+        that the result does not depend on the order in which edges were
+        added.
+
+        Earlier versions made a single pass over the nodes in the order
+        of nodes_iter, which missed edges implied by those it added late
+        in the pass.  Where the statements agree, the result is that of
+        repeating that pass until nothing changes.  Where they conflict,
+        the edges kept may differ from those kept before.
+
+        Parameters
+        ----------
+        collapse_identities : bool
+          If True, regions joined by chains of 'I' edges are first
+          collapsed into one (see _collapse_identities), deduction is run
+          on the smaller graph that results, and the edges deduced there
+          are expanded back to the regions collapsed.  Expanded edges whose
+          TPs could be shorter through other regions of a class are then
+          improved (see _expand_identities), so that, where the statements
+          agree with one another, the edges that result are the same as
+          without collapsing.  Where they conflict, the result may differ.
+          The improvement composes the edges of every region collapsed
+          again, so this is no faster than deducing without collapsing.
+
+        processes : integer
+          If more than one, the weakly connected components of the graph
+          are deduced, and have their contradictions eliminated, in a pool
+          of this many processes.  The edges that result are the same as
+          with one process.
+
+        best_first : bool
+          If True, edges are deduced in order of TP length and PDC instead
+          of in rounds, so that each is written once, with its final
+          attributes (see _deduce_best_first).  The graph that results is
+          at a fixpoint as well, but where the one best edge kept between
+          two nodes decides what else can be deduced, it may differ.
+
+        Returns
+        -------
+        report : dictionary
+          Maps 'rounds' to the number of rounds run, 'candidates' to the
+          number of pairs of edges composed, and 'added' and 'improved' to
+          the numbers of edges added and improved (each counted once with
+          its reverse), and 'removed' to the number then removed in
+          eliminating contradictions, along with those deduced from them.
+          With collapse_identities, 'collapsed' maps to the number of
+          nodes collapsed into others, 'rounds' counts those in the
+          smaller graph, and the other counts cover both the deduction
+          there and the improvement after expansion.  With best_first,
+          there are no rounds, and 'rewrites_avoided' maps to the number
+          of times edges would have been written over.
         """
-        for node in self.nodes_iter():
-            ebunch = []
-            for p in self.predecessors(node):
-                for s in self.successors(node):
-                    tp = self[p][node]['TP'] + [node] + self[node][s]['TP']
-                    if self._from_different_maps(p, tp, s):
-                        ebunch.append((p, s, {'TP': tp}))
-            self.add_edges_from(ebunch)
-        self._eliminate_contradictions()
+        if processes > 1:
+            return self._deduce_components(collapse_identities, best_first,
+                                           processes)
+        report = self._deduce(collapse_identities, best_first)
+        report['removed'] = self._eliminate_contradictions()
+        return report
+
+    def add_edges_incremental(self, edges):
+        """Add edges to a graph already deduced, and what follows from them.
+
+        The edges are added as by add_edges_from.  Only those that are
+        added or improve edges already in the graph are composed with
+        their neighbors, and so on until nothing more is added or
+        improved, as in deduce_edges.  Contradictions are then eliminated
+        only among the edges of the nodes whose edges have changed, as
+        the graph is assumed to have been free of them before.
+
+        Parameters
+        ----------
+        edges : list
+          (source, target, attributes) tuples, as for add_edges_from.
+
+        Returns
+        -------
+        report : dictionary
+          See deduce_edges.  'added' and 'improved' include the edges
+          supplied, and 'removed' counts only the edges of the nodes
+          whose edges have changed.
+
+        Notes
+        -----
+        The graph that results is at a fixpoint, as after deduce_edges.
+        If no edges have been removed in eliminating contradictions,
+        whether by deduce_edges or by this method, before or now, it has
+        the same edges, with the same RCs and PDCs, as deducing the whole
+        graph again; of two TPs as short and with the same PDC, it may
+        keep the one it had before.  Otherwise, the statements conflict,
+        and the edges kept can differ: an edge removed before is not put
+        back when new statements would now favor it, and resolving a
+        contradiction among the edges changed can go the other way once
+        the rest of the graph is deduced again.  When 'removed' is more
+        than zero here or in an earlier report, deduce the graph again
+        from all the statements to be sure of the result.
+        """
+        report = {'added': 0, 'improved': 0}
+        worklist = set()
+        for source, target, attributes in edges:
+            if self.has_edge(source, target):
+                old = self[source][target]
+                old = old['RC'], old['PDC'], old['TP']
+            else:
+                old = None
+            self.add_edges_from([(source, target, attributes)])
+            if not self.has_edge(source, target):
+                continue
+            new = self[source][target]
+            if old == (new['RC'], new['PDC'], new['TP']):
+                continue
+            pair = self._tp_pair(source, target)
+            if pair not in worklist:
+                if old is None:
+                    report['added'] += 1
+                else:
+                    report['improved'] += 1
+                worklist.add(pair)
+        changed = set(worklist)
+        deduced = self._deduce_to_fixpoint(sorted(worklist), changed)
+        for key in report:
+            deduced[key] += report[key]
+        deduced['removed'] = self._eliminate_contradictions(
+            set(itertools.chain(*changed)))
+        return deduced
 
 #------------------------------------------------------------------------------
 # Other Public Methods
@@ -1819,6 +2797,7 @@ its own map.""" % node_x)
         """
         self._check_nodes([node])
         nx.DiGraph.add_node.im_func(self, node)
+        self._index_node(node)
 
     def add_nodes_from(self, nodes):
         """Add nodes to the graph.
@@ -1843,3 +2822,67 @@ its own map.""" % node_x)
         """
         self._check_nodes(nodes)
         nx.DiGraph.add_nodes_from.im_func(self, nodes)
+        for node in nodes:
+            self._index_node(node)
+
+
+class _IdentityQuotient(MapGraph):
+
+    """MapGraph of nodes standing for classes of identical nodes.
+
+    Made by MapGraph._collapse_identities.  The TPs of its edges are
+    those of the edges in the original graph, through nodes that need not
+    be in this one.  An edge from or to a node representing a class
+    has in its TP the chain of 'I' edges from or to it, so that joining
+    two TPs at that node can go out along one chain and back along the
+    other.  These loops are cut.
+    """
+
+    def __init__(self, chains):
+        MapGraph.__init__.im_func(self)
+        self._chains = chains
+
+    def _join_tps(self, first_tp, node, second_tp):
+        """Return the TP through node made of first_tp and second_tp.
+
+        Where first_tp and second_tp retrace each other along a chain of
+        'I' edges, the loop is cut (see _cut_identity_loops).
+        """
+        tp = first_tp + (node,) + second_tp
+        return _cut_identity_loops(tp, self._chains) or tp
+
+    def _joined_length(self, first_tp, node, second_tp):
+        """Return the length of the TP _join_tps would return."""
+        return len(self._join_tps(first_tp, node, second_tp))
+
+
+def _deduce_component(component):
+    """Deduce edges for MapGraph._deduce_components in a worker process.
+
+    Parameters
+    ----------
+    component : tuple
+      The nodes of a weakly connected component of a MapGraph, the
+      collapse_identities and best_first arguments to deduce_edges, and
+      the edges of the component with their attributes.
+
+    Returns
+    -------
+    report : dictionary
+      See MapGraph.deduce_edges.
+
+    edges : list
+      The edges of the component, with their attributes, after deduction
+      and the elimination of contradictions.
+    """
+    nodes, collapse_identities, best_first, edges = component
+    mapg = MapGraph()
+    mapg.add_nodes_from(nodes)
+    for source, target, attributes in edges:
+        if source < target:
+            mapg._add_edge_and_its_reverse(source, target, attributes['RC'],
+                                           attributes['PDC'],
+                                           attributes['TP'])
+    report = mapg._deduce(collapse_identities, best_first)
+    report['removed'] = mapg._eliminate_contradictions()
+    return report, mapg.edges(data=True)
@@ -1,21 +1,42 @@
+import bz2
+import collections
 import copy
 import sqlite3
 import os
+import struct
 import errno
-import re
+import hashlib
+import marshal
+import threading
+import time
 import urllib
 import urllib2
 import xml.etree.ElementTree as etree
+import zlib
 from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 from socket import timeout
+from xml.etree.cElementTree import iterparse
 
-from brain_maps import MAPPING_SOURCES, CONNECTIVITY_SOURCES
+import client
+from brain_maps import (MAPPING_SOURCES, CONNECTIVITY_SOURCES,
+                        MAPPING_TIMEOUTS, CONNECTIVITY_TIMEOUTS, MAP_TO_AREAS,
+                        CON_TO_AREAS)
 
 
 PDC_HIER = ('A', 'C', 'H', 'L', 'D', 'F', 'J', 'N', 'B', 'G', 'E', 'K', 'I',
             'O', 'M', 'P', 'Q', 'R', None)
+# Increase whenever a change to _element2edge, _scrub_element,
+# _reduce_ecs, or _record_key alters the records produced from the same
+# XML, so that parsed ebunches cached by an earlier version are not
+# reused.
+PARSER_VERSION = 3
 DBPATH = os.path.join(os.path.expanduser('~'), '.cache', 'cocotools.sqlite')
 DBDIR = os.path.dirname(DBPATH)
+# Cache formerly kept by query_by_area; its entries are copied into the
+# main cache when that is upgraded to schema version 3.
+AREA_DBPATH = os.path.join(os.path.expanduser('~'), '.cache',
+                           'cocotools_area.sqlite')
 P = './/{http://www.cocomac.org}'
 SPECS = {'Mapping': {'data_set': 'PrimRel', 'primtag': 'PrimaryRelation',
                      'other_tags': ('RC', 'PDC')},
@@ -23,12 +44,408 @@ SPECS = {'Mapping': {'data_set': 'PrimRel', 'primtag': 'PrimaryRelation',
                           'primtag': 'IntegratedPrimaryProjection',
                           'other_tags': ('PDC_Site', 'EC', 'PDC_EC', 'Degree',
                                          'PDC_Density')}}
+# Areas queried one group at a time when a query for a whole BrainMap
+# times out.
+AREAS = {'Mapping': MAP_TO_AREAS, 'Connectivity': CON_TO_AREAS}
+# Budget for a query naming several areas of a BrainMap (see
+# _next_batch).  Some servers and proxies refuse long URLs, and long
+# responses are what make CoCoMac time out.
+MAX_URL_LENGTH = 2000
+MAX_RESPONSE_BYTES = 2 ** 21
+# Number of times a failed query for a BrainMap is repeated during an
+# ingest, and the delay in seconds before the first repeat; the delay
+# doubles for each one after that.
+RETRIES = 3
+BACKOFF = 2.0
+
+
+#------------------------------------------------------------------------------
+# Cache Storage
+#------------------------------------------------------------------------------
+
+# Codecs for XML stored in the caches, as (compress, decompress) pairs.
+# Add an entry here to make another codec available; names must not
+# contain a colon.
+CODECS = {'zlib': (lambda s: zlib.compress(s, 6), zlib.decompress),
+          'bz2': (bz2.compress, bz2.decompress),
+          'none': (str, str)}
+# Codec used for new cache entries.
+CODEC = 'zlib'
+
+
+def _pack_xml(xml, codec=None):
+    """Compress xml for storage in a cache.
+
+    The result is a BLOB holding the codec name, a colon, and the
+    compressed XML, so entries written with different codecs can share a
+    cache.
+
+    Parameters
+    ----------
+    xml : string
+      XML to store.
+
+    codec : string (optional)
+      Key in CODECS.  Default is CODEC.
+
+    Returns
+    -------
+    buffer
+      Value to store in the xml column.
+    """
+    if codec is None:
+        codec = CODEC
+    compress = CODECS[codec][0]
+    return sqlite3.Binary('%s:%s' % (codec, compress(xml)))
+
+
+def _unpack_xml(value):
+    """Return the XML stored as value by _pack_xml.
+
+    Caches written before compression was introduced hold XML as TEXT,
+    which is returned unchanged.
+    """
+    if isinstance(value, str):
+        return value
+    codec, payload = str(value).split(':', 1)
+    return CODECS[codec][1](payload)
+
+
+def _xml_hash(xml):
+    """Return the hash used to tell whether cached XML has changed."""
+    return hashlib.sha1(xml).hexdigest()
+
+
+def _recompress(con, lock, codec):
+    """Rewrite every entry in the cache behind con with codec.
+
+    Called by the recompress methods of the cache classes.  The rewrite
+    happens in one transaction; the file is then vacuumed to give the
+    freed pages back to the file system.
+
+    Returns
+    -------
+    sizes : tuple
+      Total bytes stored in the xml column before and after.
+    """
+    if codec is None:
+        codec = CODEC
+    with lock:
+        before = after = 0
+        updates = []
+        for rowid, value in con.execute('SELECT rowid, xml FROM cache'):
+            before += len(value)
+            packed = _pack_xml(_unpack_xml(value), codec)
+            after += len(packed)
+            updates.append((packed, rowid))
+        with con:
+            con.executemany("""
+UPDATE cache
+SET xml = ?
+WHERE rowid = ?
+""", updates)
+        con.execute('VACUUM')
+    return before, after
+
+#------------------------------------------------------------------------------
+# Cache Statistics
+#------------------------------------------------------------------------------
+
+# Upper bounds, in seconds, of the bins of the request latency histogram.
+# A last bin holds the requests that took longer.
+LATENCY_BINS = (0.01, 0.03, 0.1, 0.3, 1, 3, 10, 30, 100)
+
+
+class _QueryStats(object):
+
+    """Counters describing how queries were answered.
+
+    Lookups in the XML cache are counted as hits or misses; a miss whose
+    query produced no XML, because it failed or CoCoMac had nothing, is
+    also counted as negative.  Areas fetched for BrainMaps that timed out
+    and lookups in the ebunch cache are counted the same way.  Each
+    request made to CoCoMac adds its latency to a histogram (see
+    LATENCY_BINS) and the bytes received to a total.  The size of the XML
+    and the time taken to parse it are kept for each BrainMap or area
+    parsed.
+
+    The counters are shared by all threads and updated under a lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = collections.defaultdict(int)
+            self.latency = [0] * (len(LATENCY_BINS) + 1)
+            self.parses = {}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def record_request(self, seconds, size):
+        i = 0
+        while i < len(LATENCY_BINS) and seconds > LATENCY_BINS[i]:
+            i += 1
+        with self.lock:
+            self.counts['requests'] += 1
+            self.counts['bytes'] += size
+            self.latency[i] += 1
+
+    def record_parse(self, search_type, key, size, seconds, records):
+        with self.lock:
+            self.parses[(search_type, key)] = {'xml_bytes': size,
+                                               'parse_seconds': seconds,
+                                               'records': records}
+
+    def snapshot(self):
+        """Return a copy of the counters; see cache_stats."""
+        with self.lock:
+            result = dict((name, self.counts[name]) for name in
+                          ('hits', 'misses', 'negatives', 'area_hits',
+                           'area_misses', 'area_negatives', 'ebunch_hits',
+                           'ebunch_misses', 'requests', 'bytes'))
+            result['latency'] = zip(LATENCY_BINS + (None,), self.latency)
+            result['parses'] = copy.deepcopy(self.parses)
+        return result
+
+    def summary(self):
+        """Return the counters as text for people to read."""
+        s = self.snapshot()
+        lookups = s['hits'] + s['misses']
+        # BrainMaps and areas whose parsed ebunches are cached need no XML,
+        # so they do not appear in the XML counts.
+        lines = ['Parsed ebunches: %d from cache, %d parsed' %
+                 (s['ebunch_hits'], s['ebunch_misses']),
+                 'BrainMap XML: %d from cache, %d queried (%d without data); '
+                 'hit rate %.1f%%' % (s['hits'], s['misses'], s['negatives'],
+                                      100.0 * s['hits'] / max(lookups, 1)),
+                 'Area XML: %d from cache, %d queried (%d without data)' %
+                 (s['area_hits'], s['area_misses'], s['area_negatives']),
+                 'Requests: %d, %.1f MB received' % (s['requests'],
+                                                     s['bytes'] / 2.0 ** 20)]
+        if s['requests']:
+            lines.append('Latency:')
+            lower = 0
+            for upper, n in s['latency']:
+                if n:
+                    if upper is None:
+                        lines.append('  > %gs: %d' % (lower, n))
+                    else:
+                        lines.append('  %g-%gs: %d' % (lower, upper, n))
+                lower = upper
+        slowest = sorted(s['parses'].iteritems(),
+                         key=lambda item: -item[1]['parse_seconds'])[:5]
+        if slowest:
+            lines.append('Slowest parses:')
+            for (search_type, key), parse in slowest:
+                lines.append('  %s %s: %.3fs for %d bytes, %d records' %
+                             (search_type, key, parse['parse_seconds'],
+                              parse['xml_bytes'], parse['records']))
+        return '\n'.join(lines)
+
+
+query_stats = _QueryStats()
+
+#------------------------------------------------------------------------------
+# Cache Schema
+#------------------------------------------------------------------------------
+
+def _migrate_to_1(con):
+    """Key the cache on (bmap, type) instead of on the XML itself.
+
+    The original table put its only index, a UNIQUE constraint, on the XML,
+    so every lookup by BrainMap scanned the whole table.  If a file made
+    before schema versioning has several entries for a BrainMap, the first
+    one inserted is kept.
+    """
+    con.execute("""
+CREATE TABLE cache_new
+(
+    bmap TEXT NOT NULL,
+    type TEXT NOT NULL,
+    xml TEXT NOT NULL,
+    PRIMARY KEY (bmap, type)
+)
+""")
+    old = con.execute("""
+SELECT name
+FROM sqlite_master
+WHERE type = 'table' AND name = 'cache'
+""").fetchall()
+    if old:
+        con.execute("""
+INSERT OR IGNORE INTO cache_new
+SELECT bmap, type, xml
+FROM cache
+WHERE bmap IS NOT NULL AND type IS NOT NULL AND xml IS NOT NULL
+ORDER BY rowid
+""")
+        con.execute('DROP TABLE cache')
+    con.execute('ALTER TABLE cache_new RENAME TO cache')
+
+
+def _migrate_to_2(con):
+    """Hash cached XML and add a table for parsed ebunches.
+
+    An ebunch is valid only while the hash stored with it matches that of
+    the cached XML and its parser version matches PARSER_VERSION.
+    """
+    con.execute('ALTER TABLE cache ADD COLUMN hash TEXT')
+    rows = con.execute('SELECT rowid, xml FROM cache').fetchall()
+    con.executemany("""
+UPDATE cache
+SET hash = ?
+WHERE rowid = ?
+""", ((_xml_hash(_unpack_xml(xml)), rowid) for rowid, xml in rows))
+    con.execute("""
+CREATE TABLE ebunch
+(
+    bmap TEXT NOT NULL,
+    type TEXT NOT NULL,
+    xml_hash TEXT NOT NULL,
+    parser INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (bmap, type)
+)
+""")
+
+
+def _migrate_to_3(con):
+    """Copy entries from the cache formerly kept by query_by_area.
+
+    Areas are now cached in the main cache, under the key
+    '<bmap>-<area>' the old cache used.  The old file is left in place.
+    """
+    if not os.path.exists(AREA_DBPATH):
+        return
+    old = sqlite3.connect(AREA_DBPATH)
+    old.text_factory = str
+    try:
+        if not old.execute("""
+SELECT name
+FROM sqlite_master
+WHERE type = 'table' AND name = 'cache'
+""").fetchall():
+            return
+        rows = old.execute("""
+SELECT bmapPLUSarea, type, xml
+FROM cache
+WHERE bmapPLUSarea IS NOT NULL AND type IS NOT NULL AND xml IS NOT NULL
+ORDER BY rowid
+""").fetchall()
+    finally:
+        old.close()
+    entries = []
+    for key, search_type, value in rows:
+        xml = _unpack_xml(value)
+        entries.append((key, search_type, _pack_xml(xml), _xml_hash(xml)))
+    con.executemany("""
+INSERT OR IGNORE INTO cache (bmap, type, xml, hash)
+VALUES (?, ?, ?, ?)
+""", entries)
+
+
+def _migrate_to_4(con):
+    """Add the table in which ingests record their progress (see
+    _IngestJournal)."""
+    con.execute("""
+CREATE TABLE journal
+(
+    type TEXT NOT NULL,
+    bmap TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    error TEXT,
+    attempts INTEGER NOT NULL,
+    PRIMARY KEY (type, bmap)
+)
+""")
+
+
+def _migrate_to_5(con):
+    """Count the duplicate records skipped for each BrainMap in an ingest."""
+    con.execute("""
+ALTER TABLE journal ADD COLUMN duplicates INTEGER NOT NULL DEFAULT 0
+""")
+
+
+def _migrate_to_6(con):
+    """Add the table of BrainMaps queried area by area because the query
+    for the whole BrainMap timed out (see _map_records)."""
+    con.execute("""
+CREATE TABLE area_mode
+(
+    bmap TEXT NOT NULL,
+    type TEXT NOT NULL,
+    PRIMARY KEY (bmap, type)
+)
+""")
+
+
+# MIGRATIONS[i] brings a cache at schema version i to version i + 1.
+# Version 0 is any cache made before the schema was versioned, including
+# a brand new, empty file.
+MIGRATIONS = [_migrate_to_1, _migrate_to_2, _migrate_to_3, _migrate_to_4,
+              _migrate_to_5, _migrate_to_6]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def _upgrade_schema(con):
+    """Bring the cache behind con up to SCHEMA_VERSION.
+
+    All pending migrations run in a single transaction, so an interrupted
+    upgrade leaves the file as it was.
+    """
+    version = con.execute('PRAGMA user_version').fetchone()[0]
+    if version > SCHEMA_VERSION:
+        raise sqlite3.DatabaseError('cache schema version %d is newer than '
+                                    'this version of cocotools supports (%d)'
+                                    % (version, SCHEMA_VERSION))
+    if version == SCHEMA_VERSION:
+        return
+    # The sqlite3 module commits before every CREATE, DROP, or ALTER
+    # unless we manage the transaction ourselves.
+    isolation_level = con.isolation_level
+    con.isolation_level = None
+    try:
+        con.execute('BEGIN IMMEDIATE')
+        try:
+            for migrate in MIGRATIONS[version:]:
+                migrate(con)
+            # PRAGMA does not accept bound parameters.
+            con.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        except:
+            con.execute('ROLLBACK')
+            raise
+        con.execute('COMMIT')
+    finally:
+        con.isolation_level = isolation_level
 
 
 class _CoCoLite(object):
 
+    """SQLite cache in front of a CoCoMac query function.
+
+    Entries are keyed on BrainMap and search type, and their XML is stored
+    compressed (see CODECS).  XML for one area of a BrainMap is keyed on
+    '<bmap>-<area>' instead of the BrainMap, and BrainMaps whose queries
+    time out are marked to be queried area by area.  The database uses
+    write-ahead logging, so other processes reading the cache do not block
+    the one writing to it.
+
+    A single connection is shared by every thread that calls the decorated
+    function, so all access to it is serialized with a lock.  The lock is
+    not held while the wrapped function itself runs, so several queries
+    can wait on the network at once.
+    """
+
     def __init__(self, func):
         self.func = func
+        self.lock = threading.RLock()
         self.con = self.setup_connection()
 
     def setup_connection(self):
@@ -37,49 +454,364 @@ class _CoCoLite(object):
         except OSError, e:
             if e.errno != errno.EEXIST:
                 raise
-        con = sqlite3.connect(DBPATH)
+        con = sqlite3.connect(DBPATH, check_same_thread=False)
         con.text_factory = str
-        with con:
-            con.execute("""
-CREATE TABLE IF NOT EXISTS cache
-(
-    bmap TEXT,
-    type TEXT,
-    xml TEXT UNIQUE
-)
-""")
+        # In-memory databases report 'memory' and keep their journal.
+        con.execute('PRAGMA journal_mode = WAL')
+        con.execute('PRAGMA synchronous = NORMAL')
+        _upgrade_schema(con)
         return con
 
     def __call__(self, search_type, bmap):
         try:
             xml = self.select_xml(search_type, bmap)
         except IndexError:
-            xml = self.func(search_type, bmap)
-            if xml:
-                with self.con as con:
-                    con.execute("""
-INSERT INTO cache
-VALUES (?, ?, ?)
-""", (bmap, search_type, xml))
+            query_stats.count('misses')
+            try:
+                xml = self.func(search_type, bmap)
+            except:
+                query_stats.count('negatives')
+                raise
+            if not xml:
+                query_stats.count('negatives')
+            else:
+                with self.lock:
+                    try:
+                        # Another thread may have fetched the same
+                        # BrainMap while we were waiting on the network.
+                        xml = self.select_xml(search_type, bmap)
+                    except IndexError:
+                        self.insert_many([(search_type, bmap, xml)])
+        else:
+            query_stats.count('hits')
         return xml
 
     def select_xml(self, search_type, bmap):
-        rows = self.con.execute("""
+        with self.lock:
+            rows = self.con.execute("""
 SELECT xml
 FROM cache
 WHERE bmap = ? AND type = ?
 """, (bmap, search_type)).fetchall()
-        if len(rows) > 1:
-            raise sqlite3.IntegrityError('multiple xml entries for bmap %s' %
-                                         bmap)
-        return rows[0][0]
+        return _unpack_xml(rows[0][0])
 
-    def remove_entry(self, search_type, bmap):
-        self.con.execute("""
-DELETE FROM cache
+    def insert_many(self, entries):
+        """Add entries to the cache in a single transaction.
+
+        Parameters
+        ----------
+        entries : iterable
+          (search_type, bmap, xml) tuples.  An entry replaces any already
+          cached for the same search type and BrainMap, unless the XML
+          cached is the same, in which case it is left alone.
+        """
+        with self.lock:
+            with self.con as con:
+                rows = []
+                for search_type, bmap, xml in entries:
+                    xml_hash = _xml_hash(xml)
+                    if con.execute("""
+SELECT 1
+FROM cache
+WHERE bmap = ? AND type = ? AND hash = ?
+""", (bmap, search_type, xml_hash)).fetchall():
+                        continue
+                    rows.append((bmap, search_type, _pack_xml(xml), xml_hash))
+                con.executemany("""
+INSERT OR REPLACE INTO cache (bmap, type, xml, hash)
+VALUES (?, ?, ?, ?)
+""", rows)
+
+    def select_hashes(self, search_type, bmap):
+        """Return a dict mapping each key cached for bmap, whether for the
+        whole BrainMap or one of its areas, to the hash of its XML."""
+        with self.lock:
+            rows = self.con.execute("""
+SELECT bmap, hash
+FROM cache
+WHERE type = ? AND (bmap = ? OR substr(bmap, 1, ?) = ?)
+""", (search_type, bmap, len(bmap) + 1, bmap + '-')).fetchall()
+        return dict(rows)
+
+    def select_bmaps(self, search_type):
+        """Return the BrainMaps for which XML is cached, whether for the
+        whole BrainMap or one of its areas."""
+        with self.lock:
+            rows = self.con.execute("""
+SELECT DISTINCT bmap
+FROM cache
+WHERE type = ?
+""", (search_type,)).fetchall()
+        return sorted(set(key.split('-', 1)[0] for key, in rows))
+
+    def select_area_mode(self, search_type, bmap):
+        """Return whether bmap has been marked by set_area_mode."""
+        with self.lock:
+            rows = self.con.execute("""
+SELECT 1
+FROM area_mode
 WHERE bmap = ? AND type = ?
+""", (bmap, search_type)).fetchall()
+        return bool(rows)
+
+    def set_area_mode(self, search_type, bmap):
+        """Mark bmap to be queried area by area, its query having timed
+        out."""
+        with self.lock:
+            with self.con as con:
+                con.execute("""
+INSERT OR IGNORE INTO area_mode (bmap, type)
+VALUES (?, ?)
 """, (bmap, search_type))
-        self.con.commit()
+
+    def remove_entry(self, search_type, bmap):
+        with self.lock:
+            for table in ('cache', 'ebunch'):
+                self.con.execute("""
+DELETE FROM %s
+WHERE bmap = ? AND type = ?
+""" % table, (bmap, search_type))
+            self.con.commit()
+
+    def recompress(self, codec=None):
+        """Store every cached entry with codec (default CODEC).
+
+        Returns the total size of the stored XML before and after, in
+        bytes.
+        """
+        return _recompress(self.con, self.lock, codec)
+
+
+class _CoCoLiteEbunch(object):
+
+    """Cache of parsed ebunches, kept alongside a _CoCoLite XML cache.
+
+    Parsing the XML for a large BrainMap costs far more than reading it
+    from the cache, so the records built from it (see _iter_records) are
+    stored too, serialized with marshal and compressed.  A stored
+    ebunch is used only if the XML it was built from is still the XML in
+    the cache and it was built with the current PARSER_VERSION; otherwise
+    the decorated function is called again.
+
+    Records not converted to edges because their keys were in the seen
+    argument (see _iter_records) are stored as they are.  A stored ebunch
+    with such records is used only by callers that have seen them too, as
+    when the same ingest is run again; other callers have the XML parsed
+    in full again.
+
+    Parameters
+    ----------
+    func : function
+      Function that takes a search type, a BrainMap, and the keys of the
+      records seen already, and returns a list of records.
+
+    xml_cache : _CoCoLite (optional)
+      Cache holding the XML from which func builds ebunches.  Default is
+      query_cocomac.
+    """
+
+    def __init__(self, func, xml_cache=None):
+        self.func = func
+        if xml_cache is None:
+            xml_cache = query_cocomac
+        self.xml_cache = xml_cache
+
+    def __call__(self, search_type, bmap, seen=()):
+        try:
+            ebunch = self.select_ebunch(search_type, bmap)
+        except IndexError:
+            ebunch = None
+        if ebunch is not None and all(record[1] is not None or
+                                      record[0] in seen for record in ebunch):
+            query_stats.count('ebunch_hits')
+            return ebunch
+        query_stats.count('ebunch_misses')
+        ebunch = self.func(search_type, bmap, seen)
+        if ebunch:
+            self.insert_ebunch(search_type, bmap, ebunch)
+        return ebunch
+
+    def select_ebunch(self, search_type, bmap):
+        with self.xml_cache.lock:
+            rows = self.xml_cache.con.execute("""
+SELECT ebunch.data
+FROM ebunch JOIN cache USING (bmap, type)
+WHERE bmap = ? AND type = ? AND ebunch.xml_hash = cache.hash AND
+      ebunch.parser = ?
+""", (bmap, search_type, PARSER_VERSION)).fetchall()
+        return marshal.loads(zlib.decompress(rows[0][0]))
+
+    def insert_ebunch(self, search_type, bmap, ebunch):
+        """Store ebunch against the XML now cached for bmap.
+
+        Nothing is stored if no XML is cached for bmap.
+        """
+        data = sqlite3.Binary(zlib.compress(marshal.dumps(ebunch, 2)))
+        with self.xml_cache.lock:
+            with self.xml_cache.con as con:
+                con.execute("""
+INSERT OR REPLACE INTO ebunch (bmap, type, xml_hash, parser, data)
+SELECT bmap, type, hash, ?, ?
+FROM cache
+WHERE bmap = ? AND type = ?
+""", (PARSER_VERSION, data, bmap, search_type))
+
+
+class _IngestJournal(object):
+
+    """Record of the progress of an ingest, kept in the cache.
+
+    Each call to multi_map_ebunch or iter_map_edges starts a new ingest for
+    its search type, listing the BrainMaps it will query as pending.  Each
+    BrainMap is marked in-flight while it is being queried, and then done
+    or failed; the name of the error class is kept for failures, and
+    every attempt is counted.  The number of records skipped for each
+    BrainMap because an earlier BrainMap had already supplied them is
+    kept too.  Because the journal is in the cache file,
+    it outlives the process, and resume can finish an ingest that was
+    interrupted.
+
+    Parameters
+    ----------
+    xml_cache : _CoCoLite (optional)
+      Cache whose database holds the journal.  Default is query_cocomac.
+    """
+
+    def __init__(self, xml_cache=None):
+        if xml_cache is None:
+            xml_cache = query_cocomac
+        self.xml_cache = xml_cache
+
+    def start(self, search_type, bmaps):
+        """Forget the last ingest for search_type and start one for bmaps."""
+        with self.xml_cache.lock:
+            with self.xml_cache.con as con:
+                con.execute("""
+DELETE FROM journal
+WHERE type = ?
+""", (search_type,))
+                con.executemany("""
+INSERT OR IGNORE INTO journal (type, bmap, position, state, attempts)
+VALUES (?, ?, ?, 'pending', 0)
+""", ((search_type, bmap, i) for i, bmap in enumerate(bmaps)))
+
+    def mark(self, search_type, bmap, state, error=None):
+        """Set the state of bmap, counting an attempt if it is in-flight."""
+        with self.xml_cache.lock:
+            with self.xml_cache.con as con:
+                con.execute("""
+UPDATE journal
+SET state = ?, error = ?, attempts = attempts + ?
+WHERE type = ? AND bmap = ?
+""", (state, error, int(state == 'in-flight'), search_type, bmap))
+
+    def record_duplicates(self, search_type, bmap, count):
+        """Set the number of duplicate records skipped for bmap."""
+        with self.xml_cache.lock:
+            with self.xml_cache.con as con:
+                con.execute("""
+UPDATE journal
+SET duplicates = ?
+WHERE type = ? AND bmap = ?
+""", (count, search_type, bmap))
+
+    def duplicates(self, search_type):
+        """Return the number of duplicate records skipped in the last
+        ingest for search_type."""
+        with self.xml_cache.lock:
+            return self.xml_cache.con.execute("""
+SELECT TOTAL(duplicates)
+FROM journal
+WHERE type = ?
+""", (search_type,)).fetchone()[0]
+
+    def states(self, search_type):
+        """Return (bmap, state, error, attempts) tuples for the last ingest
+        for search_type, in the order the BrainMaps were listed."""
+        with self.xml_cache.lock:
+            return self.xml_cache.con.execute("""
+SELECT bmap, state, error, attempts
+FROM journal
+WHERE type = ?
+ORDER BY position
+""", (search_type,)).fetchall()
+
+#------------------------------------------------------------------------------
+# Cache Snapshots
+#------------------------------------------------------------------------------
+
+# A snapshot made by export_cache is SNAPSHOT_MAGIC, a newline, and then a
+# series of chunks, each a 4-byte big-endian length followed by that many
+# bytes of zlib-compressed marshal data: a (table, rows) tuple.  A chunk
+# of length 0 ends the series and is followed by the SHA-1 digest of all
+# the chunks before it.  Increase the number in SNAPSHOT_MAGIC whenever
+# this format changes, and keep the old magic in OLD_SNAPSHOT_MAGICS if
+# import_cache can still read such snapshots.
+SNAPSHOT_MAGIC = 'cocotools-cache-snapshot 2'
+# Version 1 lacked the area_mode table.
+OLD_SNAPSHOT_MAGICS = ('cocotools-cache-snapshot 1',)
+# Rows per chunk.
+SNAPSHOT_CHUNK = 500
+# Tables copied, with their columns in the order they are stored and the
+# column holding a BLOB (None if there is none).
+SNAPSHOT_TABLES = (('cache', ('bmap', 'type', 'xml', 'hash'), 'xml'),
+                   ('ebunch', ('bmap', 'type', 'xml_hash', 'parser', 'data'),
+                    'data'),
+                   ('area_mode', ('bmap', 'type'), None))
+
+
+def _write_chunk(f, digest, data):
+    chunk = struct.pack('>I', len(data)) + data
+    digest.update(chunk)
+    f.write(chunk)
+
+
+def _iter_raw_chunks(f):
+    """Generate the data of each chunk in a snapshot, with its header,
+    and then the digest that follows the last one."""
+    while True:
+        header = f.read(4)
+        if len(header) < 4:
+            raise ValueError('snapshot is truncated')
+        length = struct.unpack('>I', header)[0]
+        if not length:
+            break
+        data = f.read(length)
+        if len(data) < length:
+            raise ValueError('snapshot is truncated')
+        yield header, data
+    yield None, f.read()
+
+
+def _verified_chunks(f):
+    """Generate the data of each chunk in a snapshot, raising ValueError
+    at the end if the snapshot is truncated or its digest does not
+    match."""
+    digest = hashlib.sha1()
+    for header, data in _iter_raw_chunks(f):
+        if header is None:
+            if data != digest.digest():
+                raise ValueError('snapshot checksum does not match')
+            return
+        digest.update(header + data)
+        yield data
+
+
+def _read_chunks(f):
+    """Generate the (table, rows) tuples in a snapshot.
+
+    The whole snapshot is read and its digest checked before any chunk
+    is decompressed or unmarshalled, so nothing is loaded from a damaged
+    or tampered file; ValueError is raised if it is truncated or its
+    digest does not match.  The chunks are then read again from the same
+    position, and checked again, in case the file changed in between.
+    """
+    start = f.tell()
+    for data in _verified_chunks(f):
+        pass
+    f.seek(start)
+    for data in _verified_chunks(f):
+        yield marshal.loads(zlib.decompress(data))
 
 #------------------------------------------------------------------------------
 # Private Functions
@@ -189,11 +921,342 @@ def _reduce_ecs(attr):
     return attr
 
 
-def _element_tree(xml_str):
-    s = StringIO()
-    s.write(xml_str)
-    s.seek(0)
-    return etree.parse(s)
+def _iter_primary_elements(source, search_type):
+    """Parse XML incrementally, yielding each primary element.
+
+    Each PrimaryRelation or IntegratedPrimaryProjection is yielded as soon
+    as its closing tag is read and is detached from the partial tree when
+    the next one is requested.  Only the elements the parser has read
+    ahead of the current one are held, so no DOM is built for the whole
+    response.
+
+    Parameters
+    ----------
+    source : file-like object
+      XML returned by CoCoMac.
+
+    search_type : string
+      'Mapping' or 'Connectivity'
+
+    Returns
+    -------
+    generator
+      etree.Element objects.
+    """
+    primtag = P.lstrip('./') + SPECS[search_type]['primtag']
+    # Elements whose closing tags have not yet been read.
+    open_elements = []
+    for event, e in iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            open_elements.append(e)
+            continue
+        open_elements.pop()
+        if e.tag == primtag:
+            yield e
+            if open_elements:
+                open_elements[-1].remove(e)
+
+
+def _iter_edges(source, search_type):
+    """Parse XML incrementally, yielding an edge for each primary element.
+
+    See _iter_primary_elements.
+
+    Returns
+    -------
+    generator
+      (source, target, edge_attr) tuples, as returned by _element2edge.
+    """
+    for e in _iter_primary_elements(source, search_type):
+        yield _element2edge(e, search_type)
+
+
+def _record_key(prim_e):
+    """Return a key identifying the CoCoMac record in prim_e.
+
+    The XML does not include the ID of the record, so the key is a hash
+    of everything in it, which is the same whichever query returned it.
+    Whitespace between elements is ignored.
+    """
+    parts = []
+    for e in prim_e.iter():
+        text = (e.text or '').strip()
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        parts.append('%s\0%s' % (e.tag, text))
+    return hashlib.sha1('\0'.join(parts)).digest()
+
+
+def _iter_records(source, search_type, seen=()):
+    """Parse XML incrementally, yielding a record for each primary element.
+
+    Parameters
+    ----------
+    source : file-like object
+      XML to parse.
+
+    search_type : string
+      'Mapping' or 'Connectivity'
+
+    seen : container (optional)
+      Keys of records already ingested.  Their elements are not converted
+      to edges again.
+
+    Returns
+    -------
+    generator
+      (key, edge) tuples, where key is returned by _record_key and edge by
+      _element2edge, or is None if key is in seen.
+    """
+    for e in _iter_primary_elements(source, search_type):
+        key = _record_key(e)
+        if key in seen:
+            yield key, None
+        else:
+            yield key, _element2edge(e, search_type)
+
+
+def _area_key(bmap, area):
+    """Return the key under which XML for one area of bmap is cached."""
+    return '%s-%s' % (bmap, area)
+
+
+def _split_by_area(search_type, bmap, areas, xml):
+    """Divide XML returned for several areas of bmap among those areas.
+
+    Each primary element goes to every area in areas named by one of its
+    BrainSites, or to the first area if none is named.
+
+    Returns
+    -------
+    entries : list of tuples
+      (search_type, key, xml) tuples for query_cocomac.insert_many, one
+      for each area with at least one primary element.
+    """
+    if len(areas) == 1:
+        return [(search_type, _area_key(bmap, areas[0]), xml)]
+    areas_by_site = {}
+    for area in areas:
+        areas_by_site.setdefault(_area_key(bmap, area).upper(),
+                                 []).append(area)
+    elements = dict((area, []) for area in areas)
+    for e in _iter_primary_elements(StringIO(xml), search_type):
+        matches = []
+        for site_e in e.findall('%sID_BrainSite' % P):
+            for area in areas_by_site.get(site_e.text.upper(), []):
+                if area not in matches:
+                    matches.append(area)
+        for area in matches or areas[:1]:
+            elements[area].append(etree.tostring(e))
+    return [(search_type, _area_key(bmap, area),
+             '<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<CoCoMacExport xmlns="http://www.cocomac.org">%s'
+             '</CoCoMacExport>' % ''.join(elements[area]))
+            for area in areas if elements[area]]
+
+
+def _get(url):
+    """Return client.DEFAULT_CLIENT.get(url), recording the request in
+    query_stats."""
+    start = time.time()
+    size = 0
+    try:
+        raw = client.DEFAULT_CLIENT.get(url)
+        size = len(raw)
+    finally:
+        query_stats.record_request(time.time() - start, size)
+    return raw
+
+
+def _parse(search_type, key, xml, seen=()):
+    """Return the records in xml, as returned by _iter_records, recording
+    the time taken in query_stats."""
+    start = time.time()
+    # A cStringIO object made from a string reads that string in place
+    # rather than copying it.
+    records = list(_iter_records(StringIO(xml), search_type, seen))
+    query_stats.record_parse(search_type, key, len(xml), time.time() - start,
+                             len(records))
+    return records
+
+
+def _next_batch(search_type, bmap, areas, bytes_per_area=None):
+    """Return how many of areas, from the first, to name in the next query.
+
+    As many areas are named as keep the URL within MAX_URL_LENGTH and,
+    once bytes_per_area has been measured, the expected response within
+    MAX_RESPONSE_BYTES.  At least one area is always named.
+    """
+    limit = len(areas)
+    if bytes_per_area:
+        limit = min(limit, max(1, int(MAX_RESPONSE_BYTES / bytes_per_area)))
+    n = 1
+    while (n < limit and
+           len(url(search_type, bmap, areas[:n + 1])) <= MAX_URL_LENGTH):
+        n += 1
+    return n
+
+
+def _fetch_areas(search_type, bmap, areas):
+    """Query CoCoMac for areas of bmap and cache the XML for each area.
+
+    All of areas are named in one query.  If it times out, each half of
+    areas is queried in turn, and so on down to single areas.  Entries
+    cached for areas that the answer has nothing for are removed.
+
+    Returns
+    -------
+    failures : list of strings
+      Areas for which no XML was acquired.
+
+    size : integer
+      Bytes of XML received.
+    """
+    try:
+        raw = _get(url(search_type, bmap, areas))
+    except timeout:
+        if len(areas) == 1:
+            return list(areas), 0
+        half = len(areas) / 2
+        failures1, size1 = _fetch_areas(search_type, bmap, areas[:half])
+        failures2, size2 = _fetch_areas(search_type, bmap, areas[half:])
+        return failures1 + failures2, size1 + size2
+    except urllib2.URLError:
+        return list(areas), 0
+    xml = _scrub_xml_str(raw)
+    entries = _split_by_area(search_type, bmap, areas, xml)
+    query_cocomac.insert_many(entries)
+    # An area for which CoCoMac now returns nothing must not keep the XML
+    # cached for it by an earlier query.
+    answered = set(entry[1] for entry in entries)
+    for area in areas:
+        key = _area_key(bmap, area)
+        if key not in answered:
+            query_cocomac.remove_entry(search_type, key)
+    return [], len(xml)
+
+
+def _fetch_in_batches(search_type, bmap, areas):
+    """Query CoCoMac for areas of bmap and cache the XML for each area.
+
+    Areas are named in batches sized by _next_batch, using the average
+    size of the responses so far as the estimate for the next one.
+    Returns the areas for which no XML was acquired.
+    """
+    failures = []
+    received = answered = 0
+    while areas:
+        if answered:
+            bytes_per_area = float(received) / answered
+        else:
+            bytes_per_area = None
+        n = _next_batch(search_type, bmap, areas, bytes_per_area)
+        batch_failures, size = _fetch_areas(search_type, bmap, areas[:n])
+        failures += batch_failures
+        received += size
+        answered += n - len(batch_failures)
+        areas = areas[n:]
+    return failures
+
+
+def _area_records(search_type, bmap, areas, seen=()):
+    """Return (area, records) pairs for areas of bmap.
+
+    Records are as returned by _iter_records, given seen.  Areas not yet
+    in the cache are fetched by _fetch_in_batches.  The records are None
+    or empty for each area for which no data were acquired.
+    """
+    cached = [_parse_cached_xml(search_type, _area_key(bmap, area), seen)
+              for area in areas]
+    missing = [area for area, records in zip(areas, cached) if not records]
+    query_stats.count('area_hits', len(areas) - len(missing))
+    query_stats.count('area_misses', len(missing))
+    if not missing:
+        return zip(areas, cached)
+    _fetch_in_batches(search_type, bmap, missing)
+    area_records = [(area, records or
+                     _parse_cached_xml(search_type, _area_key(bmap, area),
+                                       seen))
+                    for area, records in zip(areas, cached)]
+    query_stats.count('area_negatives', len([records for area, records in
+                                             area_records if not records]))
+    return area_records
+
+
+def _records_by_area(search_type, bmap, seen=()):
+    """Return the records for bmap gathered area by area.
+
+    Records are as returned by _iter_records, given seen.  A record
+    returned for more than one area is kept once.  Returns None if the
+    areas of bmap are unknown or no data were acquired for any of them.
+    """
+    areas = AREAS[search_type].get(bmap)
+    if not areas:
+        return
+    records = []
+    keys = set()
+    for area, area_records in _area_records(search_type, bmap, areas, seen):
+        for key, edge in area_records or ():
+            if key not in keys:
+                keys.add(key)
+                records.append((key, edge))
+    if records:
+        return records
+
+
+# Invalid characters we've seen appear in CoCoMac output.  They do not
+# cover exhaustively a specific range, so we've added them one-by-one to
+# this string.
+INVALID_CHARS = """\
+\xb4\xfc\xd6\r\xdc\xe4\xdf\xf6\x85\xf3\xf2\x92\x96\xed\x84\x94\xb0"""
+
+
+class _XMLScrubber(object):
+
+    """Incremental version of _scrub_xml_str.
+
+    Data fed in chunks are held until a valid XML header has been seen;
+    from then on each chunk is returned as soon as the invalid characters
+    have been removed from it.  A scrubber made with a source can itself
+    be read like a file, so it can sit between a response and iterparse.
+
+    Parameters
+    ----------
+    source : file-like object (optional)
+      Raw data returned by CoCoMac, for use with read.
+    """
+
+    def __init__(self, source=None):
+        self.source = source
+        # Data read before the header, or None once it has been found.
+        self.head = ''
+
+    def feed(self, chunk):
+        """Return the XML in chunk, or '' if the header has not been
+        found yet."""
+        if self.head is not None:
+            self.head += chunk
+            start = self.head.find('<?xml')
+            if start < 0 or self.head.find('?>', start + 5) < 0:
+                return ''
+            chunk = self.head[start:]
+            self.head = None
+        return chunk.translate(None, INVALID_CHARS)
+
+    def close(self):
+        """Raise ValueError if no valid XML header was found."""
+        if self.head is not None:
+            raise ValueError('input does not contain valid xml header')
+
+    def read(self, size=16384):
+        while True:
+            chunk = self.source.read(size)
+            if not chunk:
+                self.close()
+                return ''
+            xml = self.feed(chunk)
+            if xml:
+                return xml
 
 
 def _scrub_xml_str(raw):
@@ -206,7 +1269,7 @@ def _scrub_xml_str(raw):
     If the otuput does not contain any valid XML header, ValueError is raised.
 
     The routine also removes a few invalid characters we've seen appear in
-    CoCoMac output.
+    CoCoMac output (see INVALID_CHARS).
 
     Parameters
     ----------
@@ -222,24 +1285,163 @@ def _scrub_xml_str(raw):
     ----
     Other than enforce that a valid XML header is present, this routine does
     not validate the output as real XML.
+
+    The header is found with a plain search and the invalid characters
+    are removed with str.translate, so the data are scanned once rather
+    than matched against a backtracking regular expression.
     """
-    match = re.match('(.*)(<\?xml.*\?>.*)', raw, re.S)
-    if match:
-        out =  match.group(2)
-        # The invalid characters seen do not cover exhaustively a
-        # specific range, so we've added them one-by-one to this
-        # string.
-        invalids = """\
-[\xb4\xfc\xd6\r\xdc\xe4\xdf\xf6\x85\xf3\xf2\x92\x96\xed\x84\x94\xb0]"""
-        return re.sub(invalids, '', out)
-    else:
-        raise ValueError('input does not contain valid xml header')
+    scrubber = _XMLScrubber()
+    xml = scrubber.feed(raw)
+    scrubber.close()
+    return xml
+
+
+def _bmaps_to_query(search_type, subset):
+    """Return the BrainMaps named by the subset argument of the ebunch
+    functions."""
+    if not subset:
+        if search_type == 'Mapping':
+            return MAPPING_SOURCES
+        elif search_type == 'Connectivity':
+            return CONNECTIVITY_SOURCES
+    elif isinstance(subset, str):
+        return [line.strip() for line in open(subset).readlines()]
+    return subset
+
+
+def _ingest_map(search_type, bmap, seen=(), done=False):
+    """Return the records for bmap, repeating failed queries.
+
+    Records are as returned by _map_records, given seen.  If done, bmap
+    was done in the ingest being resumed, and its records are taken from
+    the cache without its entry in ingest_journal being changed; only if
+    they can no longer be had is it ingested again.
+
+    Queries that fail with a URLError, other than an HTTPError for a
+    client error, are repeated up to RETRIES times, with a delay that
+    starts at BACKOFF seconds and doubles each time.  Progress is recorded
+    in ingest_journal; a BrainMap for which no edges were acquired is
+    failed with the error NoData.
+    """
+    if done:
+        try:
+            records = _map_records(search_type, bmap, seen)
+        except urllib2.URLError:
+            records = None
+        if records:
+            return records
+    for attempt in range(RETRIES + 1):
+        if attempt:
+            time.sleep(BACKOFF * 2 ** (attempt - 1))
+        ingest_journal.mark(search_type, bmap, 'in-flight')
+        try:
+            records = _map_records(search_type, bmap, seen)
+        except urllib2.HTTPError, e:
+            error, retry = e, e.code >= 500
+        except urllib2.URLError, e:
+            error, retry = e, True
+        else:
+            if records:
+                ingest_journal.mark(search_type, bmap, 'done')
+            else:
+                ingest_journal.mark(search_type, bmap, 'failed', 'NoData')
+            return records
+        ingest_journal.mark(search_type, bmap, 'failed',
+                            error.__class__.__name__)
+        if not retry:
+            return
+
+
+def _iter_map_records(search_type, bmaps, workers, seen=(), done=()):
+    """Generate (bmap, records) pairs, querying up to workers at a time.
+
+    Records are as returned by _map_records, given seen, which the caller
+    may add to as pairs are generated.  BrainMaps in done are passed to
+    _ingest_map as done.
+
+    Pairs are generated in the order of bmaps.  With more than one worker,
+    queries run in a thread pool no more than 2 * workers BrainMaps ahead
+    of the one being generated, so results do not pile up when the caller
+    consumes them more slowly than they arrive.
+    """
+    if workers <= 1:
+        for bmap in bmaps:
+            yield bmap, _ingest_map(search_type, bmap, seen, bmap in done)
+        return
+    bmaps = iter(bmaps)
+    pool = ThreadPool(workers)
+    pending = collections.deque()
+    try:
+        while True:
+            while len(pending) < 2 * workers:
+                try:
+                    bmap = bmaps.next()
+                except StopIteration:
+                    break
+                pending.append((bmap, pool.apply_async(_ingest_map,
+                                                       (search_type, bmap,
+                                                        seen,
+                                                        bmap in done))))
+            if not pending:
+                break
+            bmap, result = pending.popleft()
+            yield bmap, result.get()
+    finally:
+        # Reached also when the caller stops early.  Queries not yet
+        # started are dropped; threads cannot be killed, so join waits
+        # for those in progress, whose results are discarded.
+        pool.terminate()
+        pool.join()
+
+
+def _refresh_map(search_type, bmap):
+    """Query CoCoMac again for the XML cached for bmap.
+
+    The whole BrainMap is queried if it is cached whole or not at all.  If
+    that query times out, or only areas of bmap are cached, the areas
+    cached (or, failing that, those listed in AREAS) are queried instead,
+    and XML cached for the whole BrainMap is removed once every area has
+    been acquired.  A BrainMap that times out is marked to be queried
+    area by area (see _CoCoLite.set_area_mode).  Only entries whose XML differs from what is cached are
+    rewritten (see _CoCoLite.insert_many).
+
+    Returns
+    -------
+    changed : bool
+      Whether the XML cached for bmap changed.
+
+    failed : bool
+      Whether any query failed.
+    """
+    before = query_cocomac.select_hashes(search_type, bmap)
+    areas = sorted(key.split('-', 1)[1] for key in before if key != bmap)
+    if bmap in before or not areas:
+        try:
+            xml = query_cocomac.func(search_type, bmap)
+        except timeout:
+            query_cocomac.set_area_mode(search_type, bmap)
+            areas = areas or list(AREAS[search_type].get(bmap, ()))
+            if not areas:
+                return False, True
+        except urllib2.URLError:
+            return False, True
+        else:
+            if xml:
+                query_cocomac.insert_many([(search_type, bmap, xml)])
+            return (query_cocomac.select_hashes(search_type, bmap) != before,
+                    not xml)
+    failures = _fetch_in_batches(search_type, bmap, areas)
+    if not failures and bmap in before:
+        query_cocomac.remove_entry(search_type, bmap)
+    return (query_cocomac.select_hashes(search_type, bmap) != before,
+            bool(failures))
+
 
 #------------------------------------------------------------------------------
 # Public Functions
 #------------------------------------------------------------------------------
 
-def url(search_type, bmap):
+def url(search_type, bmap, areas=()):
     """Return CoCoMac URL corresponding to XML query results.
 
     Parameters
@@ -250,20 +1452,29 @@ def url(search_type, bmap):
     bmap : string
       Name of a BrainMap in CoCoMac.
 
+    areas : sequence (optional)
+      Areas of bmap to which the query is restricted.  Default is to query
+      the whole BrainMap.
+
     Returns
     -------
     string
       URL corresponding to query results.
     """
-    search_string = "('%s')[SourceMap]OR('%s')[TargetMap]" % (bmap, bmap)
+    if areas:
+        map_string = "(('%s')[SourceMap]OR('%s')[TargetMap])" % (bmap, bmap)
+        area_string = 'OR'.join("('%s')[SourceSite]OR('%s')[TargetSite]" %
+                                (area, area) for area in areas)
+        search_string = '%sAND(%s)' % (map_string, area_string)
+    else:
+        search_string = "('%s')[SourceMap]OR('%s')[TargetMap]" % (bmap, bmap)
     query_dict = dict(user='teamcoco',
                       password='teamcoco',
                       Search=search_type,
                       SearchString=search_string,
                       DataSet=SPECS[search_type]['data_set'],
                       OutputType='XML_Browser')
-    # The site appears to have changed from cocomac.org to 134.95.56.239:
-    return 'http://134.95.56.239/URLSearch.asp?' + urllib.urlencode(query_dict)
+    return client.COCOMAC_URL + '?' + urllib.urlencode(query_dict)
 
 
 @_CoCoLite
@@ -286,17 +1497,35 @@ def query_cocomac(search_type, bmap):
     -------
     string
       XML containing query results.
+
+    Notes
+    -----
+    Errors are raised rather than hidden, so that the caller can decide
+    what to do about them: socket.timeout if the server takes too long,
+    after which the BrainMap can be queried area by area, and
+    urllib2.URLError if the query fails otherwise, after which it can be
+    repeated.  Nothing is cached for a query that fails.
+
+    Earlier versions returned None when a query failed.  Code that
+    called this function directly and checked for None must catch these
+    errors instead; single_map_ebunch, multi_map_ebunch, and the other
+    ebunch functions handle them.
     """
-    try:
-        xml = urllib2.urlopen(url(search_type, bmap), timeout=120).read()
-    except (urllib2.URLError, timeout):
-        return
-    return _scrub_xml_str(xml)
+    return _scrub_xml_str(_get(url(search_type, bmap)))
 
 
 def single_map_ebunch(search_type, bmap):
     """Construct and return ebunch from data for one BrainMap.
 
+    Ebunches are cached once built, so XML is parsed again only when it
+    changes in the cache or PARSER_VERSION is increased.
+
+    If the query for the whole BrainMap times out, its areas (listed in
+    AREAS) are queried instead, as many at a time as fit the budget set by
+    MAX_URL_LENGTH and MAX_RESPONSE_BYTES, in groups that are split until
+    the server answers.  The timeout is recorded in the cache, and later
+    calls go straight to the areas, which are answered from the cache.
+
     Parameters
     ----------
     search_type : string
@@ -313,22 +1542,80 @@ def single_map_ebunch(search_type, bmap):
     -----
     Integrated primary projections are returned for Connectivity queries,
     and primary relations are returned for Mapping queries.
+
+    urllib2.URLError is raised if the query for the whole BrainMap fails
+    other than by timing out.
+    """
+    records = _map_records(search_type, bmap)
+    if records is not None:
+        return [edge for key, edge in records]
+
+
+ingest_journal = _IngestJournal()
+
+
+# The following are defined here rather than with the other private
+# functions because _CoCoLiteEbunch needs query_cocomac.
+
+@_CoCoLiteEbunch
+def _map_records(search_type, bmap, seen=()):
+    """Return the records, as returned by _iter_records, for one BrainMap.
+
+    See single_map_ebunch.  Elements whose keys are in seen are not
+    converted to edges.
     """
-    xml = query_cocomac(search_type, bmap)
+    if query_cocomac.select_area_mode(search_type, bmap):
+        return _records_by_area(search_type, bmap, seen)
+    try:
+        xml = query_cocomac(search_type, bmap)
+    except timeout:
+        query_cocomac.set_area_mode(search_type, bmap)
+        return _records_by_area(search_type, bmap, seen)
     if xml:
-        tree = _element_tree(xml)
-        ebunch = []
-        for prim in tree.iterfind('%s%s' % (P, SPECS[search_type]['primtag'])):
-            ebunch.append(_element2edge(prim, search_type))
-        if not ebunch:
+        records = _parse(search_type, bmap, xml, seen)
+        if not records:
             query_cocomac.remove_entry(search_type, bmap)
-        if search_type == 'Mapping':
-            return ebunch
-        else:
-            return ebunch
+        return records
+
 
+@_CoCoLiteEbunch
+def _parse_cached_xml(search_type, key, seen=()):
+    """Return the records for the XML cached under key, as returned by
+    _iter_records given seen, or None if no XML is cached under key."""
+    try:
+        xml = query_cocomac.select_xml(search_type, key)
+    except IndexError:
+        return
+    records = _parse(search_type, key, xml, seen)
+    if not records:
+        query_cocomac.remove_entry(search_type, key)
+    return records
+
+
+def single_area_ebunch(search_type, bmap, area):
+    """Construct and return ebunch from data for one area of a BrainMap.
+
+    Parameters
+    ----------
+    search_type : string
+      'Mapping' or 'Connectivity'
 
-def multi_map_ebunch(search_type, subset=False):
+    bmap : string
+      Name of a BrainMap in CoCoMac.
+
+    area : string
+      Name of an area in bmap.
+
+    Returns
+    -------
+    ebunch : list of tuples
+    """
+    records = _area_records(search_type, bmap, [area])[0][1]
+    if records is not None:
+        return [edge for key, edge in records]
+
+
+def multi_map_ebunch(search_type, subset=False, workers=1, summary=False):
     """Construct and return ebunch from data for several BrainMaps.
 
     Also return the BrainMaps for which queries failed.
@@ -343,6 +1630,18 @@ def multi_map_ebunch(search_type, subset=False):
       CoCoMac.  If a string is supplied, it must be the name of a text
       file with one BrainMap per line.  
 
+    workers : integer (optional)
+      Maximum number of BrainMaps to query at once.  With the default of
+      one, BrainMaps are queried one after the other.  Larger values
+      query BrainMaps from a pool of threads, which helps because nearly
+      all the time spent on a query is spent waiting on the CoCoMac
+      server.
+
+    summary : bool (optional)
+      Print statistics on how the BrainMaps were queried (see
+      cache_stats) when finished.  The statistics are reset first, so
+      that they cover this call only.
+
     Returns
     -------
     big_ebunch : list of tuples
@@ -355,29 +1654,431 @@ def multi_map_ebunch(search_type, subset=False):
     -----
     Querying a BrainMap for which there is only Mapping data using the
     Connectivity search type would result in its being a failure.
-    Failures can also result from CoCoMac server errors.
+    Failures can also result from CoCoMac server errors, once the query
+    has been repeated RETRIES times.
 
     The term ebunch, borrowed from NetworkX, refers to a sequence of
     graph theory edges.
     
     Integrated primary projections are returned for Connectivity queries,
     and primary relations are returned for Mapping queries.
+
+    Edges and failures are returned in the order of the BrainMaps queried,
+    whatever the number of workers.
+
+    A relation between two BrainMaps is returned by the queries for both
+    of them.  It is included only the first time it is seen; the number
+    of duplicates skipped is given by ingest_journal.duplicates.
+
+    The progress of the query is recorded in ingest_journal; if it is
+    interrupted, call resume to finish it.
     """
+    if summary:
+        query_stats.reset()
+    failures = []
+    big_ebunch = list(iter_map_edges(search_type, subset, workers,
+                                     failures.append))
+    if summary:
+        print query_stats.summary()
+    return big_ebunch, failures
+
+
+def cache_stats(reset=False):
+    """Return statistics on the queries made since the last reset.
+
+    Parameters
+    ----------
+    reset : bool (optional)
+      Start counting again from zero after returning the statistics.
+
+    Returns
+    -------
+    dict
+      hits, misses, negatives : integers
+        Lookups of BrainMaps in the XML cache that were answered from it,
+        that had to query CoCoMac, and that got no XML from CoCoMac.
+
+      area_hits, area_misses, area_negatives : integers
+        The same for areas of BrainMaps queried area by area.
+
+      ebunch_hits, ebunch_misses : integers
+        Lookups in the cache of parsed ebunches.
+
+      requests, bytes : integers
+        Requests made to CoCoMac and bytes received from it.
+
+      latency : list of tuples
+        Histogram of request latencies, as (upper bound in seconds,
+        count) pairs; the bound of the last bin is None.
+
+      parses : dict
+        Maps (search_type, key) pairs, where key names a BrainMap or an
+        area, to dicts with the size of its XML (xml_bytes), the time taken
+        to parse it (parse_seconds), and the number of records found
+        (records).
+    """
+    result = query_stats.snapshot()
+    if reset:
+        query_stats.reset()
+    return result
+
+
+def iter_map_edges(search_type, subset=False, workers=1, on_failure=None):
+    """Generate edges from data for several BrainMaps.
+
+    This is the lazy counterpart of multi_map_ebunch.  Each BrainMap's
+    edges are yielded as soon as that BrainMap has been queried and
+    parsed, so a graph can be built from the first BrainMaps while later
+    ones are still being fetched, and the full list of edges never has to
+    be held in memory.
+
+    Parameters
+    ----------
+    search_type : string
+      'Mapping' or 'Connectivity'
+
+    subset : sequence or string (optional)
+      Subset of BrainMaps to query, as for multi_map_ebunch.
+
+    workers : integer (optional)
+      Maximum number of BrainMaps to query at once, as for
+      multi_map_ebunch.
+
+    on_failure : function (optional)
+      Called with the name of each BrainMap for which no data were
+      acquired, at the point in the sequence where its edges would have
+      been yielded.
+
+    Returns
+    -------
+    generator
+      (source, target, edge_attr) tuples, in the order of the BrainMaps
+      queried.
+
+    Examples
+    --------
+    >>> failures = []
+    >>> mapg = MapGraph()
+    >>> mapg.add_edges_from(iter_map_edges('Mapping', workers=8,
+    ...                                    on_failure=failures.append))
+    """
+    bmaps = list(_bmaps_to_query(search_type, subset))
+    ingest_journal.start(search_type, bmaps)
+    for edge in _iter_bmap_edges(search_type, bmaps, workers, on_failure):
+        yield edge
+
+
+def _iter_bmap_edges(search_type, bmaps, workers, on_failure, done=()):
+    """Generate the edges for bmaps, for iter_map_edges and resume.
+
+    Records already seen for an earlier BrainMap are skipped, and the
+    number skipped for each BrainMap is recorded in ingest_journal, but
+    for the BrainMaps in done, which resume leaves as they are there.
+    """
+    seen = set()
+    # Records in seen are not converted to edges again when parsed.
+    for bmap, records in _iter_map_records(search_type, bmaps, workers,
+                                           seen, done):
+        if not records:
+            if on_failure:
+                on_failure(bmap)
+            continue
+        duplicates = 0
+        for key, edge in records:
+            if key in seen:
+                duplicates += 1
+            else:
+                seen.add(key)
+                yield edge
+        if bmap not in done:
+            ingest_journal.record_duplicates(search_type, bmap, duplicates)
+
+
+def resume(search_type, workers=1):
+    """Finish the last ingest for search_type.
+
+    The BrainMaps listed when multi_map_ebunch or iter_map_edges was last
+    called for search_type are queried again.  Those that were done are
+    answered from the cache and left as they are in ingest_journal, so
+    only BrainMaps that were pending, in-flight, or failed when the
+    ingest stopped are fetched from CoCoMac.
+
+    Parameters
+    ----------
+    search_type : string
+      'Mapping' or 'Connectivity'
+
+    workers : integer (optional)
+      Maximum number of BrainMaps to query at once, as for
+      multi_map_ebunch.
+
+    Returns
+    -------
+    big_ebunch : list of tuples
+      Each tuple specifies a source and target node and edge attributes.
+
+    failures : list of strings
+      These are the BrainMaps for which no data were acquired.
+
+    Notes
+    -----
+    The result is that which multi_map_ebunch would have returned had the
+    ingest not been interrupted.  Attempts keep being counted in
+    ingest_journal across resumes.
+    """
+    states = ingest_journal.states(search_type)
+    if not states:
+        raise ValueError('no ingest to resume for %s' % search_type)
+    bmaps = [bmap for bmap, state, error, attempts in states]
+    done = set(bmap for bmap, state, error, attempts in states if
+               state == 'done')
+    failures = []
+    big_ebunch = list(_iter_bmap_edges(search_type, bmaps, workers,
+                                       failures.append, done))
+    return big_ebunch, failures
+
+
+def refresh_cache(search_type, maps=None, workers=1):
+    """Query CoCoMac again for BrainMaps in the cache, keeping what changed.
+
+    The XML cached for each BrainMap, whether for the whole BrainMap or
+    area by area, is fetched again and compared with what is cached by
+    its hash.  Only entries whose XML changed are rewritten, so ebunches
+    cached for the others stay valid and are not parsed again.
+
+    Parameters
+    ----------
+    search_type : string
+      'Mapping' or 'Connectivity'
+
+    maps : sequence or string (optional)
+      BrainMaps to refresh.  Default is every BrainMap with XML in the
+      cache.  If a string is supplied, it must be the name of a text file
+      with one BrainMap per line.  BrainMaps not yet in the cache are
+      queried as by single_map_ebunch.
+
+    workers : integer (optional)
+      Maximum number of BrainMaps to query at once, as for
+      multi_map_ebunch.
+
+    Returns
+    -------
+    changed : list of strings
+      BrainMaps whose cached XML changed.  Graphs built from the cache
+      need to be rebuilt only for these.
+
+    failures : list of strings
+      BrainMaps for which a query failed.  What was cached for them
+      before is kept.
+    """
+    if maps is None:
+        bmaps = query_cocomac.select_bmaps(search_type)
+    else:
+        bmaps = _bmaps_to_query(search_type, maps)
+    if workers <= 1:
+        results = [_refresh_map(search_type, bmap) for bmap in bmaps]
+    else:
+        pool = ThreadPool(workers)
+        try:
+            results = [result.get() for result in
+                       [pool.apply_async(_refresh_map, (search_type, bmap))
+                        for bmap in bmaps]]
+        finally:
+            pool.terminate()
+            pool.join()
+    changed = []
+    failures = []
+    for bmap, (bmap_changed, failed) in zip(bmaps, results):
+        if bmap_changed:
+            changed.append(bmap)
+        if failed:
+            failures.append(bmap)
+    return changed, failures
+
+
+def query_maps_by_area(search_type, subset=False, workers=1):
+    """Construct and return ebunch from data for several BrainMaps, querying
+    them area by area.
+
+    Also return the areas for which queries failed.  single_map_ebunch
+    falls back on area queries by itself when a BrainMap times out; this
+    function skips the query for the whole BrainMap.
+
+    Parameters
+    ----------
+    search_type : string
+      'Mapping' or 'Connectivity'
+
+    subset : sequence or string (optional)
+      Subset of BrainMaps to query.  If a string is supplied, it must be
+      the name of a text file with one BrainMap per line.  If subset is
+      not supplied, queries are made only for maps known to produce
+      timeouts (when the map, rather than individual areas, is queried).
+
+    workers : integer (optional)
+      Maximum number of BrainMaps to query at once.  Requests share pooled
+      connections to the server (see cocotools.client).  This used to be
+      the number of areas queried at once; the areas of each BrainMap are
+      now named several to a query instead (see Notes), so concurrency
+      is across BrainMaps.
+
+    Returns
+    -------
+    big_ebunch : list of tuples
+      Each tuple specifies a source and target node and edge attributes.
+    
+    failures : list of strings
+      These are the areas, as '<bmap>-<area>', for which no data were
+      acquired.
+
+    Notes
+    -----
+    Areas are queried as many at a time as fit the budget set by
+    MAX_URL_LENGTH and MAX_RESPONSE_BYTES, and the XML returned is cached
+    separately for each area, in the same cache as that for whole
+    BrainMaps, so later queries for single areas are answered from the
+    cache.  A record returned for more than one area or BrainMap is
+    included once.
+    """
+    if search_type not in AREAS:
+        raise ValueError("search_type must be 'Mapping' or 'Connectivity'.")
+    areas = AREAS[search_type]
     if not subset:
         if search_type == 'Mapping':
-            bmaps = MAPPING_SOURCES
-        elif search_type == 'Connectivity':
-            bmaps = CONNECTIVITY_SOURCES
-    elif isinstance(subset, str):
-        bmaps = [line.strip() for line in open(subset).readlines()]
+            bmaps = MAPPING_TIMEOUTS
+        else:
+            bmaps = CONNECTIVITY_TIMEOUTS
+    else:
+        bmaps = _bmaps_to_query(search_type, subset)
+    get_records = lambda bmap: _area_records(search_type, bmap, areas[bmap])
+    if workers > 1 and len(bmaps) > 1:
+        pool = ThreadPool(min(workers, len(bmaps)))
+        try:
+            results = pool.map(get_records, bmaps)
+        finally:
+            pool.close()
+            pool.join()
     else:
-        bmaps = subset
+        results = [get_records(bmap) for bmap in bmaps]
     big_ebunch = []
     failures = []
-    for bmap in bmaps:
-        little_ebunch = single_map_ebunch(search_type, bmap)
-        if little_ebunch:
-            big_ebunch += little_ebunch
-        else:
-            failures.append(bmap)
+    seen = set()
+    for bmap, area_records in zip(bmaps, results):
+        for area, records in area_records:
+            if not records:
+                failures.append(_area_key(bmap, area))
+                continue
+            for key, edge in records:
+                if key not in seen:
+                    seen.add(key)
+                    big_ebunch.append(edge)
     return big_ebunch, failures
+
+
+def export_cache(path, cache=None):
+    """Write the contents of the query cache to a snapshot file.
+
+    The snapshot holds the XML for every BrainMap and area in the cache,
+    as stored there (compressed; see CODECS), the parsed ebunches, and
+    the BrainMaps queried area by area (see _CoCoLite.set_area_mode), so
+    a machine that imports it with import_cache need not query CoCoMac or
+    parse anything.
+
+    Parameters
+    ----------
+    path : string
+      Name of the snapshot file to write.
+
+    cache : _CoCoLite (optional)
+      Cache to export.  Default is query_cocomac.
+
+    Returns
+    -------
+    integer
+      Number of XML entries written.
+    """
+    if cache is None:
+        cache = query_cocomac
+    digest = hashlib.sha1()
+    count = 0
+    with open(path, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC + '\n')
+        # Hold the lock throughout so the snapshot is consistent.
+        with cache.lock:
+            for table, columns, blob_column in SNAPSHOT_TABLES:
+                i = blob_column and columns.index(blob_column)
+                cursor = cache.con.execute('SELECT %s FROM %s' %
+                                           (', '.join(columns), table))
+                while True:
+                    rows = cursor.fetchmany(SNAPSHOT_CHUNK)
+                    if not rows:
+                        break
+                    if table == 'cache':
+                        count += len(rows)
+                        # Entries cached as TEXT before compression was
+                        # introduced are packed so all XML is stored alike.
+                        rows = [row[:i] + (_pack_xml(row[i]),) + row[i + 1:]
+                                if isinstance(row[i], str) else row
+                                for row in rows]
+                    if i is not None:
+                        rows = [row[:i] + (str(row[i]),) + row[i + 1:]
+                                for row in rows]
+                    _write_chunk(f, digest,
+                                 zlib.compress(marshal.dumps((table, rows),
+                                                             2), 1))
+        f.write(struct.pack('>I', 0))
+        f.write(digest.digest())
+    return count
+
+
+def import_cache(path, cache=None):
+    """Load a snapshot written by export_cache into the query cache.
+
+    Entries in the snapshot replace those in the cache for the same
+    BrainMap or area.  All of them are loaded in one transaction, which is
+    rolled back if the snapshot turns out to be damaged.  Snapshots
+    written before the BrainMaps queried area by area were included are
+    still loaded.
+
+    Parameters
+    ----------
+    path : string
+      Name of the snapshot file.
+
+    cache : _CoCoLite (optional)
+      Cache to load into.  Default is query_cocomac.
+
+    Returns
+    -------
+    integer
+      Number of XML entries loaded.
+
+    Notes
+    -----
+    ValueError is raised if path is not a snapshot, is truncated, or does
+    not match its checksum.
+    """
+    if cache is None:
+        cache = query_cocomac
+    statements = {}
+    for table, columns, blob_column in SNAPSHOT_TABLES:
+        statements[table] = ('INSERT OR REPLACE INTO %s (%s) VALUES (%s)' %
+                             (table, ', '.join(columns),
+                              ', '.join('?' * len(columns))),
+                             blob_column and columns.index(blob_column))
+    count = 0
+    with open(path, 'rb') as f:
+        if f.readline() not in [magic + '\n' for magic in
+                                (SNAPSHOT_MAGIC,) + OLD_SNAPSHOT_MAGICS]:
+            raise ValueError('%s is not a cocotools cache snapshot' % path)
+        with cache.lock:
+            with cache.con as con:
+                for table, rows in _read_chunks(f):
+                    if table == 'cache':
+                        count += len(rows)
+                    statement, i = statements[table]
+                    if i is not None:
+                        rows = (row[:i] + (sqlite3.Binary(row[i]),) +
+                                row[i + 1:] for row in rows)
+                    con.executemany(statement, rows)
+    return count
@@ -0,0 +1,107 @@
+"""Relation codes (RCs) encoded as bitmasks, and their composition.
+
+Each of the RCs 'I', 'S', 'L', and 'O' (see MapGraph) is given one bit,
+and a disjunction of them -- e.g., 'SO', the source is smaller than or
+overlaps with the target -- is the union of their bits.  Zero stands for
+a relationship that cannot be resolved to any of these, such as that
+between two regions both smaller than a third, which may be disjoint.
+
+COMPOSITION[a, b] is the RC of the relationship between A and C when
+that between A and B is a and that between B and C is b.  It is
+precomputed for all sixteen bitmasks, so that compose works on whole
+arrays of them at once.
+"""
+import numpy as np
+
+
+I, S, L, O = 1, 2, 4, 8
+
+RCS = 'ISLO'
+
+ISLO = I | S | L | O
+
+BITS = {'I': I, 'S': S, 'L': L, 'O': O}
+
+CONVERSE = {I: I, S: L, L: S, O: O}
+
+# The composition of single RCs that can be resolved (see Stephan et
+# al., 2000); all other pairs compose to zero.
+_SINGLE_STEPS = {(I, I): I, (I, S): S, (I, L): L, (I, O): O,
+                 (S, I): S, (S, S): S,
+                 (L, I): L, (L, S): ISLO, (L, L): L, (L, O): L | O,
+                 (O, I): O, (O, S): S | O}
+
+
+def encode(rcs):
+    """Return the bitmask for a string of RCs.
+
+    Parameters
+    ----------
+    rcs : string
+      One RC (e.g., 'S') or a disjunction of them (e.g., 'SO').
+
+    Returns
+    -------
+    mask : integer
+    """
+    mask = 0
+    for rc in rcs:
+        mask |= BITS[rc]
+    return mask
+
+
+def decode(mask):
+    """Return the string of RCs for a bitmask, or None if it is zero.
+
+    Parameters
+    ----------
+    mask : integer
+
+    Returns
+    -------
+    rcs : string
+      RCs in the order I, S, L, O (e.g., 'SO').
+    """
+    rcs = ''.join([rc for rc in RCS if mask & BITS[rc]])
+    return rcs or None
+
+
+def _compose_masks(a, b):
+    """Compose the disjunctions a and b one pair of RCs at a time."""
+    composed = 0
+    for x in (I, S, L, O):
+        if not a & x:
+            continue
+        for y in (I, S, L, O):
+            if not b & y:
+                continue
+            step = _SINGLE_STEPS.get((x, y), 0)
+            if not step:
+                return 0
+            composed |= step
+    return composed
+
+
+COMPOSITION = np.array([[_compose_masks(a, b) for b in range(16)]
+                        for a in range(16)], dtype=np.uint8)
+
+
+def compose(rc_a_array, rc_b_array):
+    """Compose arrays of RC bitmasks element by element.
+
+    Parameters
+    ----------
+    rc_a_array : array_like
+      RC bitmasks for relationships from A to B.
+
+    rc_b_array : array_like
+      RC bitmasks for relationships from B to C, broadcastable with
+      rc_a_array.
+
+    Returns
+    -------
+    composed : ndarray
+      RC bitmasks for the relationships from A to C (zero where they
+      cannot be resolved).
+    """
+    return COMPOSITION[np.asarray(rc_a_array), np.asarray(rc_b_array)]
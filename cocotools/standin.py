@@ -0,0 +1,313 @@
+"""Local stand-in for the CoCoMac server.
+
+StandInServer answers the URLSearch.asp queries built by query.url, for
+whole BrainMaps and for areas of them, from records held by a
+StandInData object.  The records are either synthetic or taken from XML
+files saved from CoCoMac.  Latency, server errors, and timeouts can be
+set, so that ingests can be tested and timed offline.
+
+Examples
+--------
+>>> from cocotools import client
+>>> data = StandInData.synthetic()
+>>> server = StandInServer(data, latency=0.05, error_rate=0.01)
+>>> server.start()
+>>> client.COCOMAC_URL = server.url
+>>> ebunch, failures = multi_map_ebunch('Mapping', data.bmaps, workers=8)
+>>> server.stop()
+"""
+import BaseHTTPServer
+import SocketServer
+import random
+import re
+import threading
+import time
+import urlparse
+from xml.etree.cElementTree import iterparse, tostring
+
+from query import P, SPECS, PDC_HIER
+
+
+HEADER = """\
+SELECT  Top 32767  ID FROM StandIn
+<?xml version="1.0" encoding="UTF-8"?><CoCoMacExport \
+xmlns="http://www.cocomac.org">
+<Header>
+<Creator>CoCoMac stand-in</Creator>
+</Header>
+"""
+FOOTER = '</CoCoMacExport>\n'
+# Elements that hold the primary elements for each search type.
+CONTAINERS = {'Mapping': 'MapData', 'Connectivity': 'ProcessedConnectivityData'}
+
+
+#------------------------------------------------------------------------------
+# Data
+#------------------------------------------------------------------------------
+
+def _mapping_element(source, target, rng):
+    return """\
+<PrimaryRelation>
+<SourceBrainSite>
+<ID_BrainSite>%s</ID_BrainSite>
+</SourceBrainSite>
+<TargetBrainSite>
+<ID_BrainSite>%s</ID_BrainSite>
+</TargetBrainSite>
+<RC>%s</RC>
+<Reference>
+<ID_Literature>%s</ID_Literature>
+<TextPageNumber>%d</TextPageNumber>
+<PDC>%s</PDC>
+</Reference>
+</PrimaryRelation>
+""" % (source, target, rng.choice('SILO'), source.split('-')[0],
+       rng.randint(1, 500), rng.choice(PDC_HIER[:-1]))
+
+
+def _connectivity_element(source, target, rng):
+    sites = []
+    for site_tag, site in (('SourceSite', source), ('TargetSite', target)):
+        sites.append("""\
+<%s>
+<ID_BrainSite>%s</ID_BrainSite>
+<PDC_Site>%s</PDC_Site>
+<Extent>
+<EC>%s</EC>
+<PDC_EC>%s</PDC_EC>
+</Extent>
+</%s>
+""" % (site_tag, site, rng.choice(PDC_HIER[:-1]), rng.choice('CPXN'),
+       rng.choice(PDC_HIER[:-1]), site_tag))
+    return """\
+<IntegratedPrimaryProjection>
+%s%s<Density>
+<Degree>%d</Degree>
+<PDC_Density>%s</PDC_Density>
+</Density>
+</IntegratedPrimaryProjection>
+""" % (sites[0], sites[1], rng.randint(0, 3), rng.choice(PDC_HIER[:-1]))
+
+
+class StandInData(object):
+
+    """Records served by StandInServer.
+
+    Parameters
+    ----------
+    records : dict
+      Maps each search type to a list of (source, target, element)
+      tuples, where source and target are BrainSite IDs (<bmap>-<area>)
+      and element is the XML for a primary element.
+    """
+
+    def __init__(self, records):
+        self.records = records
+        self.areas = {}
+        for search_type_records in records.itervalues():
+            for source, target, element in search_type_records:
+                for site in (source, target):
+                    bmap, area = site.split('-', 1)
+                    areas = self.areas.setdefault(bmap, [])
+                    if area not in areas:
+                        areas.append(area)
+        self.bmaps = sorted(self.areas)
+
+    @classmethod
+    def synthetic(cls, n_maps=20, areas_per_map=12, records_per_map=50,
+                  seed=0):
+        """Make records relating the areas of n_maps BrainMaps.
+
+        Each BrainMap (SYN00, SYN01, ...) is the source of records_per_map
+        records of each search type, about half of them to other
+        BrainMaps, so the same record is returned for both of its
+        BrainMaps, as CoCoMac does.
+        """
+        rng = random.Random(seed)
+        bmaps = ['SYN%02d' % i for i in range(n_maps)]
+        sites = dict((bmap, ['%s-A%d' % (bmap, i) for i in
+                             range(areas_per_map)]) for bmap in bmaps)
+        records = {}
+        for search_type, make_element in (('Mapping', _mapping_element),
+                                          ('Connectivity',
+                                           _connectivity_element)):
+            records[search_type] = []
+            for bmap in bmaps:
+                for i in range(records_per_map):
+                    other = bmap if rng.random() < 0.5 else rng.choice(bmaps)
+                    source = rng.choice(sites[bmap])
+                    target = rng.choice(sites[other])
+                    records[search_type].append(
+                        (source, target, make_element(source, target, rng)))
+        return cls(records)
+
+    @classmethod
+    def from_files(cls, paths):
+        """Take records from XML saved from CoCoMac.
+
+        Parameters
+        ----------
+        paths : dict
+          Maps each search type to a list of paths to XML files.
+        """
+        records = {}
+        for search_type, search_type_paths in paths.iteritems():
+            records[search_type] = []
+            primtag = P.lstrip('./') + SPECS[search_type]['primtag']
+            for path in search_type_paths:
+                for event, e in iterparse(path):
+                    if e.tag != primtag:
+                        continue
+                    site_ids = [site_e.text for site_e in
+                                e.findall('%sID_BrainSite' % P)]
+                    # Serialize without the namespace prefix cElementTree
+                    # would add, so the element fits in our export.
+                    element = re.sub(r'(</?)ns0:', r'\1',
+                                     tostring(e).replace(
+                                         ' xmlns:ns0="http://www.cocomac.org"',
+                                         ''))
+                    records[search_type].append((site_ids[0], site_ids[1],
+                                                 element))
+        return cls(records)
+
+    def select(self, search_type, bmap, areas=()):
+        """Return the elements for records of bmap, restricted to areas if
+        any are given."""
+        sites = set('%s-%s' % (bmap, area) for area in areas)
+        prefix = bmap + '-'
+        elements = []
+        for source, target, element in self.records.get(search_type, ()):
+            if areas:
+                if source in sites or target in sites:
+                    elements.append(element)
+            elif source.startswith(prefix) or target.startswith(prefix):
+                elements.append(element)
+        return elements
+
+#------------------------------------------------------------------------------
+# Server
+#------------------------------------------------------------------------------
+
+def _parse_search_string(search_string):
+    """Return the BrainMap and areas named in a SearchString."""
+    bmap = re.search(r"\('([^']*)'\)\[SourceMap\]", search_string).group(1)
+    areas = re.findall(r"\('([^']*)'\)\[SourceSite\]", search_string)
+    return bmap, areas
+
+
+class _StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        parts = urlparse.urlsplit(self.path)
+        query = dict(urlparse.parse_qsl(parts.query))
+        search_type = query.get('Search')
+        try:
+            bmap, areas = _parse_search_string(query['SearchString'])
+        except (KeyError, AttributeError):
+            return self.reply(400, '')
+        with server.lock:
+            server.requests += 1
+            error = server.rng.random() < server.error_rate
+            stall = server.rng.random() < server.timeout_rate
+        time.sleep(server.latency)
+        if error:
+            with server.lock:
+                server.errors += 1
+            return self.reply(500, '')
+        elements = server.data.select(search_type, bmap, areas)
+        if stall or (server.max_records is not None and
+                     len(elements) > server.max_records):
+            # Keep the client waiting as the real server does when a
+            # query is too big for it.
+            with server.lock:
+                server.timeouts += 1
+            time.sleep(server.stall)
+        body = (HEADER + '<%s>\n' % CONTAINERS[search_type] +
+                ''.join(elements) + '</%s>\n' % CONTAINERS[search_type] +
+                FOOTER)
+        self.reply(200, body)
+
+    def reply(self, status, body):
+        try:
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except IOError:
+            # The client gave up waiting.
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    """HTTP server that answers CoCoMac queries from a StandInData.
+
+    Parameters
+    ----------
+    data : StandInData
+      Records to serve.
+
+    latency : number (optional)
+      Seconds to wait before answering each request.
+
+    error_rate : number (optional)
+      Fraction of requests answered with 500 Internal Server Error.
+
+    timeout_rate : number (optional)
+      Fraction of requests that stall for stall seconds before they are
+      answered, so that the client times out.
+
+    max_records : integer (optional)
+      Requests that would return more records than this stall too, as
+      queries for large BrainMaps do on the real server.  Default is no
+      limit.
+
+    stall : number (optional)
+      Seconds a stalled request waits; set it above the timeout of the
+      client.
+
+    seed : hashable (optional)
+      Seed for the choice of requests that fail.
+
+    Attributes
+    ----------
+    url : string
+      Value for client.COCOMAC_URL.
+
+    requests, errors, timeouts : integer
+      Counts of requests received, answered with an error, and stalled.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, data, latency=0, error_rate=0, timeout_rate=0,
+                 max_records=None, stall=5, seed=None,
+                 address=('127.0.0.1', 0)):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _StandInHandler)
+        self.data = data
+        self.latency = latency
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.max_records = max_records
+        self.stall = stall
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = self.errors = self.timeouts = 0
+        self.url = 'http://%s:%d/URLSearch.asp' % self.server_address
+
+    def start(self):
+        """Serve requests from a background thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
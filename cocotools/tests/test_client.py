@@ -0,0 +1,121 @@
+import BaseHTTPServer
+import SocketServer
+import socket
+import threading
+import time
+import urllib2
+from unittest import TestCase
+
+from testfixtures import Replacer
+import nose.tools as nt
+
+import cocotools.client as cc
+import cocotools.query as cq
+
+
+#------------------------------------------------------------------------------
+# Stand-in Server
+#------------------------------------------------------------------------------
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight,
+                                            self.server.in_flight)
+        time.sleep(self.server.delay)
+        with self.server.lock:
+            self.server.in_flight -= 1
+        if self.path.startswith('/missing'):
+            self.send_response(404)
+            body = ''
+        else:
+            self.send_response(200)
+            with open('cocotools/tests/sample_map.xml') as f:
+                body = 'SELECT junk ' + f.read()
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, delay=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           MockHandler)
+        self.lock = threading.Lock()
+        self.delay = delay
+        self.connections = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+#------------------------------------------------------------------------------
+# CoCoMacClient Tests
+#------------------------------------------------------------------------------
+
+class CoCoMacClientTestCase(TestCase):
+
+    def start_server(self, delay=0):
+        self.server = MockServer(delay)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.base = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reused(self):
+        self.start_server()
+        client = cc.CoCoMacClient()
+        for i in range(5):
+            self.assertTrue(client.get(self.base + '/URLSearch.asp?x=%d' % i)
+                            .startswith('SELECT junk <?xml'))
+        self.assertEqual(self.server.connections, 1)
+        client.close()
+
+    def test_max_per_host(self):
+        self.start_server(delay=0.05)
+        client = cc.CoCoMacClient(max_per_host=2)
+        threads = [threading.Thread(target=client.get, args=(self.base,))
+                   for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.server.max_in_flight, 2)
+        self.assertEqual(self.server.connections, 2)
+        client.close()
+
+    def test_timeout(self):
+        self.start_server(delay=0.5)
+        client = cc.CoCoMacClient(timeout=0.1)
+        self.assertRaises(socket.timeout, client.get, self.base)
+
+    def test_http_error(self):
+        self.start_server()
+        client = cc.CoCoMacClient()
+        self.assertRaises(urllib2.HTTPError, client.get, self.base + '/missing')
+
+    def test_query_cocomac(self):
+        self.start_server()
+        with Replacer() as r:
+            r.replace('cocotools.client.COCOMAC_URL', self.base +
+                      '/URLSearch.asp')
+            r.replace('cocotools.client.DEFAULT_CLIENT', cc.CoCoMacClient())
+            xml = cq.query_cocomac.func('Mapping', 'PP99')
+        self.assertTrue(xml.startswith('<?xml'))
@@ -1,3 +1,5 @@
+import pickle
+import random
 from unittest import TestCase
 
 from testfixtures import replace
@@ -5,13 +7,67 @@ from networkx import DiGraph
 import nose.tools as nt
 
 from cocotools import MapGraph, MapGraphError
+from cocotools.mapgraph import _cut_identity_loops
 
 
 # Not tested: _add_valid_edge, add_edge, add_edges_from, add_node,
-# add_nodes_from, deduce_edges, _resolve_contradiction,
-# _eliminate_contradictions, remove_nodes_from,
+# add_nodes_from, _resolve_contradiction, remove_nodes_from,
 # keep_only_one_level_of_resolution.
 
+#------------------------------------------------------------------------------
+# Helper Functions
+#------------------------------------------------------------------------------
+
+def synthetic_statements(n_maps, seed):
+    """Return statements, all true, relating regions of n_maps BrainMaps
+    that each divide the same line of atoms into consecutive regions.
+    Some BrainMaps divide it as an earlier one does."""
+    rng = random.Random(seed)
+    sites = {}
+    partitions = []
+    for i in range(n_maps):
+        if partitions and rng.random() < 0.5:
+            bounds = rng.choice(partitions)
+        else:
+            bounds = [0] + sorted(rng.sample(range(1, 40),
+                                             rng.randint(1, 4))) + [40]
+            partitions.append(bounds)
+        for j in range(len(bounds) - 1):
+            sites['A%02d-%d' % (i, j)] = frozenset(range(bounds[j],
+                                                         bounds[j + 1]))
+    nodes = sorted(sites)
+    statements = []
+    for i, source in enumerate(nodes):
+        for target in nodes[i + 1:]:
+            a, b = sites[source], sites[target]
+            if source[:3] == target[:3] or not a & b:
+                continue
+            if rng.random() < 0.5:
+                if a == b:
+                    rc = 'I'
+                elif a < b:
+                    rc = 'S'
+                elif a > b:
+                    rc = 'L'
+                else:
+                    rc = 'O'
+                statements.append((source, target,
+                                   {'RC': rc, 'PDC': rng.randint(0, 18)}))
+    return statements
+
+
+def single_pass_deduce(mapg):
+    """Deduce edges as deduce_edges once did, in one pass over the nodes
+    and without eliminating contradictions."""
+    for node in mapg.nodes_iter():
+        ebunch = []
+        for p in mapg.predecessors(node):
+            for s in mapg.successors(node):
+                tp = mapg[p][node]['TP'] + (node,) + mapg[node][s]['TP']
+                if mapg._from_different_maps(p, tp, s):
+                    ebunch.append((p, s, {'TP': tp}))
+        mapg.add_edges_from(ebunch)
+
 #------------------------------------------------------------------------------
 # Integration Tests
 #------------------------------------------------------------------------------
@@ -23,6 +79,259 @@ def test_clean_data():
     nt.assert_false(mapg.clean_data())
 
 
+def test_deduce_edges():
+    mapg = MapGraph()
+    mapg.add_edges_from([('A00-1', 'B00-1', {'RC': 'I', 'PDC': 3}),
+                         ('B00-1', 'C00-1', {'RC': 'S', 'PDC': 5}),
+                         ('C00-1', 'D00-1', {'RC': 'I', 'PDC': 1}),
+                         ('D00-1', 'E00-1', {'RC': 'L', 'PDC': 0}),
+                         # Shorter than A00-1 -> B00-1 -> C00-1 -> D00-1.
+                         ('A00-1', 'F00-1', {'RC': 'I', 'PDC': 9}),
+                         ('F00-1', 'D00-1', {'RC': 'S', 'PDC': 9}),
+                         ('A00-1', 'A00-2', {'RC': 'L', 'PDC': 0})])
+    report = mapg.deduce_edges()
+    nt.assert_equal(mapg['A00-1']['C00-1'], {'RC': 'S', 'PDC': 5,
+                                             'TP': ('B00-1',)})
+    nt.assert_equal(mapg['D00-1']['A00-1'], {'RC': 'L', 'PDC': 9,
+                                             'TP': ('F00-1',)})
+    nt.assert_equal(mapg['B00-1']['D00-1'], {'RC': 'S', 'PDC': 5,
+                                             'TP': ('C00-1',)})
+    # S then L cannot be resolved to a single RC.
+    nt.assert_false(mapg.has_edge('A00-1', 'E00-1'))
+    # Intra-map edges are never deduced.
+    nt.assert_false(mapg.has_edge('A00-2', 'F00-1'))
+    nt.assert_equal(report['rounds'], 2)
+    # The graph is at a fixpoint: another call changes nothing.
+    report = mapg.deduce_edges()
+    nt.assert_equal((report['rounds'], report['added'], report['improved']),
+                    (1, 0, 0))
+
+
+def test_deduce_edges_matches_repeated_single_pass():
+    # Where the statements agree, the result is that of repeating the
+    # single pass deduce_edges used to make until nothing changes.
+    for seed in range(8):
+        statements = synthetic_statements(6, seed)
+        mapg = MapGraph()
+        mapg.add_edges_from(statements)
+        mapg.deduce_edges()
+        old = MapGraph()
+        old.add_edges_from(statements)
+        edges = None
+        while edges != old.edge:
+            edges = pickle.loads(pickle.dumps(old.edge))
+            single_pass_deduce(old)
+        nt.assert_equal(sorted(mapg.edges()), sorted(old.edges()))
+        for source, target, attributes in mapg.edges_iter(data=True):
+            old_attributes = old[source][target]
+            nt.assert_equal((attributes['RC'], len(attributes['TP']),
+                             attributes['PDC']),
+                            (old_attributes['RC'], len(old_attributes['TP']),
+                             old_attributes['PDC']))
+
+
+def test_eliminate_contradictions_order():
+    statements = [('SYN00-0', 'SYN01-0', {'PDC': 18, 'RC': 'S'}),
+                  ('SYN00-0', 'SYN01-1', {'PDC': 17, 'RC': 'O'}),
+                  ('SYN00-1', 'SYN01-1', {'PDC': 6, 'RC': 'L'}),
+                  ('SYN00-1', 'SYN02-1', {'PDC': 13, 'RC': 'S'}),
+                  ('SYN00-2', 'SYN01-2', {'PDC': 14, 'RC': 'S'}),
+                  ('SYN00-2', 'SYN02-1', {'PDC': 17, 'RC': 'S'}),
+                  ('SYN01-0', 'SYN02-0', {'PDC': 6, 'RC': 'S'}),
+                  ('SYN01-1', 'SYN02-0', {'PDC': 4, 'RC': 'O'}),
+                  ('SYN01-1', 'SYN02-1', {'PDC': 17, 'RC': 'O'})]
+    results = []
+    for order in (sorted, lambda nodes: sorted(nodes, reverse=True)):
+        mapg = MapGraph()
+        mapg.add_edges_from(statements)
+        mapg._deduce(False, False)
+        mapg._eliminate_contradictions(order(mapg.nodes()))
+        results.append(mapg.edge)
+    # Nodes are taken in sorted order whatever order they are given in.
+    # Resolving the contradictions at SYN00-0 first removes its edge to
+    # SYN01-0, which taking SYN01-1 first (as the order of nodes_iter
+    # once might) would have kept.
+    nt.assert_equal(results[0], results[1])
+    nt.assert_false(mapg.has_edge('SYN00-0', 'SYN01-0'))
+    nt.assert_equal(mapg['SYN00-0']['SYN02-0']['RC'], 'S')
+
+
+def test_deduce_edges_best_first():
+    edges = [('A00-1', 'B00-1', {'RC': 'I', 'PDC': 3}),
+             ('B00-1', 'C00-1', {'RC': 'S', 'PDC': 5}),
+             ('C00-1', 'D00-1', {'RC': 'I', 'PDC': 1}),
+             ('D00-1', 'E00-1', {'RC': 'L', 'PDC': 0}),
+             ('A00-1', 'F00-1', {'RC': 'I', 'PDC': 9}),
+             ('F00-1', 'D00-1', {'RC': 'S', 'PDC': 9}),
+             ('A00-1', 'A00-2', {'RC': 'L', 'PDC': 0})]
+    mapg = MapGraph()
+    mapg.add_edges_from(edges)
+    report = mapg.deduce_edges(best_first=True)
+    # Each edge is written once, with its best TP.
+    nt.assert_equal(report['improved'], 0)
+    nt.assert_equal(mapg['D00-1']['A00-1'], {'RC': 'L', 'PDC': 9,
+                                             'TP': ('F00-1',)})
+    worklist = MapGraph()
+    worklist.add_edges_from(edges)
+    worklist.deduce_edges()
+    nt.assert_equal(mapg.edge, worklist.edge)
+    # The result is a fixpoint of the worklist as well.
+    report = mapg.deduce_edges()
+    nt.assert_equal((report['added'], report['improved']), (0, 0))
+
+
+def test_deduce_edges_collapse_identities():
+    edges = [('A00-1', 'B00-1', {'RC': 'I', 'PDC': 0}),
+             ('C00-1', 'B00-1', {'RC': 'I', 'PDC': 2}),
+             # Not collapsed, as B00-1 is identical to a region of its
+             # BrainMap by a better PDC.
+             ('B00-1', 'C00-2', {'RC': 'I', 'PDC': 5}),
+             ('A00-1', 'D00-1', {'RC': 'S', 'PDC': 1}),
+             ('D00-1', 'E00-1', {'RC': 'S', 'PDC': 3}),
+             ('C00-1', 'F00-1', {'RC': 'L', 'PDC': 4})]
+    mapg = MapGraph()
+    mapg.add_edges_from(edges)
+    nt.assert_equal(mapg._identity_classes(),
+                    {'A00-1': ('A00-1',), 'B00-1': ('B00-1', 'A00-1'),
+                     'C00-1': ('C00-1', 'B00-1', 'A00-1')})
+    report = mapg.deduce_edges(collapse_identities=True)
+    nt.assert_equal(report['collapsed'], 2)
+    nt.assert_equal(mapg['C00-1']['A00-1'], {'RC': 'I', 'PDC': 2,
+                                             'TP': ('B00-1',)})
+    nt.assert_equal(mapg['B00-1']['E00-1'], {'RC': 'S', 'PDC': 3,
+                                             'TP': ('A00-1', 'D00-1')})
+    nt.assert_equal(mapg['F00-1']['B00-1'], {'RC': 'S', 'PDC': 4,
+                                             'TP': ('C00-1',)})
+    # The same edges are deduced without collapsing.
+    plain = MapGraph()
+    plain.add_edges_from(edges)
+    plain.deduce_edges()
+    nt.assert_equal(mapg.edge, plain.edge)
+
+
+def test_deduce_edges_collapse_identities_shortest_tps():
+    # The tree of the class runs A00-1, B00-1, C00-1, D00-1, but B00-1 is
+    # identical to D00-1 directly, and E00-1 and G00-1 are reached
+    # through D00-1 and F00-1 rather than through A00-1.
+    edges = [('A00-1', 'B00-1', {'RC': 'I', 'PDC': 0}),
+             ('B00-1', 'C00-1', {'RC': 'I', 'PDC': 0}),
+             ('C00-1', 'D00-1', {'RC': 'I', 'PDC': 0}),
+             ('B00-1', 'D00-1', {'RC': 'I', 'PDC': 9}),
+             ('D00-1', 'E00-1', {'RC': 'S', 'PDC': 3}),
+             ('F00-1', 'B00-1', {'RC': 'I', 'PDC': 1}),
+             ('F00-1', 'G00-1', {'RC': 'O', 'PDC': 2})]
+    for best_first in (False, True):
+        mapg = MapGraph()
+        mapg.add_edges_from(edges)
+        mapg.deduce_edges(collapse_identities=True, best_first=best_first)
+        nt.assert_equal(mapg['A00-1']['D00-1'], {'RC': 'I', 'PDC': 9,
+                                                 'TP': ('B00-1',)})
+        nt.assert_equal(mapg['B00-1']['E00-1'], {'RC': 'S', 'PDC': 9,
+                                                 'TP': ('D00-1',)})
+        plain = MapGraph()
+        plain.add_edges_from(edges)
+        plain.deduce_edges(best_first=best_first)
+        nt.assert_equal(mapg.edge, plain.edge)
+
+
+def test_deduce_edges_in_parallel():
+    edges = [('A00-1', 'B00-1', {'RC': 'I', 'PDC': 3}),
+             ('B00-1', 'C00-1', {'RC': 'S', 'PDC': 5}),
+             ('C00-1', 'D00-1', {'RC': 'I', 'PDC': 1}),
+             ('C00-1', 'D00-2', {'RC': 'O', 'PDC': 7}),
+             ('G00-1', 'H00-1', {'RC': 'L', 'PDC': 2}),
+             ('H00-1', 'J00-1', {'RC': 'I', 'PDC': 1}),
+             ('J00-1', 'K00-1', {'RC': 'L', 'PDC': 0}),
+             ('K00-1', 'L00-1', {'RC': 'O', 'PDC': 0}),
+             ('M00-1', 'N00-1', {'RC': 'I', 'PDC': 0})]
+    # Components of two nodes are not sent to the pool, but are still
+    # counted in the report, even when there are no others.
+    for edges in (edges, edges[-1:]):
+        for collapse_identities in (False, True):
+            for best_first in (False, True):
+                serial = MapGraph()
+                serial.add_edges_from(edges)
+                serial_report = serial.deduce_edges(collapse_identities,
+                                                    best_first=best_first)
+                parallel = MapGraph()
+                parallel.add_edges_from(reversed(edges))
+                report = parallel.deduce_edges(collapse_identities,
+                                               processes=2,
+                                               best_first=best_first)
+                nt.assert_equal(parallel.edge, serial.edge)
+                nt.assert_equal(report, serial_report)
+
+
+def test_add_edges_incremental():
+    edges = [('A00-1', 'B00-1', {'RC': 'I', 'PDC': 3}),
+             ('B00-1', 'C00-1', {'RC': 'S', 'PDC': 5}),
+             ('C00-1', 'D00-1', {'RC': 'I', 'PDC': 1}),
+             ('F00-1', 'G00-1', {'RC': 'L', 'PDC': 0})]
+    new_edges = [('D00-1', 'E00-1', {'RC': 'I', 'PDC': 0}),
+                 # Implies that E00-1 overlaps both C00-1 and C00-2.
+                 ('E00-1', 'C00-2', {'RC': 'S', 'PDC': 9}),
+                 # Worse than the edge already in the graph.
+                 ('B00-1', 'C00-1', {'RC': 'S', 'PDC': 8})]
+    mapg = MapGraph()
+    mapg.add_edges_from(edges)
+    mapg.deduce_edges()
+    report = mapg.add_edges_incremental(new_edges)
+    nt.assert_equal(mapg['A00-1']['E00-1'], {'RC': 'S', 'PDC': 5,
+                                             'TP': ('B00-1', 'C00-1',
+                                                    'D00-1')})
+    nt.assert_equal(mapg['B00-1']['C00-1'], {'RC': 'S', 'PDC': 5,
+                                             'TP': ()})
+    nt.assert_false(mapg.has_edge('E00-1', 'C00-2'))
+    # E00-1 to C00-2 is removed, along with D00-1 to C00-2 through it.
+    nt.assert_equal((report['improved'], report['removed']), (0, 2))
+    # The same graph results from deducing everything at once.
+    full = MapGraph()
+    full.add_edges_from(edges + new_edges)
+    full.deduce_edges()
+    nt.assert_equal(mapg.edge, full.edge)
+
+
+def test_add_edges_incremental_conflicting():
+    # A00-1 cannot be identical to C00-1 and overlap C00-2, so the
+    # overlap is removed.
+    edges = [('A00-1', 'C00-1', {'RC': 'I', 'PDC': 11}),
+             ('B00-1', 'C00-2', {'RC': 'I', 'PDC': 6}),
+             ('A00-1', 'C00-2', {'RC': 'O', 'PDC': 14})]
+    # Implies that A00-1 is larger than C00-2, which outweighs the
+    # identity with C00-1.
+    new_edges = [('A00-1', 'B00-1', {'RC': 'L', 'PDC': 0})]
+    mapg = MapGraph()
+    mapg.add_edges_from(edges)
+    nt.assert_equal(mapg.deduce_edges()['removed'], 1)
+    report = mapg.add_edges_incremental(new_edges)
+    nt.assert_equal(report['removed'], 2)
+    nt.assert_equal(mapg['A00-1']['C00-2'], {'RC': 'L', 'PDC': 6,
+                                             'TP': ('B00-1',)})
+    nt.assert_false(mapg.has_edge('A00-1', 'C00-1'))
+    # Deducing everything at once, the statement that A00-1 overlaps
+    # C00-2 is still there to be weighed against the identity, which is
+    # kept.
+    full = MapGraph()
+    full.add_edges_from(edges + new_edges)
+    full.deduce_edges()
+    nt.assert_equal(full['A00-1']['C00-1'], {'RC': 'I', 'PDC': 11,
+                                             'TP': ()})
+    nt.assert_false(full.has_edge('A00-1', 'C00-2'))
+
+
+def test_cut_identity_loops():
+    chains = {'A00-1': ('A00-1',), 'B00-1': ('B00-1', 'A00-1'),
+              'C00-1': ('C00-1', 'A00-1')}
+    nt.assert_equal(_cut_identity_loops(('X00-1', 'B00-1', 'A00-1', 'B00-1',
+                                         'Y00-1'), chains),
+                    ('X00-1', 'B00-1', 'Y00-1'))
+    nt.assert_equal(_cut_identity_loops(('B00-1', 'A00-1', 'C00-1'), chains),
+                    ('B00-1', 'A00-1', 'C00-1'))
+    # X00-1 is not identical to B00-1.
+    nt.assert_equal(_cut_identity_loops(('B00-1', 'X00-1', 'B00-1'), chains),
+                    None)
+
+
 class TransferDataTestCase(TestCase):
 
     def setUp(self):
@@ -79,6 +388,8 @@ def test_edge_removal():
                               ('E-1', 'F-1', {'TP': ['D-1', 'C-1', 'G-1']}),
                               ('F-1', 'E-1', {'TP': ['G-1', 'C-1', 'D-1']}),
                               ('G-1', 'H-1', {'TP': []})])
+    mock_mapp._build_map_index()
+    mock_mapp._build_tp_index()
     mock_mapp.remove_edges_from([('A-1', 'B-1')])
     nt.assert_equal(mock_mapp.edges(), [('G-1', 'H-1')])
 
@@ -141,6 +452,7 @@ def test_find_partial_coverage():
                          ('B-1', 'D-1', {'RC': 'L'}),
                          ('D-2', 'B-1', {'RC': 'O'}),
                          ('B-1', 'D-2', {'RC': 'O'})])
+    mapp._build_map_index()
     # A has partial coverage of B, and B has partial coverage of D.
     nt.assert_equal(MapGraph.find_partial_coverage.im_func(mapp),
                     [('B-1', 'D-2'), ('A-1', 'B-1')])
@@ -153,15 +465,13 @@ def test_summate_connections():
     mock_cong = DiGraph()
     mock_cong.add_edges_from([('A-1', 'B-3'), ('B-2', 'A-1'), ('A-2', 'B-2'),
                               ('C-3', 'B-1'), ('D-1', 'D-2')])
-    mock_mapg = DiGraph()
-    mock_mapg.add_edges_from([('A-1', 'B-1', {'RC': 'I'}),
-                              ('A-1', 'C-1', {'RC': 'S'}),
-                              ('A-2', 'D-1', {'RC': 'L'}),
-                              ('A-2', 'E-1', {'RC': 'O'})])
-    mock_mapg.cong = mock_cong
-    nt.assert_equal(MapGraph._summate_connections.im_func(mock_mapg,
-                                                          ['A-1', 'A-2']),
-                    4)
+    mapg = MapGraph()
+    for source, target, rc in [('A-1', 'B-1', 'I'), ('A-1', 'C-1', 'S'),
+                               ('A-2', 'D-1', 'L'), ('A-2', 'E-1', 'O'),
+                               ('A-2', 'A-3', 'I')]:
+        mapg._add_edge_and_its_reverse(source, target, rc, 0, [])
+    mapg.cong = mock_cong
+    nt.assert_equal(mapg._summate_connections(['A-1', 'A-2']), 4)
 
     
 def test_get_worst_pdc():
@@ -196,11 +506,58 @@ def test_organize_by_rc():
 
 
 def test_organize_neighbors_by_map():
-    mock_mapp = DiGraph()
-    mock_mapp.add_edges_from([('A-1', 'B-1'), ('A-1', 'B-2'), ('A-1', 'C-3'),
-                              ('A-1', 'D-3')])
-    result = MapGraph._organize_neighbors_by_map.im_func(mock_mapp, 'A-1')
-    nt.assert_equal(result, {'B': ['B-2', 'B-1'], 'C': ['C-3'], 'D': ['D-3']})
+    mapp = MapGraph()
+    for target in ('B-1', 'B-2', 'C-3', 'D-3'):
+        mapp._add_edge_and_its_reverse('A-1', target, 'I', 0, [])
+    result = mapp._organize_neighbors_by_map('A-1')
+    result['B'].sort()
+    nt.assert_equal(result, {'B': ['B-1', 'B-2'], 'C': ['C-3'], 'D': ['D-3']})
+    nt.assert_equal(mapp._organize_neighbors_by_map('B-1'), {'A': ['A-1']})
+    # The index follows removals.
+    mapp.remove_edge('A-1', 'C-3')
+    mapp.remove_node('B-2')
+    nt.assert_equal(mapp._organize_neighbors_by_map('A-1'), {'B': ['B-1'],
+                                                              'D': ['D-3']})
+    nt.assert_equal(mapp._map_nodes, {'A': set(['A-1']), 'B': set(['B-1']),
+                                      'C': set(['C-3']), 'D': set(['D-3'])})
+
+
+def test_tp_index():
+    mapp = MapGraph()
+    mapp._add_edge_and_its_reverse('A-1', 'D-1', 'I', 0, ['B-1', 'C-1'])
+    nt.assert_equal(mapp._tp_by_pair, {('B-1', 'C-1'): set([('A-1', 'D-1'),
+                                                            ('D-1', 'A-1')])})
+    nt.assert_equal(mapp._tp_by_node['B-1'], set([('A-1', 'D-1'),
+                                                  ('D-1', 'A-1')]))
+    # Replacing the attributes of an edge replaces its entries.
+    mapp._add_edge_and_its_reverse('A-1', 'D-1', 'I', 0, ['E-1'])
+    nt.assert_equal(mapp._tp_by_pair, {})
+    nt.assert_equal(sorted(mapp._tp_by_node), ['E-1'])
+    # The old TPs are no longer interned.
+    nt.assert_equal(mapp._tps, {('E-1',): ('E-1',)})
+    nt.assert_equal(mapp._tp_uses, {('E-1',): 2})
+    mapp._add_edge_and_its_reverse('E-1', 'F-1', 'I', 0, ['A-1', 'D-1'])
+    mapp._add_edge_and_its_reverse('G-1', 'H-1', 'I', 0, ['E-1', 'F-1'])
+    # Removing E-1 removes (A-1, D-1), which supports (E-1, F-1), which
+    # supports (G-1, H-1).
+    mapp.remove_node('E-1')
+    nt.assert_equal(mapp.edges(), [])
+    nt.assert_equal((mapp._tp_by_node, mapp._tp_by_pair), ({}, {}))
+    nt.assert_equal((mapp._tps, mapp._tp_uses), ({}, {}))
+
+
+def test_map_index_survives_pickling():
+    mapp = MapGraph()
+    mapp._add_edge_and_its_reverse('A-1', 'B-1', 'I', 0, [])
+    copied = pickle.loads(pickle.dumps(mapp))
+    nt.assert_equal(copied._map_neighbors, mapp._map_neighbors)
+    # Graphs pickled before the index was introduced get one.
+    state = mapp.__dict__.copy()
+    for name in ('_node_map', '_map_nodes', '_map_neighbors'):
+        del state[name]
+    old = MapGraph.__new__(MapGraph)
+    old.__setstate__(state)
+    nt.assert_equal(old._map_neighbors, mapp._map_neighbors)
 
 
 class RemoveLevelFromHierarchyTestCase(TestCase):
@@ -225,12 +582,14 @@ class RemoveLevelFromHierarchyTestCase(TestCase):
 
 
 def test_remove_node():
-    mock_mapp = DiGraph()
-    mock_mapp.add_node('X')
-    mock_mapp.add_edges_from([('A', 'B', {'TP': ['X']}),
-                              ('B', 'C', {'TP': ['Y']})])
-    MapGraph.remove_node.im_func(mock_mapp, 'X')
-    nt.assert_equal(mock_mapp.edges(), [('B', 'C')])
+    mapp = MapGraph()
+    mapp.add_node('X00-1')
+    mapp._add_edge_and_its_reverse('A00-1', 'B00-1', 'I', 0, ['X00-1'])
+    mapp._add_edge_and_its_reverse('B00-1', 'C00-1', 'I', 0, ['Y00-1'])
+    mapp.remove_node('X00-1')
+    nt.assert_equal(sorted(mapp.edges()), [('B00-1', 'C00-1'),
+                                           ('C00-1', 'B00-1')])
+    nt.assert_false(mapp._map_nodes.has_key('X00'))
 
 
 def test_find_bottom_of_hierarchy():
@@ -271,6 +630,7 @@ def test_merge_identical_nodes():
                          ('A-1', 'B-1', {'RC': 'I', 'PDC': 7}),
                          ('A-1', 'C-1', {'RC': 'L', 'PDC': 10}),
                          ('A-1', 'A-2', {'RC': 'I', 'PDC': 12})])
+    mapp._build_map_index()
     mapp.cong = mock_conn
     mapp._merge_identical_nodes('A-2', 'A-1')
     nt.assert_equal(mapp.cong.edges(), [('A-2', 'A-5'), ('A-4', 'A-2')])
@@ -318,13 +678,20 @@ def test_new_attributes_are_better():
 
     
 def test_add_edge_and_its_reverse():
-    mock_g = DiGraph()
-    MapGraph._add_edge_and_its_reverse.im_func(mock_g, 'A', 'B', 'S', 0,
-                                                  ['C', 'D'])
+    mock_g = MapGraph()
+    tp = ['C', 'D']
+    mock_g._add_edge_and_its_reverse('A', 'B', 'S', 0, tp)
     nt.assert_equal(mock_g.edge, {'A': {'B': {'RC': 'S', 'PDC': 0,
-                                              'TP': ['C', 'D']}},
+                                              'TP': ('C', 'D')}},
                                   'B': {'A': {'RC': 'L', 'PDC': 0,
-                                              'TP': ['D', 'C']}}})
+                                              'TP': ('D', 'C')}}})
+    # Changing the list supplied does not change the graph.
+    tp.reverse()
+    nt.assert_equal(mock_g['A']['B']['TP'], ('C', 'D'))
+    # Equal TPs are shared.
+    mock_g._add_edge_and_its_reverse('E', 'F', 'I', 0, ['C'])
+    mock_g._add_edge_and_its_reverse('G', 'H', 'I', 0, ['C'])
+    nt.assert_true(mock_g['E']['F']['TP'] is mock_g['H']['G']['TP'])
 
     
 def test_get_worst_pdc_in_tp():
@@ -367,6 +734,6 @@ def test_check_nodes():
 
 
 def test_from_different_maps():
-    method = MapGraph._from_different_maps.im_func
-    nt.assert_true(method(None, 'A-1', ['B-1', 'C-1'], 'D-1'))
-    nt.assert_false(method(None, 'A-1', ['B-1', 'D-1'], 'D-1'))
+    method = MapGraph()._from_different_maps
+    nt.assert_true(method('A-1', ['B-1', 'C-1'], 'D-1'))
+    nt.assert_false(method('A-1', ['B-1', 'D-1'], 'D-1'))
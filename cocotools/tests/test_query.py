@@ -1,5 +1,17 @@
+import itertools
+import os
+import re
+import shutil
 import sqlite3
+import tempfile
+import threading
+import time
+import urllib2
+import urlparse
 import xml.etree.ElementTree as etree
+from cStringIO import StringIO
+from socket import timeout
+from xml.etree.cElementTree import iterparse
 from testfixtures import replace, Replacer
 from unittest import TestCase
 
@@ -12,6 +24,30 @@ import cocotools.query as cq
 # Mock Functions
 #------------------------------------------------------------------------------
 
+def replace_cache(r):
+    """Use r, a Replacer, to point cocotools.query at a new in-memory cache,
+    so that tests leave the cache in ~/.cache alone.  Return the cache."""
+    r.replace('cocotools.query.DBPATH', ':memory:')
+    cache = cq._CoCoLite(cq.query_cocomac.func)
+    r.replace('cocotools.query.query_cocomac', cache)
+    # These were bound to the cache when they were decorated.
+    r.replace('cocotools.query._map_records.xml_cache', cache)
+    r.replace('cocotools.query._parse_cached_xml.xml_cache', cache)
+    r.replace('cocotools.query.ingest_journal', cq._IngestJournal(cache))
+    return cache
+
+
+def in_memory_cache(test):
+    """Decorate test to run with replace_cache.  Put it above decorators
+    that replace _map_records, so that the cache is replaced first."""
+    def wrapper():
+        with Replacer() as r:
+            replace_cache(r)
+            test()
+    wrapper.__name__ = test.__name__
+    return wrapper
+
+
 def mock__scrub_element(e, attr_tag):
     return 'X'
 
@@ -24,6 +60,15 @@ def mock__scrub_xml_str(xml):
     return xml[:10]
 
 
+def mock__get(url):
+    assert url == 'http://www.google.com'
+    return '<!doctype html><html></html>'
+
+
+def mock_failing__get(url):
+    raise urllib2.URLError('connection refused')
+
+
 def mock_func(search_type, bmap):
     if search_type and bmap:
         return 'xml %s %s xml' % (search_type, bmap)
@@ -33,13 +78,7 @@ def mock_func(search_type, bmap):
 def mock_query_cocomac(search_type, bmap):
     assert search_type == 'Mapping'
     assert bmap == 'A'
-    return 'X'
-
-
-def mock__element_tree(xml):
-    tree = etree.parse(open('cocotools/tests/sample_map.xml'))
-    assert isinstance(tree, etree.ElementTree)
-    return tree
+    return open('cocotools/tests/sample_map.xml').read()
 
 
 def mock__element2edge(prim_e, search_type):
@@ -47,9 +86,78 @@ def mock__element2edge(prim_e, search_type):
     return ('node', 'node', 'edge_attr')
 
 
-def mock_single_map_ebunch(search_type, bmap):
+# Keys for records returned by the mocks of _map_records, new for every
+# call unless given.
+record_keys = itertools.count()
+
+
+def mock__map_records(search_type, bmap, seen=()):
     if bmap in ('A', 'C', 'PP99'):
-        return [('node', 'node', 'edge_attr'), ('node', 'node', 'edge_attr')]
+        return [(record_keys.next(), ('node', 'node', 'edge_attr')),
+                (record_keys.next(), ('node', 'node', 'edge_attr'))]
+
+
+def mock_slow__map_records(search_type, bmap, seen=()):
+    # Later BrainMaps finish first, to check that output order does not
+    # depend on the order in which the queries complete.
+    time.sleep(0.01 * (4 - 'ABCD'.index(bmap)))
+    if bmap in ('A', 'C'):
+        return [(record_keys.next(), (bmap, 'node', 'edge_attr'))]
+
+
+def mock_shared__map_records(search_type, bmap, seen=()):
+    # A and B share the record for the relation between them.
+    edges = {'A': [('A-1', 'A-2'), ('A-1', 'B-1')],
+             'B': [('A-1', 'B-1'), ('B-1', 'B-2')],
+             'C': [('C-1', 'C-2')]}
+    return [(edge, edge + ('edge_attr',)) for edge in edges[bmap]]
+
+
+class MockFlakyMapRecords(object):
+
+    """Stand-in for _map_records whose queries for A fail twice, for B fail
+    for good, and for C are refused by the server."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, search_type, bmap, seen=()):
+        self.calls.append(bmap)
+        if bmap == 'A' and self.calls.count('A') <= 2:
+            raise urllib2.URLError('connection reset')
+        if bmap == 'B':
+            raise urllib2.URLError('connection refused')
+        if bmap == 'C':
+            raise urllib2.HTTPError('url', 404, 'Not Found', None, None)
+        if bmap != 'D':
+            return [(record_keys.next(), (bmap, 'node', 'edge_attr'))]
+
+
+class MockClient(object):
+
+    """Stand-in for client.DEFAULT_CLIENT that times out on queries for
+    whole BrainMaps and for more than two areas."""
+
+    def __init__(self):
+        self.searches = []
+
+    def get(self, url):
+        query = urlparse.parse_qs(urlparse.urlsplit(url).query)
+        search_string = query['SearchString'][0]
+        self.searches.append(search_string)
+        areas = re.findall(r"\('([^']*)'\)\[SourceSite\]", search_string)
+        if len(areas) not in (1, 2):
+            raise timeout
+        # Keep only the primary relations for the areas queried.
+        tree = etree.parse('cocotools/tests/sample_map.xml')
+        for parent in tree.getiterator():
+            for prim_e in parent.findall('{http://www.cocomac.org}'
+                                         'PrimaryRelation'):
+                sites = [site_e.text.split('-', 1)[1] for site_e in
+                         prim_e.findall('%sID_BrainSite' % cq.P)]
+                if not set(sites) & set(areas):
+                    parent.remove(prim_e)
+        return 'junk <?xml version="1.0"?>' + etree.tostring(tree.getroot())
 
 #------------------------------------------------------------------------------
 # Private Function Unit Tests
@@ -125,10 +233,100 @@ def test__element2edge():
     nt.assert_equal(element2edge(prim_e, 'Connectivity'), edge)
 
 
-def test_element_tree():
+def test_iter_edges():
+    for search_type, path in (('Mapping', 'cocotools/tests/sample_map.xml'),
+                              ('Connectivity',
+                               'cocotools/tests/sample_con.xml')):
+        tree = etree.parse(open(path))
+        primtag = '%s%s' % (cq.P, cq.SPECS[search_type]['primtag'])
+        expected = [cq._element2edge(prim, search_type) for prim in
+                    tree.iterfind(primtag)]
+        edges = cq._iter_edges(open(path), search_type)
+        nt.assert_true(expected)
+        nt.assert_equal(list(edges), expected)
+
+
+def test_iter_edges_releases_elements():
     xml = open('cocotools/tests/sample_map.xml').read()
-    nt.assert_true(isinstance(cq._element_tree(xml), etree.ElementTree))
-    
+    head, tail = xml.split('</MapData>')
+    prim = head[head.index('<PrimaryRelation>'):]
+    big_xml = head + prim * 200 + '</MapData>' + tail
+    map_data = []
+    def mock_iterparse(source, events):
+        for event, e in iterparse(source, events):
+            if event == 'start' and e.tag.endswith('MapData'):
+                map_data.append(e)
+            yield event, e
+    with Replacer() as r:
+        r.replace('cocotools.query.iterparse', mock_iterparse)
+        n_edges = 0
+        held = []
+        for edge in cq._iter_edges(StringIO(big_xml), 'Mapping'):
+            held.append(len(map_data[0]))
+            n_edges += 1
+    nt.assert_equal(n_edges, 804)
+    # Only elements the parser has read ahead are held, however long
+    # the document.
+    nt.assert_true(max(held) < 50)
+    nt.assert_equal(len(map_data[0]), 0)
+
+
+def test_query_stats():
+    stats = cq._QueryStats()
+    for seconds in (0.001, 0.02, 0.02, 5, 1000):
+        stats.record_request(seconds, 10)
+    stats.count('hits', 3)
+    stats.record_parse('Mapping', 'A', 100, 0.5, 7)
+    snapshot = stats.snapshot()
+    nt.assert_equal(snapshot['latency'],
+                    [(0.01, 1), (0.03, 2), (0.1, 0), (0.3, 0), (1, 0), (3, 0),
+                     (10, 1), (30, 0), (100, 0), (None, 1)])
+    nt.assert_equal((snapshot['requests'], snapshot['bytes'],
+                     snapshot['hits']), (5, 50, 3))
+    nt.assert_equal(snapshot['parses'], {('Mapping', 'A'): {
+        'xml_bytes': 100, 'parse_seconds': 0.5, 'records': 7}})
+    nt.assert_true('> 100s: 1' in stats.summary())
+    stats.reset()
+    nt.assert_equal(stats.snapshot()['requests'], 0)
+
+
+def test_split_by_area():
+    xml = open('cocotools/tests/sample_map.xml').read()
+    entries = cq._split_by_area('Mapping', 'PP99', ['19', '23', 'TEO', 'XX'],
+                                xml)
+    nt.assert_equal([key for search_type, key, area_xml in entries],
+                    ['PP99-19', 'PP99-23', 'PP99-TEO'])
+    # The element for PP99-TF names none of the areas, so it goes to the
+    # first.
+    edges = [list(cq._iter_edges(StringIO(area_xml), 'Mapping')) for
+             search_type, key, area_xml in entries]
+    nt.assert_equal([[edge[:2] for edge in area_edges] for area_edges in
+                     edges], [[('B05-19', 'PP99-19'), ('BB47-TF', 'PP99-TF')],
+                              [('B05-23', 'PP99-23')],
+                              [('BB47-TEO', 'PP99-TEO')]])
+    nt.assert_equal(sorted(sum(edges, [])),
+                    sorted(cq._iter_edges(StringIO(xml), 'Mapping')))
+    # XML for a single area is stored as it is.
+    nt.assert_equal(cq._split_by_area('Mapping', 'PP99', ['19'], xml),
+                    [('Mapping', 'PP99-19', xml)])
+
+
+def test_next_batch():
+    areas = ['%d' % i for i in range(40)]
+    nt.assert_equal(cq._next_batch('Mapping', 'PP99', areas[:10]), 10)
+    # The default budget does not allow a URL naming all 40.
+    nt.assert_true(cq._next_batch('Mapping', 'PP99', areas) < 40)
+    with Replacer() as r:
+        r.replace('cocotools.query.MAX_URL_LENGTH',
+                  len(cq.url('Mapping', 'PP99', areas[:3])))
+        nt.assert_equal(cq._next_batch('Mapping', 'PP99', areas), 3)
+        r.replace('cocotools.query.MAX_RESPONSE_BYTES', 1000)
+        nt.assert_equal(cq._next_batch('Mapping', 'PP99', areas, 400.0), 2)
+        # One area is named however little fits.
+        nt.assert_equal(cq._next_batch('Mapping', 'PP99', areas, 4000.0), 1)
+        r.replace('cocotools.query.MAX_URL_LENGTH', 0)
+        nt.assert_equal(cq._next_batch('Mapping', 'PP99', areas), 1)
+
 
 def test_scrub_xml_str():
     scrub_xml_str = cq._scrub_xml_str
@@ -148,12 +346,35 @@ def test_scrub_xml_str():
     for text, valid in zip(texts, valids):
         nt.assert_equal(scrub_xml_str(text), valid)
 
+
+def test_xml_scrubber():
+    with open('cocotools/tests/sample_map.xml') as f:
+        xml = f.read()
+    raw = 'SELECT  Top 32767  \xb4' + xml.replace('\n', '\r\n')
+    expected = cq._scrub_xml_str(raw)
+    nt.assert_equal(expected, xml)
+    # The header can be split across chunks.
+    for size in (1, 3, 100, len(raw)):
+        scrubber = cq._XMLScrubber()
+        chunks = [scrubber.feed(raw[i:i + size]) for i in
+                  range(0, len(raw), size)]
+        scrubber.close()
+        nt.assert_equal(''.join(chunks), expected)
+    scrubber = cq._XMLScrubber()
+    nt.assert_equal(scrubber.feed('SELECT <?xml version="1.0"'), '')
+    nt.assert_raises(ValueError, scrubber.close)
+    # A scrubber can be parsed from directly.
+    edges = list(cq._iter_edges(cq._XMLScrubber(StringIO(raw)), 'Mapping'))
+    nt.assert_equal(edges, list(cq._iter_edges(StringIO(xml), 'Mapping')))
+    nt.assert_raises(ValueError, cq._XMLScrubber(StringIO('junk')).read)
+
 #------------------------------------------------------------------------------
 # _CoCoLite and query_cocomac Tests
 #------------------------------------------------------------------------------
 
 @replace('cocotools.query.url', mock_url)
 @replace('cocotools.query._scrub_xml_str', mock__scrub_xml_str)
+@replace('cocotools.query._get', mock__get)
 def test_query_cocomac():
     # query_cocomac has been decorated.  Test __init__ and
     # setup_connection.
@@ -161,6 +382,14 @@ def test_query_cocomac():
     # But the undecorated function can be used within the decorated one.
     undecorated = cq.query_cocomac.func
     nt.assert_equal(undecorated(None, None), '<!doctype ')
+    # Failed queries raise rather than return None, and nothing is
+    # cached for them.
+    with Replacer() as r:
+        cache = replace_cache(r)
+        r.replace('cocotools.query._get', mock_failing__get)
+        nt.assert_raises(urllib2.URLError, undecorated, None, None)
+        nt.assert_raises(urllib2.URLError, cache, 'Mapping', 'A')
+        nt.assert_raises(IndexError, cache.select_xml, 'Mapping', 'A')
     
     
 @replace('cocotools.query.DBPATH', ':memory:')
@@ -180,24 +409,245 @@ def test__CoCoLite():
         mock_select_xml = lambda self, s, b: 'stuff'
         r.replace('cocotools.query._CoCoLite.select_xml', mock_select_xml)
         nt.assert_equal(db('Mapping', 'A'), 'stuff')
-    # Test selection when cache has multiple matching entries
-    # (select_xml).
-    db.con.execute("""
-INSERT INTO cache
+    # The cache cannot hold multiple entries for a BrainMap.
+    nt.assert_raises(sqlite3.IntegrityError, db.con.execute, """
+INSERT INTO cache (bmap, type, xml)
 VALUES ('A', 'Mapping', 'entry #2')
 """)
-    nt.assert_raises(sqlite3.IntegrityError, db.select_xml, 'Mapping', 'A')
+    # insert_many replaces entries.
+    db.insert_many([('Mapping', 'A', 'entry #2'), ('Mapping', 'B', 'new')])
+    nt.assert_equal(db.select_xml('Mapping', 'A'), 'entry #2')
+    nt.assert_equal(db.select_xml('Mapping', 'B'), 'new')
+    # Lookups use the primary key rather than a table scan.
+    plan = db.con.execute("""
+EXPLAIN QUERY PLAN
+SELECT xml
+FROM cache
+WHERE bmap = 'A' AND type = 'Mapping'
+""").fetchall()
+    nt.assert_true('INDEX' in plan[0][-1])
+
+
+def test_pack_xml():
+    xml = open('cocotools/tests/sample_map.xml').read()
+    for codec in cq.CODECS:
+        packed = cq._pack_xml(xml, codec)
+        nt.assert_true(isinstance(packed, buffer))
+        nt.assert_equal(cq._unpack_xml(packed), xml)
+    nt.assert_true(len(cq._pack_xml(xml * 20)) < len(xml * 20) / 5)
+    # XML cached before compression was introduced is stored as TEXT.
+    nt.assert_equal(cq._unpack_xml(xml), xml)
+
+
+@replace('cocotools.query.DBPATH', ':memory:')
+def test__CoCoLite_recompress():
+    db = cq._CoCoLite(mock_func)
+    xml = open('cocotools/tests/sample_map.xml').read() * 20
+    db.con.execute('INSERT INTO cache (bmap, type, xml) VALUES (?, ?, ?)',
+                   ('A', 'Mapping', xml))
+    db.insert_many([('Mapping', 'B', xml)])
+    before, after = db.recompress('bz2')
+    nt.assert_true(after < before)
+    nt.assert_equal(db.select_xml('Mapping', 'A'), xml)
+    nt.assert_equal(db.select_xml('Mapping', 'B'), xml)
+    value = db.con.execute("SELECT xml FROM cache WHERE bmap = 'A'").fetchone()
+    nt.assert_true(str(value[0]).startswith('bz2:'))
+
+
+def mock_parse(search_type, bmap, seen=()):
+    mock_parse.calls += 1
+    return [(bmap, 'B-1', {'RC': 'I', 'PDC': mock_parse.calls})]
+
+
+@replace('cocotools.query.DBPATH', ':memory:')
+def test__CoCoLiteEbunch():
+    xml_cache = cq._CoCoLite(mock_func)
+    db = cq._CoCoLiteEbunch(mock_parse, xml_cache)
+    mock_parse.calls = 0
+    # Without cached XML, nothing is stored.
+    nt.assert_equal(db('Mapping', 'A-1'), [('A-1', 'B-1', {'RC': 'I',
+                                                           'PDC': 1})])
+    nt.assert_raises(IndexError, db.select_ebunch, 'Mapping', 'A-1')
+    # With cached XML, the ebunch is parsed once.
+    xml_cache('Mapping', 'A-1')
+    db('Mapping', 'A-1')
+    nt.assert_equal(db('Mapping', 'A-1'), [('A-1', 'B-1', {'RC': 'I',
+                                                           'PDC': 2})])
+    nt.assert_equal(mock_parse.calls, 2)
+    # New XML invalidates the ebunch.
+    xml_cache.insert_many([('Mapping', 'A-1', 'new xml')])
+    nt.assert_equal(db('Mapping', 'A-1')[0][2]['PDC'], 3)
+    nt.assert_equal(db('Mapping', 'A-1')[0][2]['PDC'], 3)
+    # So does a new parser version.
+    with Replacer() as r:
+        r.replace('cocotools.query.PARSER_VERSION', cq.PARSER_VERSION + 1)
+        nt.assert_equal(db('Mapping', 'A-1')[0][2]['PDC'], 4)
+    # Removing the XML removes the ebunch.
+    xml_cache.remove_entry('Mapping', 'A-1')
+    nt.assert_equal(xml_cache.con.execute('SELECT COUNT(*) FROM '
+                                          'ebunch').fetchone()[0], 0)
+
+
+def test__CoCoLite_migration():
+    tempdir = tempfile.mkdtemp()
+    dbpath = os.path.join(tempdir, 'old.sqlite')
+    try:
+        con = sqlite3.connect(dbpath)
+        con.execute("""
+CREATE TABLE cache
+(
+    bmap TEXT,
+    type TEXT,
+    xml TEXT UNIQUE
+)
+""")
+        con.executemany('INSERT INTO cache VALUES (?, ?, ?)',
+                        [('A', 'Mapping', 'first'),
+                         ('A', 'Mapping', 'second'),
+                         ('A', 'Connectivity', 'third')])
+        con.commit()
+        con.close()
+        area_dbpath = os.path.join(tempdir, 'area.sqlite')
+        con = sqlite3.connect(area_dbpath)
+        con.execute("""
+CREATE TABLE cache
+(
+    bmapPLUSarea TEXT,
+    type TEXT,
+    xml TEXT UNIQUE
+)
+""")
+        con.execute("INSERT INTO cache VALUES ('A-1', 'Mapping', 'fourth')")
+        con.commit()
+        con.close()
+        with Replacer() as r:
+            r.replace('cocotools.query.DBPATH', dbpath)
+            r.replace('cocotools.query.AREA_DBPATH', area_dbpath)
+            db = cq._CoCoLite(mock_func)
+        nt.assert_equal(db.con.execute('PRAGMA user_version').fetchone()[0],
+                        cq.SCHEMA_VERSION)
+        nt.assert_equal(db.con.execute('PRAGMA journal_mode').fetchone()[0],
+                        'wal')
+        nt.assert_equal(db.select_xml('Mapping', 'A'), 'first')
+        nt.assert_equal(db.select_xml('Connectivity', 'A'), 'third')
+        nt.assert_equal(db.con.execute("SELECT hash FROM cache WHERE type = "
+                                       "'Connectivity'").fetchone()[0],
+                        cq._xml_hash('third'))
+        nt.assert_equal(db.select_xml('Mapping', 'A-1'), 'fourth')
+        db.con.close()
+        # Opening an up-to-date file again changes nothing.
+        with Replacer() as r:
+            r.replace('cocotools.query.DBPATH', dbpath)
+            db = cq._CoCoLite(mock_func)
+        nt.assert_equal(db.select_xml('Mapping', 'A'), 'first')
+        db.con.close()
+    finally:
+        shutil.rmtree(tempdir)
 
     
+@replace('cocotools.query.DBPATH', ':memory:')
+@replace('cocotools.query.AREA_DBPATH', 'no_such_file.sqlite')
+def test_export_import_cache():
+    tempdir = tempfile.mkdtemp()
+    path = os.path.join(tempdir, 'cache.snapshot')
+    try:
+        source = cq._CoCoLite(mock_func)
+        source.insert_many([('Mapping', 'A%d' % i, 'xml %d' % i) for i in
+                            range(1200)])
+        # An entry cached before compression was introduced.
+        source.con.execute("""
+INSERT INTO cache (bmap, type, xml, hash)
+VALUES ('B', 'Connectivity', 'old', 'hash')
+""")
+        cq._CoCoLiteEbunch(None, source).insert_ebunch('Mapping', 'A1',
+                                                       [('x', 'y', {})])
+        nt.assert_equal(cq.export_cache(path, source), 1201)
+        target = cq._CoCoLite(mock_func)
+        target.insert_many([('Mapping', 'A1', 'stale')])
+        nt.assert_equal(cq.import_cache(path, target), 1201)
+        nt.assert_equal(target.select_xml('Mapping', 'A1'), 'xml 1')
+        nt.assert_equal(target.select_xml('Mapping', 'A1199'), 'xml 1199')
+        nt.assert_equal(target.select_xml('Connectivity', 'B'), 'old')
+        nt.assert_equal(cq._CoCoLiteEbunch(None, target).select_ebunch(
+            'Mapping', 'A1'), [('x', 'y', {})])
+        # A damaged snapshot is refused and nothing is loaded from it.
+        data = open(path, 'rb').read()
+        # The digest is checked before anything is unmarshalled, so a
+        # damaged chunk is caught as such rather than by zlib.
+        in_chunk = len(cq.SNAPSHOT_MAGIC) + 20
+        for damaged in (data[:-1] + chr(ord(data[-1]) ^ 1), data[:-30],
+                        'not a snapshot\n' + data,
+                        data[:in_chunk] + chr(ord(data[in_chunk]) ^ 1) +
+                        data[in_chunk + 1:]):
+            with open(path, 'wb') as f:
+                f.write(damaged)
+            target = cq._CoCoLite(mock_func)
+            nt.assert_raises(ValueError, cq.import_cache, path, target)
+            nt.assert_equal(target.con.execute('SELECT COUNT(*) FROM '
+                                               'cache').fetchone()[0], 0)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_export_import_cache_area_mode():
+    tempdir = tempfile.mkdtemp()
+    path = os.path.join(tempdir, 'cache.snapshot')
+    areas = {'Mapping': {'PP99': ['19', '23', 'TEO', 'TF']}}
+    try:
+        with Replacer() as r:
+            source = replace_cache(r)
+            r.replace('cocotools.client.DEFAULT_CLIENT', MockClient())
+            r.replace('cocotools.query.AREAS', areas)
+            ebunch = cq.single_map_ebunch('Mapping', 'PP99')
+            count = cq.export_cache(path, source)
+        # A machine offline that imports the snapshot goes straight to
+        # the areas cached for PP99.
+        with Replacer() as r:
+            target = replace_cache(r)
+            r.replace('cocotools.query._get', mock_failing__get)
+            r.replace('cocotools.query.AREAS', areas)
+            cq.import_cache(path, target)
+            nt.assert_true(target.select_area_mode('Mapping', 'PP99'))
+            nt.assert_equal(cq.multi_map_ebunch('Mapping', ['PP99']),
+                            (ebunch, []))
+            nt.assert_equal(cq.ingest_journal.states('Mapping'),
+                            [('PP99', 'done', None, 1)])
+        # Snapshots written before area_mode was included still load.
+        data = open(path, 'rb').read()
+        with open(path, 'wb') as f:
+            f.write(data.replace(cq.SNAPSHOT_MAGIC,
+                                 cq.OLD_SNAPSHOT_MAGICS[0], 1))
+        with Replacer() as r:
+            target = replace_cache(r)
+            nt.assert_equal(cq.import_cache(path, target), count)
+    finally:
+        shutil.rmtree(tempdir)
+
+
 @replace('cocotools.query.DBPATH', ':memory:')
 def test_remove_entry():
     cq.query_cocomac.con.execute("""
-INSERT INTO cache
+INSERT INTO cache (bmap, type, xml)
 VALUES ('A', 'B', 'Blah')
 """)
     nt.assert_equal(cq.query_cocomac.select_xml('B', 'A'), 'Blah')
     cq.query_cocomac.remove_entry('B', 'A')
     nt.assert_raises(IndexError, cq.query_cocomac.select_xml, 'B', 'A')
+
+
+@replace('cocotools.query.DBPATH', ':memory:')
+def test__CoCoLite_threads():
+    db = cq._CoCoLite(mock_func)
+    bmaps = ['A%d' % i for i in range(20)] * 2
+    threads = [threading.Thread(target=db, args=('Mapping', bmap)) for bmap
+               in bmaps]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    count = db.con.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+    nt.assert_equal(count, 20)
+    nt.assert_equal(db.select_xml('Mapping', 'A7'), 'xml Mapping A7 xml')
     
 #------------------------------------------------------------------------------
 # Public Function Unit Tests
@@ -208,17 +658,194 @@ def test_url():
 %28%27PP99%27%29%5BSourceMap%5DOR%28%27PP99%27%29%5BTargetMap%5D&user=\
 teamcoco&password=teamcoco&OutputType=XML_Browser&DataSet=PrimRel"""
     nt.assert_equal(cq.url('Mapping', 'PP99'), url)
+    url = """http://134.95.56.239/URLSearch.asp?Search=Mapping&SearchString=\
+%28%28%27PP99%27%29%5BSourceMap%5DOR%28%27PP99%27%29%5BTargetMap%5D%29AND%28\
+%28%2710%27%29%5BSourceSite%5DOR%28%2710%27%29%5BTargetSite%5DOR%28%2711%27\
+%29%5BSourceSite%5DOR%28%2711%27%29%5BTargetSite%5D%29&user=teamcoco&password=\
+teamcoco&OutputType=XML_Browser&DataSet=PrimRel"""
+    nt.assert_equal(cq.url('Mapping', 'PP99', ['10', '11']), url)
 
     
-@replace('cocotools.query.query_cocomac', mock_query_cocomac)
-@replace('cocotools.query._element_tree', mock__element_tree)
 @replace('cocotools.query._element2edge', mock__element2edge)
 def test_single_map_ebunch():
     ebunch = [('node', 'node', 'edge_attr') for i in range(4)]
-    nt.assert_equal(cq.single_map_ebunch('Mapping', 'A'), ebunch)
+    with Replacer() as r:
+        replace_cache(r)
+        r.replace('cocotools.query.query_cocomac.func', mock_query_cocomac)
+        nt.assert_equal(cq.single_map_ebunch('Mapping', 'A'), ebunch)
 
     
-@replace('cocotools.query.single_map_ebunch', mock_single_map_ebunch)
+def test_single_map_ebunch_by_area():
+    areas = ['19', '23', 'TEO', 'TF', 'XX']
+    client = MockClient()
+    with Replacer() as r:
+        replace_cache(r)
+        r.replace('cocotools.client.DEFAULT_CLIENT', client)
+        r.replace('cocotools.query.AREAS', {'Mapping': {'PP99': areas}})
+        ebunch = cq.single_map_ebunch('Mapping', 'PP99')
+        # The whole BrainMap, then all five areas, timed out, and the
+        # areas were split until the server answered.
+        nt.assert_equal([s.count('[SourceSite]') for s in client.searches],
+                        [0, 5, 2, 3, 1, 2])
+        nt.assert_equal(sorted(ebunch),
+                        sorted(cq._iter_edges(open('cocotools/tests/'
+                                                   'sample_map.xml'),
+                                              'Mapping')))
+        # Areas already cached are not queried again.
+        del client.searches[:]
+        ebunch, failures = cq.query_maps_by_area('Mapping', ['PP99'])
+        nt.assert_equal(len(ebunch), 4)
+        nt.assert_equal(failures, ['PP99-XX'])
+        nt.assert_equal(client.searches, ["(('PP99')[SourceMap]OR"
+                                          "('PP99')[TargetMap])AND"
+                                          "(('XX')[SourceSite]OR"
+                                          "('XX')[TargetSite])"])
+
+
+def test_single_map_ebunch_area_mode():
+    areas = ['19', '23', 'TEO', 'TF']
+    client = MockClient()
+    with Replacer() as r:
+        cache = replace_cache(r)
+        r.replace('cocotools.client.DEFAULT_CLIENT', client)
+        r.replace('cocotools.query.AREAS', {'Mapping': {'PP99': areas}})
+        ebunch = cq.single_map_ebunch('Mapping', 'PP99')
+        nt.assert_true(cache.select_area_mode('Mapping', 'PP99'))
+        # The query for the whole BrainMap is not repeated, and the areas
+        # are answered from the cache.
+        del client.searches[:]
+        nt.assert_equal(cq.single_map_ebunch('Mapping', 'PP99'), ebunch)
+        nt.assert_equal(client.searches, [])
+
+
+def test_query_maps_by_area_batches():
+    areas = ['19', '23', 'TEO', 'TF', 'XX']
+    client = MockClient()
+    with Replacer() as r:
+        replace_cache(r)
+        r.replace('cocotools.client.DEFAULT_CLIENT', client)
+        r.replace('cocotools.query.AREAS', {'Mapping': {'PP99': areas}})
+        r.replace('cocotools.query.MAX_URL_LENGTH',
+                  len(cq.url('Mapping', 'PP99', ['TEO', 'TF'])))
+        ebunch, failures = cq.query_maps_by_area('Mapping', ['PP99'])
+        nt.assert_equal([s.count('[SourceSite]') for s in client.searches],
+                        [2, 2, 1])
+        nt.assert_equal(len(ebunch), 4)
+        nt.assert_equal(failures, ['PP99-XX'])
+        # Single areas are then answered from the cache.
+        del client.searches[:]
+        nt.assert_equal(len(cq.single_area_ebunch('Mapping', 'PP99', 'TEO')),
+                        1)
+        nt.assert_equal(client.searches, [])
+
+
+@replace('cocotools.query.BACKOFF', 0)
+def test_multi_map_ebunch_retries():
+    map_records = MockFlakyMapRecords()
+    with Replacer() as r:
+        replace_cache(r)
+        r.replace('cocotools.query._map_records', map_records)
+        e, f = cq.multi_map_ebunch('Mapping', ['A', 'B', 'C', 'D', 'E'])
+        nt.assert_equal(e, [('A', 'node', 'edge_attr'),
+                            ('E', 'node', 'edge_attr')])
+        nt.assert_equal(f, ['B', 'C', 'D'])
+        nt.assert_equal(map_records.calls,
+                        ['A'] * 3 + ['B'] * (cq.RETRIES + 1) +
+                        ['C', 'D', 'E'])
+        nt.assert_equal(cq.ingest_journal.states('Mapping'),
+                        [('A', 'done', None, 3),
+                         ('B', 'failed', 'URLError', cq.RETRIES + 1),
+                         ('C', 'failed', 'HTTPError', 1),
+                         ('D', 'failed', 'NoData', 1),
+                         ('E', 'done', None, 1)])
+
+
+def test_multi_map_ebunch_duplicates():
+    with Replacer() as r:
+        replace_cache(r)
+        r.replace('cocotools.query._map_records', mock_shared__map_records)
+        e, f = cq.multi_map_ebunch('Mapping', ['A', 'B', 'C'])
+        nt.assert_equal(e, [('A-1', 'A-2', 'edge_attr'),
+                            ('A-1', 'B-1', 'edge_attr'),
+                            ('B-1', 'B-2', 'edge_attr'),
+                            ('C-1', 'C-2', 'edge_attr')])
+        nt.assert_equal(cq.ingest_journal.duplicates('Mapping'), 1)
+        edges = cq.iter_map_edges('Mapping', ['B', 'A'])
+        nt.assert_equal(len(list(edges)), 3)
+        nt.assert_equal(cq.ingest_journal.duplicates('Mapping'), 1)
+
+
+def test_multi_map_ebunch_duplicates_not_converted():
+    xml = open('cocotools/tests/sample_map.xml').read()
+    calls = []
+
+    def count__element2edge(prim_e, search_type):
+        calls.append(prim_e)
+        return element2edge(prim_e, search_type)
+
+    element2edge = cq._element2edge
+    with Replacer() as r:
+        cache = replace_cache(r)
+        # Both BrainMaps return the same four records.
+        r.replace('cocotools.query.query_cocomac.func',
+                  lambda search_type, bmap: xml)
+        r.replace('cocotools.query._element2edge', count__element2edge)
+        e, f = cq.multi_map_ebunch('Mapping', ['A', 'B'])
+        nt.assert_equal(len(e), 4)
+        nt.assert_equal(cq.ingest_journal.duplicates('Mapping'), 4)
+        # The records for B were not converted to edges.
+        nt.assert_equal(len(calls), 4)
+        # Run again, the ingest is answered from the ebunch cache.
+        del calls[:]
+        nt.assert_equal(cq.multi_map_ebunch('Mapping', ['A', 'B']), (e, f))
+        nt.assert_equal(calls, [])
+        # On its own, B has its XML parsed in full.
+        nt.assert_equal(sorted(cq.single_map_ebunch('Mapping', 'B')),
+                        sorted(e))
+        nt.assert_equal(len(calls), 4)
+
+
+def test_record_key():
+    with open('cocotools/tests/sample_map.xml') as xml:
+        xml = xml.read()
+    keys = [key for key, edge in cq._iter_records(StringIO(xml), 'Mapping')]
+    nt.assert_equal(len(set(keys)), 4)
+    # Whitespace between elements does not matter.
+    keys2 = [key for key, edge in
+             cq._iter_records(StringIO(xml.replace('>\n<', '>\n  <')),
+                              'Mapping')]
+    nt.assert_equal(keys2, keys)
+
+
+@replace('cocotools.query.BACKOFF', 0)
+def test_resume():
+    map_records = MockFlakyMapRecords()
+    with Replacer() as r:
+        replace_cache(r)
+        r.replace('cocotools.query._map_records', map_records)
+        edges = cq.iter_map_edges('Mapping', ['E', 'A', 'F'])
+        nt.assert_equal(edges.next(), ('E', 'node', 'edge_attr'))
+        # The ingest is interrupted.
+        edges.close()
+        nt.assert_equal([state for bmap, state, error, attempts in
+                         cq.ingest_journal.states('Mapping')],
+                        ['done', 'pending', 'pending'])
+        done_row = cq.ingest_journal.states('Mapping')[0]
+        e, f = cq.resume('Mapping')
+        nt.assert_equal(e, [('E', 'node', 'edge_attr'),
+                            ('A', 'node', 'edge_attr'),
+                            ('F', 'node', 'edge_attr')])
+        nt.assert_equal(f, [])
+        nt.assert_equal([state for bmap, state, error, attempts in
+                         cq.ingest_journal.states('Mapping')], ['done'] * 3)
+        # E was done, so it was answered without being marked again.
+        nt.assert_equal(cq.ingest_journal.states('Mapping')[0], done_row)
+        nt.assert_equal(done_row, ('E', 'done', None, 1))
+        nt.assert_raises(ValueError, cq.resume, 'Nothing')
+
+
+@in_memory_cache
+@replace('cocotools.query._map_records', mock__map_records)
 def test_multi_map_ebunch():
     e, f = cq.multi_map_ebunch(None, ['A', 'B', 'C', 'D'])
     nt.assert_equal(e, [('node', 'node', 'edge_attr') for i in range(4)])
@@ -226,3 +853,41 @@ def test_multi_map_ebunch():
     e, f = cq.multi_map_ebunch(None, 'cocotools/tests/sample_bmaps.txt')
     nt.assert_equal(e, [('node', 'node', 'edge_attr') for i in range(2)])
     nt.assert_equal(f, ['PP02'])
+
+
+@in_memory_cache
+@replace('cocotools.query._map_records', mock_slow__map_records)
+def test_multi_map_ebunch_workers():
+    e, f = cq.multi_map_ebunch(None, ['A', 'B', 'C', 'D'], workers=4)
+    nt.assert_equal(e, [('A', 'node', 'edge_attr'), ('C', 'node', 'edge_attr')])
+    nt.assert_equal(f, ['B', 'D'])
+
+
+@in_memory_cache
+@replace('cocotools.query._map_records', mock__map_records)
+def test_iter_map_edges():
+    failures = []
+    edges = cq.iter_map_edges(None, ['B', 'A', 'D', 'C'],
+                              on_failure=failures.append)
+    # Nothing is queried until the first edge is requested, and then
+    # only as far as the first BrainMap with data.
+    nt.assert_equal(failures, [])
+    nt.assert_equal(edges.next(), ('node', 'node', 'edge_attr'))
+    nt.assert_equal(failures, ['B'])
+    nt.assert_equal(len(list(edges)), 3)
+    nt.assert_equal(failures, ['B', 'D'])
+
+
+@in_memory_cache
+@replace('cocotools.query._map_records', mock_slow__map_records)
+def test_iter_map_edges_workers():
+    failures = []
+    edges = cq.iter_map_edges(None, ['A', 'B', 'C', 'D'] * 5, workers=2,
+                              on_failure=failures.append)
+    nt.assert_equal(list(edges), [('A', 'node', 'edge_attr'),
+                                  ('C', 'node', 'edge_attr')] * 5)
+    nt.assert_equal(failures, ['B', 'D'] * 5)
+    # Stopping early does not hang.
+    edges = cq.iter_map_edges(None, ['A', 'B', 'C', 'D'] * 5, workers=2)
+    nt.assert_equal(edges.next(), ('A', 'node', 'edge_attr'))
+    edges.close()
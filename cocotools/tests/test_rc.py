@@ -0,0 +1,42 @@
+import numpy as np
+import nose.tools as nt
+
+import cocotools.rc as rc
+
+
+def test_encode_decode():
+    nt.assert_equal(rc.encode('SO'), rc.S | rc.O)
+    nt.assert_equal(rc.encode('ISLO'), rc.ISLO)
+    nt.assert_equal(rc.decode(rc.L | rc.O), 'LO')
+    nt.assert_equal(rc.decode(rc.encode('OS')), 'SO')
+    nt.assert_equal(rc.decode(0), None)
+
+
+def test_composition():
+    # The table MapGraph used to step through chains of RCs.
+    map_step = {'I': {'I': 'I', 'S': 'S', 'L': 'L', 'O': 'O'},
+                'S': {'I': 'S', 'S': 'S'},
+                'L': {'I': 'L', 'S': 'ISLO', 'L': 'L', 'O': 'LO'},
+                'O': {'I': 'O', 'S': 'SO'},
+                'SO': {'I': 'SO', 'S': 'SO'},
+                'LO': {'I': 'LO', 'S': 'ISLO'},
+                'ISLO': {'I': 'ISLO', 'S': 'ISLO'}}
+    for a, steps in map_step.iteritems():
+        for b in 'ISLO':
+            nt.assert_equal(rc.decode(rc.COMPOSITION[rc.encode(a),
+                                                     rc.encode(b)]),
+                            steps.get(b))
+    # Zero cannot be resolved by what follows it.
+    nt.assert_equal(rc.COMPOSITION[0].tolist(), [0] * 16)
+    nt.assert_equal(rc.COMPOSITION[:, 0].tolist(), [0] * 16)
+
+
+def test_compose():
+    a = np.array([rc.I, rc.S, rc.L, rc.O])
+    nt.assert_equal(rc.compose(a, rc.S).tolist(),
+                    [rc.S, rc.S, rc.ISLO, rc.S | rc.O])
+    nt.assert_equal(rc.compose(a, a).tolist(), [rc.I, rc.S, rc.L, 0])
+    table = rc.compose(a[:, np.newaxis], a)
+    nt.assert_equal(table.shape, (4, 4))
+    nt.assert_equal(table[2, 3], rc.L | rc.O)
+    nt.assert_equal(rc.compose(rc.O, rc.I), rc.O)
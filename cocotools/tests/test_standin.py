@@ -0,0 +1,171 @@
+from cStringIO import StringIO
+from unittest import TestCase
+
+from testfixtures import Replacer
+import nose.tools as nt
+
+import cocotools.client as cc
+import cocotools.query as cq
+import cocotools.standin as cs
+from cocotools.tests.test_query import replace_cache
+
+
+def test_from_files():
+    data = cs.StandInData.from_files({'Mapping':
+                                      ['cocotools/tests/sample_map.xml']})
+    nt.assert_equal(data.bmaps, ['B05', 'BB47', 'PP99'])
+    nt.assert_equal(len(data.select('Mapping', 'PP99')), 4)
+    nt.assert_equal(len(data.select('Mapping', 'PP99', ['19', 'TF'])), 2)
+    nt.assert_equal(data.select('Connectivity', 'PP99'), [])
+    xml = cq._scrub_xml_str(cs.HEADER + ''.join(data.select('Mapping',
+                                                            'PP99')) +
+                            cs.FOOTER)
+    nt.assert_equal(list(cq._iter_edges(StringIO(xml), 'Mapping')),
+                    list(cq._iter_edges(open('cocotools/tests/'
+                                             'sample_map.xml'), 'Mapping')))
+
+
+class StandInServerTestCase(TestCase):
+
+    def setUp(self):
+        self.data = cs.StandInData.synthetic(n_maps=4, areas_per_map=6,
+                                             records_per_map=10)
+        self.replacer = Replacer()
+        replace_cache(self.replacer)
+        self.replacer.replace('cocotools.query.BACKOFF', 0)
+
+    def tearDown(self):
+        self.replacer.restore()
+        self.server.stop()
+
+    def start_server(self, timeout=120, **kwargs):
+        self.server = cs.StandInServer(self.data, **kwargs)
+        self.server.start()
+        self.replacer.replace('cocotools.client.COCOMAC_URL', self.server.url)
+        self.replacer.replace('cocotools.client.DEFAULT_CLIENT',
+                              cc.CoCoMacClient(timeout=timeout))
+
+    def expected_edges(self, search_type):
+        # Each record once, although it is returned for both of its
+        # BrainMaps.
+        keys = set()
+        for bmap in self.data.bmaps:
+            xml = (cs.HEADER + ''.join(self.data.select(search_type, bmap)) +
+                   cs.FOOTER)
+            for key, edge in cq._iter_records(cq._XMLScrubber(StringIO(xml)),
+                                              search_type):
+                keys.add(key)
+        return len(keys)
+
+    def test_multi_map_ebunch(self):
+        self.start_server()
+        for search_type in ('Mapping', 'Connectivity'):
+            ebunch, failures = cq.multi_map_ebunch(search_type,
+                                                   self.data.bmaps, workers=4)
+            nt.assert_equal(failures, [])
+            nt.assert_equal(len(ebunch), self.expected_edges(search_type))
+        nt.assert_equal(self.server.requests, 8)
+        # A second ingest is answered from the cache.
+        cq.multi_map_ebunch('Mapping', self.data.bmaps)
+        nt.assert_equal(self.server.requests, 8)
+
+    def test_cache_stats(self):
+        self.start_server()
+        cq.cache_stats(reset=True)
+        cq.multi_map_ebunch('Mapping', self.data.bmaps)
+        stats = cq.cache_stats()
+        nt.assert_equal((stats['hits'], stats['misses'], stats['negatives'],
+                         stats['requests']), (0, 4, 0, 4))
+        nt.assert_true(stats['bytes'] > 0)
+        nt.assert_equal(sum(n for upper, n in stats['latency']), 4)
+        nt.assert_equal(sorted(stats['parses']),
+                        [('Mapping', bmap) for bmap in self.data.bmaps])
+        # Parsed ebunches are then taken from the cache.
+        with Replacer() as r:
+            out = StringIO()
+            r.replace('sys.stdout', out)
+            cq.multi_map_ebunch('Mapping', self.data.bmaps, summary=True)
+        stats = cq.cache_stats()
+        nt.assert_equal((stats['ebunch_hits'], stats['misses'],
+                         stats['requests']), (4, 0, 0))
+        lines = out.getvalue().splitlines()
+        nt.assert_equal(lines[0], 'Parsed ebunches: 4 from cache, 0 parsed')
+        nt.assert_true(lines[1].startswith('BrainMap XML: 0 from cache, '
+                                           '0 queried'))
+
+    def add_record(self, bmap):
+        source, target = '%s-A0' % bmap, '%s-A1' % bmap
+        self.data.records['Mapping'].append(
+            (source, target, cs._mapping_element(source, target,
+                                                 cs.random.Random(1))))
+
+    def test_refresh_cache(self):
+        self.start_server()
+        cq.multi_map_ebunch('Mapping', self.data.bmaps)
+        nt.assert_equal(cq.refresh_cache('Mapping', self.data.bmaps),
+                        ([], []))
+        self.add_record('SYN02')
+        cq.cache_stats(reset=True)
+        nt.assert_equal(cq.refresh_cache('Mapping', self.data.bmaps,
+                                         workers=2), (['SYN02'], []))
+        nt.assert_equal(self.server.requests, 12)
+        # Only the BrainMap that changed is parsed again.
+        ebunch, failures = cq.multi_map_ebunch('Mapping', self.data.bmaps)
+        nt.assert_equal(len(ebunch), self.expected_edges('Mapping'))
+        nt.assert_equal(cq.cache_stats()['parses'].keys(),
+                        [('Mapping', 'SYN02')])
+
+    def test_refresh_cache_by_area(self):
+        self.start_server(timeout=0.2, max_records=8, stall=0.5)
+        self.replacer.replace('cocotools.query.AREAS',
+                              {'Mapping': self.data.areas})
+        cq.multi_map_ebunch('Mapping', self.data.bmaps, workers=4)
+        self.add_record('SYN01')
+        nt.assert_equal(cq.refresh_cache('Mapping', ['SYN01']),
+                        (['SYN01'], []))
+        # Only areas were cached, and still are.
+        nt.assert_false('SYN01' in cq.query_cocomac.select_hashes('Mapping',
+                                                                  'SYN01'))
+        ebunch, failures = cq.multi_map_ebunch('Mapping', self.data.bmaps)
+        nt.assert_equal(len(ebunch), self.expected_edges('Mapping'))
+
+    def test_refresh_cache_empty_area(self):
+        self.start_server(timeout=0.2, max_records=8, stall=0.5)
+        self.replacer.replace('cocotools.query.AREAS',
+                              {'Mapping': self.data.areas})
+        cq.multi_map_ebunch('Mapping', self.data.bmaps, workers=4)
+        # Every record for one area of SYN01 disappears upstream.
+        area = self.data.areas['SYN01'][0]
+        site = cq._area_key('SYN01', area)
+        records = self.data.records['Mapping']
+        nt.assert_true([r for r in records if site in r[:2]])
+        records[:] = [r for r in records if site not in r[:2]]
+        nt.assert_equal(cq.refresh_cache('Mapping', ['SYN01']),
+                        (['SYN01'], []))
+        nt.assert_false(cq.single_area_ebunch('Mapping', 'SYN01', area))
+
+    def test_refresh_cache_errors(self):
+        self.start_server()
+        cq.multi_map_ebunch('Mapping', self.data.bmaps)
+        self.server.error_rate = 1
+        self.add_record('SYN02')
+        nt.assert_equal(cq.refresh_cache('Mapping', ['SYN02']),
+                        ([], ['SYN02']))
+
+    def test_timeouts(self):
+        self.start_server(timeout=0.2, max_records=8, stall=0.5)
+        self.replacer.replace('cocotools.query.AREAS',
+                              {'Mapping': self.data.areas})
+        ebunch, failures = cq.multi_map_ebunch('Mapping', self.data.bmaps,
+                                               workers=4)
+        nt.assert_equal(failures, [])
+        nt.assert_equal(len(ebunch), self.expected_edges('Mapping'))
+        nt.assert_true(self.server.timeouts >= 4)
+
+    def test_errors(self):
+        self.replacer.replace('cocotools.query.RETRIES', 2)
+        self.start_server(error_rate=1)
+        ebunch, failures = cq.multi_map_ebunch('Mapping', self.data.bmaps)
+        nt.assert_equal(ebunch, [])
+        nt.assert_equal(failures, self.data.bmaps)
+        nt.assert_equal(self.server.errors, 4 * 3)
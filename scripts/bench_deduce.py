@@ -0,0 +1,120 @@
+"""Time MapGraph.deduce_edges on synthetic Mapping data.
+
+Usage: python bench_deduce.py [--shared=fraction] [n_maps ...]
+
+Each BrainMap divides the same line of atoms into consecutive regions,
+so the true relation between any two regions is known.  A fraction of
+the relations between regions of different maps is given to the
+MapGraph as literature statements, a few of them with the wrong RC so
+that there are contradictions to eliminate.  deduce_edges, with and
+without identical regions collapsed, is compared with the single pass
+over the nodes it replaced (default 10, 20, and 40 maps).  With
+--shared, that fraction of the BrainMaps divide the atoms as an earlier
+one does (default 0).
+"""
+import random
+import sys
+import time
+
+from cocotools import MapGraph
+
+
+def synthetic_edges(n_maps, n_atoms=200, regions=(5, 15), fraction=0.3,
+                    noise=0.05, shared=0.0, seed=0):
+    """Return an ebunch relating regions of n_maps BrainMaps.
+
+    With probability shared, a BrainMap divides the atoms just as an
+    earlier one does, so that its regions are identical to that one's.
+    """
+    rng = random.Random(seed)
+    sites = {}
+    partitions = []
+    for i in range(n_maps):
+        if shared and partitions and rng.random() < shared:
+            bounds = rng.choice(partitions)
+        else:
+            n_regions = rng.randint(*regions)
+            bounds = ([0] + sorted(rng.sample(range(1, n_atoms),
+                                              n_regions - 1)) + [n_atoms])
+            partitions.append(bounds)
+        n_regions = len(bounds) - 1
+        for j in range(n_regions):
+            sites['SYN%02d-%d' % (i, j)] = frozenset(range(bounds[j],
+                                                           bounds[j + 1]))
+    nodes = sorted(sites)
+    edges = []
+    for i, source in enumerate(nodes):
+        for target in nodes[i + 1:]:
+            if source.split('-')[0] == target.split('-')[0]:
+                continue
+            a, b = sites[source], sites[target]
+            if a == b:
+                rc = 'I'
+            elif a < b:
+                rc = 'S'
+            elif a > b:
+                rc = 'L'
+            elif a & b:
+                rc = 'O'
+            else:
+                continue
+            if rng.random() < fraction:
+                if rng.random() < noise:
+                    rc = rng.choice('ISLO')
+                edges.append((source, target, {'RC': rc,
+                                               'PDC': rng.randint(0, 18)}))
+    rng.shuffle(edges)
+    return edges
+
+
+def single_pass_deduce(mapg):
+    """deduce_edges as it was: one pass over the nodes."""
+    for node in mapg.nodes_iter():
+        ebunch = []
+        for p in mapg.predecessors(node):
+            for s in mapg.successors(node):
+                tp = mapg[p][node]['TP'] + (node,) + mapg[node][s]['TP']
+                if mapg._from_different_maps(p, tp, s):
+                    ebunch.append((p, s, {'TP': tp}))
+        mapg.add_edges_from(ebunch)
+    mapg._eliminate_contradictions()
+
+
+def collapsed_deduce(mapg):
+    return mapg.deduce_edges(collapse_identities=True)
+
+
+def best_first_deduce(mapg):
+    return mapg.deduce_edges(best_first=True)
+
+
+def main(sizes, shared=0.0):
+    for n_maps in sizes:
+        edges = synthetic_edges(n_maps, shared=shared)
+        print '%d maps, %d statements:' % (n_maps, len(edges))
+        for name, deduce in (('single pass', single_pass_deduce),
+                             ('worklist', MapGraph.deduce_edges),
+                             ('collapsed', collapsed_deduce),
+                             ('best first', best_first_deduce)):
+            mapg = MapGraph()
+            mapg.add_edges_from(edges)
+            start = time.time()
+            report = deduce(mapg)
+            seconds = time.time() - start
+            line = '  %-12s %8.2f s %8d edges' % (name, seconds,
+                                                  mapg.number_of_edges())
+            if report and 'rounds' in report:
+                line += '  (%d rounds, %d candidates)' % (
+                    report['rounds'], report['candidates'])
+            elif report:
+                line += '  (%d candidates, %d rewrites avoided)' % (
+                    report['candidates'], report['rewrites_avoided'])
+            print line
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    shared = 0.0
+    if args and args[0].startswith('--shared='):
+        shared = float(args.pop(0).split('=')[1])
+    main([int(arg) for arg in args] or [10, 20, 40], shared)
@@ -0,0 +1,114 @@
+"""Measure ingest throughput against a local CoCoMac stand-in server.
+
+Usage: python bench_ingest.py [latency]
+
+multi_map_ebunch and query_maps_by_area are run against synthetic data
+with 1, 4, and 16 workers, first with an empty cache and then again with
+the cache filled by the first run.  For each run, BrainMaps per second,
+edges per second, the number of requests the server received, and the
+fraction of lookups answered from the cache are printed.  Finally, the
+time taken to export the warm cache to a snapshot and import it into an
+empty cache is printed, for comparison with the cold runs.  Latency is the
+delay in seconds before the server answers each request (default 0.05).
+
+The cache is kept in a temporary directory, so the cache in your home
+directory is left alone.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+tempdir = tempfile.mkdtemp()
+os.environ['HOME'] = tempdir
+
+from cocotools import client, query
+from cocotools.standin import StandInData, StandInServer
+
+
+WORKERS = (1, 4, 16)
+
+
+class Counter(object):
+
+    """Wrapper counting the calls made to func."""
+
+    def __init__(self, func, count=lambda *args: 1):
+        self.func = func
+        self.count = count
+        self.calls = 0
+
+    def __call__(self, *args):
+        self.calls += self.count(*args)
+        return self.func(*args)
+
+
+def clear_cache():
+    with query.query_cocomac.lock:
+        with query.query_cocomac.con as con:
+            con.execute('DELETE FROM cache')
+            con.execute('DELETE FROM ebunch')
+
+
+def run(server, name, ingest, lookups, misses):
+    requests = server.requests
+    misses.calls = 0
+    start = time.time()
+    ebunch, failures = ingest()
+    seconds = time.time() - start
+    print '  %-8s %8.1f maps/s %10.1f edges/s %6d requests %6.1f%% hits' % (
+        name, len(server.data.bmaps) / seconds, len(ebunch) / seconds,
+        server.requests - requests,
+        100.0 * (lookups - misses.calls) / lookups)
+
+
+def main(latency):
+    data = StandInData.synthetic(n_maps=40, areas_per_map=12,
+                                 records_per_map=200)
+    server = StandInServer(data, latency=latency)
+    server.start()
+    client.COCOMAC_URL = server.url
+    query.AREAS = {'Mapping': data.areas, 'Connectivity': data.areas}
+    n_areas = sum(len(areas) for areas in data.areas.itervalues())
+    # Count the BrainMaps and areas that had to be fetched.
+    map_misses = Counter(query.query_cocomac.func)
+    query.query_cocomac.func = map_misses
+    area_misses = Counter(query._fetch_areas,
+                          lambda search_type, bmap, areas: len(areas))
+    query._fetch_areas = area_misses
+    try:
+        for workers in WORKERS:
+            client.DEFAULT_CLIENT = client.CoCoMacClient(max_per_host=workers)
+            print 'multi_map_ebunch, %d workers:' % workers
+            clear_cache()
+            for name in ('cold', 'warm'):
+                run(server, name,
+                    lambda: query.multi_map_ebunch('Mapping', data.bmaps,
+                                                   workers),
+                    len(data.bmaps), map_misses)
+            print 'query_maps_by_area, %d workers:' % workers
+            clear_cache()
+            for name in ('cold', 'warm'):
+                run(server, name,
+                    lambda: query.query_maps_by_area('Mapping', data.bmaps,
+                                                     workers),
+                    n_areas, area_misses)
+            client.DEFAULT_CLIENT.close()
+        snapshot = os.path.join(tempdir, 'cache.snapshot')
+        start = time.time()
+        count = query.export_cache(snapshot)
+        export_seconds = time.time() - start
+        clear_cache()
+        start = time.time()
+        query.import_cache(snapshot)
+        print 'snapshot of %d entries: export %.3f s, import %.3f s' % (
+            count, export_seconds, time.time() - start)
+    finally:
+        client.DEFAULT_CLIENT.close()
+        server.stop()
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 0.05)
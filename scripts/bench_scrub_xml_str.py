@@ -0,0 +1,69 @@
+"""Time _scrub_xml_str against the regular expressions it replaced.
+
+Usage: python bench_scrub_xml_str.py [megabytes ...]
+
+The test fixtures are repeated until each response is about the given
+size (default 1, 10, and 50 MB), with the SQL string the server puts in
+front of the XML header.  Run from the root of the repository.
+"""
+import re
+import sys
+import time
+
+from cocotools.query import _scrub_xml_str, _XMLScrubber
+
+
+FIXTURES = ('cocotools/tests/sample_map.xml', 'cocotools/tests/sample_con.xml')
+PREFIX = 'SELECT  Top 32767  RelationCode, InterMapRelations.ID AS RelationID '
+
+
+def regex_scrub_xml_str(raw):
+    match = re.match('(.*)(<\?xml.*\?>.*)', raw, re.S)
+    if match:
+        out =  match.group(2)
+        invalids = """\
+[\xb4\xfc\xd6\r\xdc\xe4\xdf\xf6\x85\xf3\xf2\x92\x96\xed\x84\x94\xb0]"""
+        return re.sub(invalids, '', out)
+    else:
+        raise ValueError('input does not contain valid xml header')
+
+
+def chunked_scrub_xml_str(raw, size=16384):
+    scrubber = _XMLScrubber()
+    chunks = [scrubber.feed(raw[i:i + size]) for i in
+              range(0, len(raw), size)]
+    scrubber.close()
+    return ''.join(chunks)
+
+
+def best_time(func, raw, repeat=3):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func(raw)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(sizes):
+    for path in FIXTURES:
+        xml = open(path).read()
+        header_end = xml.index('?>') + 2
+        header, body = xml[:header_end], xml[header_end:]
+        for megabytes in sizes:
+            copies = max(1, int(megabytes * 2 ** 20 / len(body)))
+            raw = PREFIX + header + body * copies
+            assert (regex_scrub_xml_str(raw) == _scrub_xml_str(raw) ==
+                    chunked_scrub_xml_str(raw))
+            print '%s, %.1f MB:' % (path, len(raw) / 2.0 ** 20)
+            for name, func in (('regex', regex_scrub_xml_str),
+                               ('find + translate', _scrub_xml_str),
+                               ('chunked', chunked_scrub_xml_str)):
+                seconds = best_time(func, raw)
+                print '  %-16s %8.4f s %8.1f MB/s' % (name, seconds,
+                                                      len(raw) / 2.0 ** 20 /
+                                                      max(seconds, 1e-9))
+
+
+if __name__ == '__main__':
+    main([float(arg) for arg in sys.argv[1:]] or [1, 10, 50])
@@ -0,0 +1,14 @@
+"""Recompress the local CoCoMac query cache.
+
+Usage: python recompress_cache.py [codec]
+
+Entries cached before compression was introduced, or with a different
+codec, are rewritten with codec (default cocotools.query.CODEC).
+"""
+import sys
+
+from cocotools.query import query_cocomac
+
+codec = sys.argv[1] if len(sys.argv) > 1 else None
+before, after = query_cocomac.recompress(codec)
+print 'cache: %d bytes -> %d bytes' % (before, after)